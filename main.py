@@ -14,17 +14,32 @@ details.
 You should have received a copy of the GNU General Public License along with
 Dottore Genius Invokation PWA. If not, see <https://www.gnu.org/licenses/>
 """
-import flet as ft
+from src.timing import recorder, report_enabled  # imported first so its origin is close to process start
+import multiprocessing
 
-from src.app import DgisimApp
+from src.log import configure_logging
 
+with recorder.span("module import"):
+    import flet as ft
+
+    from src.app import DgisimApp
 
-def main(page: ft.Page):
-    DgisimApp(page)
 
+configure_logging()
 
-ft.app(
-    target=main,
-    assets_dir="assets",
-    # view=ft.AppView.FLET_APP,
-)
+
+def main(page: ft.Page):
+    DgisimApp(page)
+    if report_enabled():
+        print(recorder.report())
+
+
+# spawned rollout and engine worker processes re-import this module, so only
+# the parent starts the app; not keyed on __name__ as web builds import it as
+# "main"
+if multiprocessing.parent_process() is None:
+    ft.app(
+        target=main,
+        assets_dir="assets",
+        # view=ft.AppView.FLET_APP,
+    )
@@ -0,0 +1,178 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from typing import Iterator, TypeVar
+
+import dgisim as ds
+
+from ..engine import ENGINE_LOCK
+
+__all__ = [
+    "ActionCache",
+    "ActionList",
+    "iter_actions",
+]
+
+_K = TypeVar("_K")
+
+
+def _sub_multisets(counts: dict[_K, int], size: int | None = None) -> Iterator[dict[_K, int]]:
+    """
+    Yields every sub-multiset of `counts`, only those of `size` items if
+    given, starting with the empty one.
+    """
+    items = [(key, count) for key, count in counts.items() if count > 0]
+
+    def expand(i: int, left: int | None) -> Iterator[dict[_K, int]]:
+        if i == len(items):
+            if not left:
+                yield {}
+            return
+        key, count = items[i]
+        for n in range(min(count, count if left is None else left) + 1):
+            for rest in expand(i + 1, None if left is None else left - n):
+                yield {key: n, **rest} if n else rest
+
+    return expand(0, size)
+
+
+def _concrete_choices(act_gen: ds.ActionGenerator, choices: object) -> list[object]:
+    if isinstance(choices, ds.AbstractDice):
+        # dice of an element are interchangeable, so a payment is a count of
+        # each element, and paying with different dice of the same elements
+        # is one payment
+        return [
+            payment
+            for counts in _sub_multisets(act_gen.dice_available().to_dict(), choices.num_dice())
+            if (payment := ds.ActualDice(counts)).just_satisfy(choices)
+        ]
+    if isinstance(choices, ds.ActualDice):
+        # the dice to reroll, any of them
+        return [ds.ActualDice(counts) for counts in _sub_multisets(choices.to_dict())]
+    if isinstance(choices, ds.Cards):
+        # the cards to redraw, any of them
+        return [ds.Cards(counts) for counts in _sub_multisets(choices.to_dict())]
+    raise TypeError(f"Unknown choices {choices!r}")
+
+
+def iter_actions(game_state: ds.GameState, pid: ds.Pid) -> Iterator[ds.PlayerAction]:
+    """
+    Yields every distinct action `pid` can take at `game_state`, expanding the
+    action generator depth first.
+
+    Every exact payment of a cost, every set of dice to reroll and every set
+    of cards to redraw is a choice of its own. Only the same dice or cards
+    picked in another order, which make the same action, appear once.
+    """
+    act_gen = game_state.action_generator(pid)
+    if act_gen is None:
+        return
+    seen: set[ds.PlayerAction] = set()
+    stack = [act_gen]
+    while stack:
+        act_gen = stack.pop()
+        if act_gen.filled():
+            action = act_gen.generate_action()
+            if action not in seen:
+                seen.add(action)
+                yield action
+            continue
+        choices = act_gen.choices()
+        if isinstance(choices, tuple):
+            next_choices = list(choices)
+        else:
+            next_choices = _concrete_choices(act_gen, choices)
+        # reversed, so choices are yielded in the generator's order
+        stack.extend(act_gen.choose(choice) for choice in reversed(next_choices))
+
+
+class ActionList:
+    """
+    The actions of a state, expanded only as far as they are iterated and
+    kept for later iterations.
+
+    Expanding takes `ENGINE_LOCK` and then the list's own lock, never the
+    other way round, so it can't deadlock with callers holding `ENGINE_LOCK`.
+    """
+
+    def __init__(self, game_state: ds.GameState, pid: ds.Pid) -> None:
+        self._computed: list[ds.PlayerAction] = []
+        self._pending: Iterator[ds.PlayerAction] | None = iter_actions(game_state, pid)
+        #: only ever taken while holding `ENGINE_LOCK`
+        self._lock = threading.Lock()
+
+    def _compute_next(self) -> bool:
+        if self._pending is None:
+            # fully expanded, no need to wait for the engine
+            return False
+        with ENGINE_LOCK, self._lock:
+            if self._pending is None:
+                return False
+            action = next(self._pending, None)
+            if action is None:
+                self._pending = None
+                return False
+            self._computed.append(action)
+            return True
+
+    def __iter__(self) -> Iterator[ds.PlayerAction]:
+        i = 0
+        while i < len(self._computed) or self._compute_next():
+            yield self._computed[i]
+            i += 1
+
+    def all(self) -> list[ds.PlayerAction]:
+        for _ in self:
+            pass
+        return list(self._computed)
+
+
+class ActionCache:
+    """
+    Keeps the actions of the `max_states` most recently used states.
+
+    States are compared by value, so equal states reached in different ways
+    share their actions.
+    """
+
+    def __init__(self, max_states: int = 4096) -> None:
+        self._max_states = max_states
+        self._lists: OrderedDict[tuple[ds.Pid, ds.GameState], ActionList] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, game_state: ds.GameState, pid: ds.Pid) -> ActionList:
+        key = (pid, game_state)
+        with self._lock:
+            actions = self._lists.get(key)
+            if actions is not None:
+                self._hits += 1
+                self._lists.move_to_end(key)
+                return actions
+            self._misses += 1
+            actions = self._lists[key] = ActionList(game_state, pid)
+            if len(self._lists) > self._max_states:
+                self._lists.popitem(last=False)
+            return actions
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return self._hits / lookups if lookups else 0.0
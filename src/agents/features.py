@@ -0,0 +1,220 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import zlib
+from typing import Iterable, Protocol
+
+import dgisim as ds
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, see `require_numpy()`
+    np = None
+
+__all__ = [
+    "FEATURE_SIZE",
+    "BatchEvaluator",
+    "LinearEvaluator",
+    "MLPEvaluator",
+    "default_evaluator",
+    "encode",
+    "encode_batch",
+    "require_numpy",
+]
+
+_MAX_CHARACTERS = 3
+_AURA_ELEMENTS = (ds.Element.PYRO, ds.Element.HYDRO, ds.Element.ELECTRO, ds.Element.CRYO, ds.Element.DENDRO)
+_DICE_ELEMENTS = (
+    ds.Element.OMNI, ds.Element.PYRO, ds.Element.HYDRO, ds.Element.ANEMO,
+    ds.Element.ELECTRO, ds.Element.DENDRO, ds.Element.CRYO, ds.Element.GEO,
+)
+#: Hand cards are counted into this many buckets by a stable hash of their name.
+_CARD_BUCKETS = 16
+
+# hp, hp ratio, energy ratio, alive, active, aura..., number of statuses
+_CHARACTER_SIZE = 6 + len(_AURA_ELEMENTS)
+# characters, dice, hand buckets + hand size, deck size, summons + their usages,
+# supports, combat statuses
+_PLAYER_SIZE = (
+    _MAX_CHARACTERS * _CHARACTER_SIZE + len(_DICE_ELEMENTS) + _CARD_BUCKETS + 1 + 1 + 2 + 1 + 1
+)
+#: round, whether the perspective player is to act, then the perspective
+#: player's features followed by the opponent's
+FEATURE_SIZE = 2 + 2 * _PLAYER_SIZE
+
+#: logits are clipped to this before the sigmoid
+_MAX_LOGIT = 40.0
+
+
+def require_numpy() -> None:
+    """
+    Raises `ImportError` if NumPy, which the features need, is missing.
+    """
+    if np is None:
+        raise ImportError("Feature encoding needs NumPy, install it with `pip install numpy`")
+
+
+def _card_bucket(card: type) -> int:
+    return zlib.crc32(card.__name__.encode()) % _CARD_BUCKETS
+
+
+def _player_features(player: ds.PlayerState, secret: bool) -> list[float]:
+    features: list[float] = []
+    chars = player.characters.get_characters()
+    active_id = player.characters.get_active_character_id()
+    for char in chars[:_MAX_CHARACTERS]:
+        aura = char.elemental_aura
+        # the engine marks some defeated characters with a large negative hp
+        hp = max(0, char.hp)
+        features += (
+            hp,
+            hp / char.max_hp,
+            char.energy / char.max_energy if char.max_energy else 0.0,
+            float(char.is_alive()),
+            float(char.id == active_id),
+            *(float(aura.contains(elem)) for elem in _AURA_ELEMENTS),
+            len(char.character_statuses),
+        )
+    features += [0.0] * (_CHARACTER_SIZE * (_MAX_CHARACTERS - len(chars)))
+    dice = player.dice
+    features += (dice[elem] for elem in _DICE_ELEMENTS)
+    buckets = [0.0] * _CARD_BUCKETS
+    if not secret:
+        for card, count in player.hand_cards.to_dict().items():
+            buckets[_card_bucket(card)] += count
+    features += buckets
+    features.append(player.hand_cards.num_cards())
+    features.append(player.deck_cards.num_cards())
+    summons = tuple(player.summons)
+    features.append(len(summons))
+    features.append(sum(getattr(summon, "usages", 0) for summon in summons))
+    features.append(len(tuple(player.supports)))
+    features.append(len(tuple(player.combat_statuses)))
+    return features
+
+
+def _features(game_state: ds.GameState, pid: ds.Pid) -> list[float]:
+    return [
+        game_state.round,
+        float(game_state.waiting_for() is pid),
+        *_player_features(game_state.get_player(pid), secret=False),
+        *_player_features(game_state.get_player(pid.other()), secret=True),
+    ]
+
+
+def encode(game_state: ds.GameState, pid: ds.Pid) -> np.ndarray:
+    """
+    :returns: the `FEATURE_SIZE` features of `game_state` as seen by `pid`,
+              the opponent's hand only counting towards its size.
+    """
+    require_numpy()
+    return np.asarray(_features(game_state, pid), dtype=np.float32)
+
+
+def encode_batch(game_states: Iterable[ds.GameState], pid: ds.Pid) -> np.ndarray:
+    """
+    :returns: a (number of states, `FEATURE_SIZE`) array.
+    """
+    require_numpy()
+    rows = [_features(game_state, pid) for game_state in game_states]
+    if not rows:
+        return np.empty((0, FEATURE_SIZE), dtype=np.float32)
+    return np.asarray(rows, dtype=np.float32)
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    # the result hardly changes beyond this, and exp() can't overflow
+    x = np.clip(x, -_MAX_LOGIT, _MAX_LOGIT)
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+class BatchEvaluator(Protocol):
+    def evaluate(self, features: np.ndarray) -> np.ndarray:
+        """
+        :param features: a (n, `FEATURE_SIZE`) array from `encode_batch()`.
+        :returns: n values from 0 (lost) to 1 (won) for the encoding player.
+        """
+        ...
+
+
+class LinearEvaluator:
+    def __init__(self, weights: np.ndarray, bias: float = 0.0) -> None:
+        require_numpy()
+        self.weights = np.asarray(weights, dtype=np.float32).reshape(FEATURE_SIZE)
+        self.bias = float(bias)
+
+    def evaluate(self, features: np.ndarray) -> np.ndarray:
+        return _sigmoid(features @ self.weights + self.bias)
+
+    def save(self, path: str) -> None:
+        np.savez(path, weights=self.weights, bias=np.float32(self.bias))
+
+    @classmethod
+    def load(cls, path: str) -> LinearEvaluator:
+        require_numpy()
+        with np.load(path) as data:
+            return cls(data["weights"], float(data["bias"]))
+
+
+class MLPEvaluator:
+    """
+    Fully connected layers with ReLU in between and a sigmoid on the single
+    output.
+    """
+
+    def __init__(self, layers: list[tuple[np.ndarray, np.ndarray]]) -> None:
+        require_numpy()
+        assert layers and layers[0][0].shape[0] == FEATURE_SIZE and layers[-1][0].shape[1] == 1
+        self.layers = [
+            (np.asarray(w, dtype=np.float32), np.asarray(b, dtype=np.float32))
+            for w, b in layers
+        ]
+
+    def evaluate(self, features: np.ndarray) -> np.ndarray:
+        x = features
+        for i, (w, b) in enumerate(self.layers):
+            x = x @ w + b
+            if i < len(self.layers) - 1:
+                np.maximum(x, 0.0, out=x)
+        return _sigmoid(x[:, 0])
+
+    def save(self, path: str) -> None:
+        np.savez(path, **{
+            f"{name}{i}": array
+            for i, (w, b) in enumerate(self.layers)
+            for name, array in (("w", w), ("b", b))
+        })
+
+    @classmethod
+    def load(cls, path: str) -> MLPEvaluator:
+        require_numpy()
+        with np.load(path) as data:
+            return cls([(data[f"w{i}"], data[f"b{i}"]) for i in range(len(data.files) // 2)])
+
+
+def default_evaluator() -> LinearEvaluator:
+    """
+    An untrained evaluator valuing the hp of living characters on each side,
+    close to `rollout.evaluate()`.
+    """
+    require_numpy()
+    weights = np.zeros(FEATURE_SIZE, dtype=np.float32)
+    for side, sign in ((0, 1.0), (1, -1.0)):
+        for char in range(_MAX_CHARACTERS):
+            # the hp ratio of each character
+            weights[2 + side * _PLAYER_SIZE + char * _CHARACTER_SIZE + 1] = sign * 2.0
+    return LinearEvaluator(weights)
@@ -0,0 +1,265 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import math
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+
+import dgisim as ds
+from dgisim import agents as dsa
+
+from ..engine import ENGINE_LOCK, new_seed
+from ..log import get_logger
+from .actions import ActionCache
+from .rollout import rollout, rollout_executor, rollout_workers
+from .transposition import TableEntry, TranspositionTable
+
+__all__ = [
+    "MCTSAgent",
+]
+
+_logger = get_logger(__name__)
+
+
+@dataclass(eq=False)
+class _Node:
+    state: ds.GameState
+    parent: _Node | None = None
+    #: the action taken at the parent's state that led to this node
+    action: ds.PlayerAction | None = None
+    #: sampled actions not yet expanded, None until the node is first selected
+    untried: list[ds.PlayerAction] | None = None
+    children: list[_Node] = field(default_factory=list)
+    #: includes rollouts still running, so parallel selections spread out
+    visits: int = 0
+    #: number of finished rollouts through this node
+    results: int = 0
+    #: sum of the finished rollouts' values for the searching player
+    value: float = 0.0
+    #: statistics of the position shared with other nodes reaching it
+    entry: TableEntry | None = None
+
+    def mean(self) -> float:
+        return self.value / self.results if self.results else 0.5
+
+
+class MCTSAgent(ds.PlayerAgent):
+    """
+    Picks actions by Monte Carlo tree search, returning the best action found
+    when `time_budget` seconds are up.
+
+    Each node expands into at most `num_candidates` distinct actions sampled
+    from all actions of its state (see `ActionCache`).
+    Rollouts play `rollout_depth` random actions and are run on the shared
+    process pool (see `rollout_executor()`).
+
+    Positions are valued by `table`, which persists across moves, so an agent
+    should stick to one player of one match.
+    """
+
+    #: engine calls are locked one by one, so others can step during a search
+    locks_engine = True
+
+    def __init__(
+            self,
+            time_budget: float = 0.5,
+            num_candidates: int = 8,
+            rollout_depth: int = 8,
+            exploration: float = 1.4,
+            table: TranspositionTable | None = None,
+            actions: ActionCache | None = None,
+    ) -> None:
+        self._time_budget = time_budget
+        self._num_candidates = num_candidates
+        self._rollout_depth = rollout_depth
+        self._exploration = exploration
+        self._random_agent = dsa.RandomAgent()
+        self._table = TranspositionTable() if table is None else table
+        self._actions = ActionCache() if actions is None else actions
+
+    @property
+    def table(self) -> TranspositionTable:
+        return self._table
+
+    def choose_action(self, history: list[ds.GameState], pid: ds.Pid) -> ds.PlayerAction:
+        deadline = time.perf_counter() + self._time_budget
+        rng = random.Random(new_seed())
+        root = _Node(history[-1])
+        root.entry = self._table.lookup(self._table.key(root.state, pid))
+        root.untried = self._sample_actions(root.state, pid, rng)
+        if len(root.untried) <= 1:
+            return root.untried[0] if root.untried else self._random_agent.choose_action(history, pid)
+
+        executor = rollout_executor()
+        # enough to keep every process busy while results are backpropagated
+        max_in_flight = 2 * max(1, rollout_workers())
+        in_flight: dict[Future[float], _Node] = {}
+        num_rollouts = 0
+        while time.perf_counter() < deadline:
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(
+                    in_flight,
+                    timeout=deadline - time.perf_counter(),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    self._backpropagate(in_flight.pop(future), future, pid)
+                continue
+            leaf = self._select(root, pid, rng)
+            node: _Node | None = leaf
+            while node is not None:
+                node.visits += 1
+                node = node.parent
+            seed = rng.getrandbits(32)
+            num_rollouts += 1
+            if executor is None:
+                future = Future()
+                future.set_result(rollout(leaf.state, pid, self._rollout_depth, seed))
+                self._backpropagate(leaf, future, pid)
+            else:
+                in_flight[executor.submit(
+                    rollout, leaf.state, pid, self._rollout_depth, seed
+                )] = leaf
+        for future, leaf in in_flight.items():
+            if not future.cancel() and future.done():
+                self._backpropagate(leaf, future, pid)
+
+        _logger.debug(
+            "%d rollouts over %d candidates, %d positions with %.0f%% hit rate",
+            num_rollouts, len(root.children), len(self._table), 100 * self._table.hit_rate(),
+            extra={"pid": pid},
+        )
+        if not root.children:
+            return root.untried[0]
+        best = max(root.children, key=lambda child: (child.results, child.mean()))
+        assert best.action is not None
+        return best.action
+
+    def _sample_actions(
+            self,
+            game_state: ds.GameState,
+            pid: ds.Pid,
+            rng: random.Random,
+    ) -> list[ds.PlayerAction]:
+        try:
+            actions = self._actions.get(game_state, pid).all()
+        except Exception:
+            _logger.debug("Cannot enumerate actions, sampling instead", exc_info=True)
+            return self._sample_random_actions(game_state, pid, rng)
+        if len(actions) <= self._num_candidates:
+            return actions
+        return rng.sample(actions, self._num_candidates)
+
+    def _sample_random_actions(
+            self,
+            game_state: ds.GameState,
+            pid: ds.Pid,
+            rng: random.Random,
+    ) -> list[ds.PlayerAction]:
+        actions: list[ds.PlayerAction] = []
+        with ENGINE_LOCK:
+            random.seed(rng.getrandbits(32))
+            for _ in range(2 * self._num_candidates):
+                try:
+                    action = self._random_agent.choose_action([game_state], pid)
+                except Exception:
+                    # the random agent doesn't cover every phase
+                    break
+                if action not in actions:
+                    actions.append(action)
+                    if len(actions) == self._num_candidates:
+                        break
+        return actions
+
+    def _select(self, root: _Node, pid: ds.Pid, rng: random.Random) -> _Node:
+        """
+        Walks down by UCT and expands one untried action.
+        """
+        node = root
+        while True:
+            waiting_for = node.state.waiting_for()
+            if waiting_for is None or node.state.game_end():
+                return node
+            if node.untried is None:
+                node.untried = self._sample_actions(node.state, waiting_for, rng)
+            if node.untried:
+                action = node.untried.pop()
+                child_state = self._advance(node.state, waiting_for, action, rng)
+                if child_state is None:
+                    continue
+                child = _Node(
+                    child_state,
+                    parent=node,
+                    action=action,
+                    entry=self._table.lookup(self._table.key(child_state, pid)),
+                )
+                node.children.append(child)
+                return child
+            if not node.children:
+                return node
+            node = self._best_child(node, waiting_for, root)
+
+    def _best_child(self, node: _Node, waiting_for: ds.Pid, root: _Node) -> _Node:
+        # values are for the searching player, who moves at the root
+        sign = 1.0 if waiting_for is root.state.waiting_for() else -1.0
+        log_visits = math.log(max(1, node.visits))
+
+        def uct(child: _Node) -> float:
+            if child.visits == 0:
+                return math.inf
+            mean = child.mean() if child.entry is None else child.entry.mean()
+            exploit = mean if sign > 0 else 1.0 - mean
+            return exploit + self._exploration * math.sqrt(log_visits / child.visits)
+
+        return max(node.children, key=uct)
+
+    def _advance(
+            self,
+            game_state: ds.GameState,
+            pid: ds.Pid,
+            action: ds.PlayerAction,
+            rng: random.Random,
+    ) -> ds.GameState | None:
+        """
+        :returns: the next state after `action` that needs a decision (or ends
+                  the game), None if `action` turns out to be invalid.
+        """
+        with ENGINE_LOCK:
+            try:
+                next_state = game_state.action_step(pid, action, seed=rng.random())
+                assert next_state is not None
+                while next_state.waiting_for() is None and not next_state.game_end():
+                    next_state = next_state.step(seed=rng.random())
+            except Exception:
+                return None
+        return next_state
+
+    def _backpropagate(self, leaf: _Node, future: Future[float], pid: ds.Pid) -> None:
+        try:
+            value = future.result()
+        except Exception:
+            _logger.warning("Rollout failed", exc_info=True, extra={"pid": pid})
+            value = 0.5
+        node: _Node | None = leaf
+        while node is not None:
+            node.results += 1
+            node.value += value
+            if node.entry is not None:
+                self._table.add_result(node.entry, value)
+            node = node.parent
@@ -0,0 +1,375 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import struct
+import threading
+import zlib
+from collections import Counter
+
+import dgisim as ds
+from dgisim import agents as dsa
+
+from ..engine import ENGINE_LOCK, choose_action
+from ..log import get_logger
+
+__all__ = [
+    "DEFAULT_MIN_VOTES",
+    "BookAgent",
+    "OpeningBook",
+    "book_key",
+    "build",
+    "default_book",
+    "with_opening_book",
+]
+
+_logger = get_logger(__name__)
+
+#: Path of the book `default_book()` loads, if set.
+BOOK_ENV_VAR = "DGISIM_OPENING_BOOK"
+
+_MAGIC = b"DGOB"
+_VERSION = 3
+_LENGTH = struct.Struct("<H")
+#: times a kind of card or die was redrawn or rerolled, and times it was kept
+_VOTES = struct.Struct("<HH")
+#: first byte of a stored value
+_ACTION = b"A"
+_CHOICE = b"C"
+
+
+def _names(items: object) -> str:
+    return ",".join(type(item).__name__ for item in items)
+
+
+def book_key(game_state: ds.GameState, pid: ds.Pid) -> str | None:
+    """
+    :returns: the signature of the decision `pid` faces at `game_state` if it
+              is an opening one (card redraw, starting character or the first
+              reroll), None otherwise.
+
+    The starting character is keyed by the two lineups. Redraws and rerolls
+    are keyed by the phase alone, as their cards and dice are decided one kind
+    at a time, see `_items()`.
+    """
+    mode = game_state.mode
+    phase = game_state.phase
+    if isinstance(phase, mode.starting_hand_select_phase):
+        return "|".join((
+            type(phase).__name__,
+            _names(game_state.get_player(pid).characters.get_characters()),
+            _names(game_state.get_player(pid.other()).characters.get_characters()),
+        ))
+    if isinstance(phase, mode.card_select_phase) or (
+            isinstance(phase, mode.roll_phase) and game_state.round <= 1
+    ):
+        return type(phase).__name__
+    return None
+
+
+def _die_kind(element: ds.Element, player: ds.PlayerState) -> str:
+    """
+    :returns: what a die of `element` is to `player`, which is what rerolls
+              are decided by, as the elements themselves vary with the lineup.
+    """
+    if element is ds.Element.OMNI:
+        return "omni"
+    active = player.characters.get_active_character()
+    if active is not None and element is active.ELEMENT:
+        return "active"
+    if any(element is char.ELEMENT for char in player.characters.get_characters()):
+        return "lineup"
+    return "other"
+
+
+def _items(game_state: ds.GameState, pid: ds.Pid, key: str) -> dict[str, dict]:
+    """
+    :returns: the cards in hand at a redraw, or the dice at a reroll, grouped
+              by their choice key, each group as counts by card or element.
+    """
+    mode = game_state.mode
+    player = game_state.get_player(pid)
+    items: dict[str, dict] = {}
+    if isinstance(game_state.phase, mode.card_select_phase):
+        for card, count in player.hand_cards.to_dict().items():
+            if count:
+                items.setdefault(f"{key}|{card.__name__}", {})[card] = count
+    elif isinstance(game_state.phase, mode.roll_phase):
+        for element, count in player.dice.to_dict().items():
+            if count:
+                items.setdefault(f"{key}|{_die_kind(element, player)}", {})[element] = count
+    return items
+
+
+def _selected(action: ds.PlayerAction) -> dict:
+    if isinstance(action, ds.CardsSelectAction):
+        return action.selected_cards.to_dict()
+    if isinstance(action, ds.DiceSelectAction):
+        return action.selected_dice.to_dict()
+    # e.g. `EndRoundAction` keeps everything
+    return {}
+
+
+#: decisions on a kind of card or die a book needs before it plays them
+DEFAULT_MIN_VOTES = 3
+
+
+class OpeningBook:
+    """
+    Precomputed opening decisions: actions keyed by `book_key()` for the
+    starting character, and for redraws and rerolls how often each kind of
+    card or die was redrawn or rerolled and how often kept, so that books
+    cover random hands. A kind is redrawn or rerolled if it mostly was, once
+    it has been decided on `min_votes` times.
+    """
+
+    def __init__(
+            self,
+            entries: dict[str, ds.PlayerAction] | None = None,
+            choices: dict[str, tuple[int, int]] | None = None,
+            min_votes: int = DEFAULT_MIN_VOTES,
+    ) -> None:
+        self._entries = {} if entries is None else dict(entries)
+        self._choices = {} if choices is None else dict(choices)
+        self._min_votes = min_votes
+
+    def get(self, game_state: ds.GameState, pid: ds.Pid) -> ds.PlayerAction | None:
+        key = book_key(game_state, pid)
+        if key is None:
+            return None
+        items = _items(game_state, pid, key)
+        if not items:
+            return self._entries.get(key)
+        if any(sum(self._choices.get(item_key, (0, 0))) < self._min_votes for item_key in items):
+            return None
+        selected = {}
+        for item_key, counts in items.items():
+            chosen, kept = self._choices[item_key]
+            if chosen > kept:
+                selected.update(counts)
+        if isinstance(game_state.phase, game_state.mode.card_select_phase):
+            return ds.CardsSelectAction(selected_cards=ds.Cards(selected))
+        return ds.DiceSelectAction(selected_dice=ds.ActualDice(selected))
+
+    def learn(self, game_state: ds.GameState, pid: ds.Pid, action: ds.PlayerAction) -> int:
+        """
+        Records the choices `action` makes at the opening decision of `pid` at
+        `game_state`: the action if the book doesn't have the position yet,
+        or a vote on each kind of card or die at a redraw or reroll.
+
+        :returns: the number of entries added.
+        """
+        key = book_key(game_state, pid)
+        if key is None:
+            return 0
+        items = _items(game_state, pid, key)
+        if not items:
+            if key in self._entries:
+                return 0
+            self._entries[key] = action
+            return 1
+        selected = _selected(action)
+        added = 0
+        for item_key, counts in items.items():
+            if item_key not in self._choices:
+                added += 1
+            votes_chosen, votes_kept = self._choices.get(item_key, (0, 0))
+            # a kind counts as redrawn or rerolled if most of it was
+            chosen = sum(min(selected.get(item, 0), count) for item, count in counts.items())
+            if 2 * chosen > sum(counts.values()):
+                votes_chosen = min(votes_chosen + 1, 0xFFFF)
+            else:
+                votes_kept = min(votes_kept + 1, 0xFFFF)
+            self._choices[item_key] = (votes_chosen, votes_kept)
+        return added
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._choices)
+
+    def save(self, path: str) -> None:
+        from ..match_codec import encode_action
+
+        body = bytearray()
+        records = [
+            *((key, _ACTION + encode_action(action)) for key, action in self._entries.items()),
+            *((key, _CHOICE + _VOTES.pack(*votes)) for key, votes in self._choices.items()),
+        ]
+        for key, value in records:
+            for data in (key.encode(), value):
+                body += _LENGTH.pack(len(data))
+                body += data
+        version = ds.__version__.encode()
+        with open(path, "wb") as f:
+            f.write(_MAGIC + bytes((_VERSION, len(version))) + version)
+            f.write(zlib.compress(bytes(body), 9))
+
+    @classmethod
+    def load(cls, path: str) -> OpeningBook:
+        """
+        Raises `ValueError` if the file is not a book for this dgisim version.
+        """
+        from ..match_codec import decode_action
+
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(_MAGIC) or data[len(_MAGIC)] != _VERSION:
+            raise ValueError(f"{path} is not an opening book")
+        version_end = len(_MAGIC) + 2 + data[len(_MAGIC) + 1]
+        version = data[len(_MAGIC) + 2:version_end].decode()
+        if version != ds.__version__:
+            raise ValueError(f"{path} was built with dgisim {version}, running {ds.__version__}")
+        body = zlib.decompress(data[version_end:])
+        fields = []
+        pos = 0
+        while pos < len(body):
+            (size,) = _LENGTH.unpack_from(body, pos)
+            pos += _LENGTH.size
+            fields.append(body[pos:pos + size])
+            pos += size
+        book = cls()
+        for key, value in zip(fields[::2], fields[1::2]):
+            if value[:1] == _ACTION:
+                book._entries[key.decode()] = decode_action(value[1:])
+            elif value[:1] == _CHOICE and len(value) == 1 + _VOTES.size:
+                book._choices[key.decode()] = _VOTES.unpack_from(value, 1)
+            else:
+                raise ValueError(f"{path} has a corrupted entry")
+        return book
+
+
+class BookAgent(ds.PlayerAgent):
+    """
+    Plays from `book` when it has the position, otherwise asks `fallback`.
+    """
+
+    def __init__(self, fallback: ds.PlayerAgent, book: OpeningBook) -> None:
+        self.fallback = fallback
+        self.book = book
+        self.locks_engine = getattr(fallback, "locks_engine", False)
+
+    def choose_action(self, history: list[ds.GameState], pid: ds.Pid) -> ds.PlayerAction:
+        action = self.book.get(history[-1], pid)
+        if action is not None:
+            return action
+        return self.fallback.choose_action(history, pid)
+
+
+_default_book: OpeningBook | None = None
+_default_book_loaded = False
+_default_book_lock = threading.Lock()
+
+
+def default_book() -> OpeningBook | None:
+    """
+    :returns: the book at the path in `DGISIM_OPENING_BOOK`, loaded once, or
+              None if unset or unreadable.
+    """
+    global _default_book, _default_book_loaded
+    with _default_book_lock:
+        if not _default_book_loaded:
+            _default_book_loaded = True
+            path = os.environ.get(BOOK_ENV_VAR)
+            if path:
+                try:
+                    _default_book = OpeningBook.load(path)
+                    _logger.info("Loaded %d opening book entries from %s", len(_default_book), path)
+                except (OSError, ValueError):
+                    _logger.warning("Cannot load opening book %s", path, exc_info=True)
+        return _default_book
+
+
+def with_opening_book(agent: ds.PlayerAgent) -> ds.PlayerAgent:
+    book = default_book()
+    return agent if book is None else BookAgent(agent, book)
+
+
+def build(
+        num_games: int,
+        agent: ds.PlayerAgent,
+        seed: int = 0,
+        book: OpeningBook | None = None,
+        stats: Counter[str] | None = None,
+) -> OpeningBook:
+    """
+    Walks the openings of `num_games` random games and lets `agent` decide
+    every opening position the book can't play yet, see `OpeningBook.get()`.
+
+    :param stats: counts, by phase, the positions walked ("positions:<phase>")
+                  and those the book already had ("hits:<phase>"), and the
+                  entries added ("added").
+    """
+    from ..game_data import Match
+
+    book = OpeningBook() if book is None else book
+    seeds = random.Random(seed)
+    stats = Counter() if stats is None else stats
+    walker = dsa.RandomAgent()
+    for _ in range(num_games):
+        match = Match(seed=seeds.getrandbits(32))
+        while True:
+            state = match.latest_state()
+            pid = state.waiting_for()
+            if pid is None or state.game_end():
+                break
+            key = book_key(state, pid)
+            if key is None:
+                break
+            phase = type(state.phase).__name__
+            stats[f"positions:{phase}"] += 1
+            if book.get(state, pid) is not None:
+                stats[f"hits:{phase}"] += 1
+            else:
+                stats["added"] += book.learn(state, pid, choose_action(agent, [state], pid))
+            # walk on randomly, so the book covers the positions others reach
+            with ENGINE_LOCK:
+                random.seed(seeds.getrandbits(32))
+                action = walker.choose_action([state], pid)
+            match.apply_action(pid, action)
+    _logger.info(
+        "%d entries added, %d of %d positions already in the book",
+        stats["added"],
+        sum(v for k, v in stats.items() if k.startswith("hits:")),
+        sum(v for k, v in stats.items() if k.startswith("positions:")),
+    )
+    return book
+
+
+def _main(argv: list[str] | None = None) -> None:
+    from .mcts import MCTSAgent
+
+    parser = argparse.ArgumentParser(description="Builds an opening book with the MCTS agent.")
+    parser.add_argument("path", help="book file, extended if it exists")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--time-budget", type=float, default=2.0, help="search seconds per position")
+    args = parser.parse_args(argv)
+    book = OpeningBook.load(args.path) if os.path.exists(args.path) else None
+    stats: Counter[str] = Counter()
+    book = build(args.games, MCTSAgent(time_budget=args.time_budget), seed=args.seed, book=book, stats=stats)
+    book.save(args.path)
+    print(f"{len(book)} entries in {args.path}")
+    for name, positions in sorted(stats.items()):
+        if name.startswith("positions:"):
+            phase = name.split(":", 1)[1]
+            hits = stats[f"hits:{phase}"]
+            print(f"{phase}: {hits}/{positions} positions already in the book ({hits / positions:.0%})")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,132 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+import dgisim as ds
+from dgisim import agents as dsa
+
+from ..engine import ENGINE_LOCK
+from ..log import get_logger
+
+__all__ = [
+    "evaluate",
+    "rollout",
+    "rollout_executor",
+    "rollout_workers",
+    "set_rollout_workers",
+]
+
+_logger = get_logger(__name__)
+
+
+def evaluate(game_state: ds.GameState, pid: ds.Pid) -> float:
+    """
+    :returns: how good `game_state` is for `pid`, from 0 (lost) to 1 (won),
+              judged by the share of hp left on each side.
+    """
+    if game_state.game_end():
+        winner = game_state.get_winner()
+        if winner is None:
+            return 0.5
+        return 1.0 if winner is pid else 0.0
+
+    def hp_ratio(player: ds.PlayerState) -> float:
+        chars = player.characters.get_characters()
+        max_hp = sum(char.max_hp for char in chars)
+        return sum(char.hp for char in chars if char.is_alive()) / max_hp
+
+    return 0.5 + 0.5 * (
+        hp_ratio(game_state.get_player(pid)) - hp_ratio(game_state.get_player(pid.other()))
+    )
+
+
+def rollout(game_state: ds.GameState, pid: ds.Pid, depth: int, seed: int) -> float:
+    """
+    Plays `depth` random actions from `game_state` and evaluates the result
+    for `pid`.
+
+    This runs in the rollout processes, or in-process when there are none.
+    """
+    agent = dsa.RandomAgent()
+    with ENGINE_LOCK:
+        random.seed(seed)
+        try:
+            while depth > 0 and not game_state.game_end():
+                waiting_for = game_state.waiting_for()
+                if waiting_for is None:
+                    game_state = game_state.step()
+                else:
+                    action = agent.choose_action([game_state], waiting_for)
+                    game_state = game_state.action_step(waiting_for, action)
+                    depth -= 1
+        except Exception:
+            # dgisim occasionally rejects its own random actions, count it as even
+            return 0.5
+    return evaluate(game_state, pid)
+
+
+_executor: Executor | None = None
+_executor_lock = threading.Lock()
+_num_workers: int | None = None
+#: the number of processes of `_executor`
+_executor_workers = 0
+
+
+def set_rollout_workers(num_workers: int) -> None:
+    """
+    Sets the number of rollout processes, 0 to run rollouts in-process.
+    Only takes effect before the pool is first used.
+    """
+    global _num_workers
+    _num_workers = num_workers
+
+
+def rollout_executor() -> Executor | None:
+    """
+    :returns: the process pool shared by all search agents, or None if there
+              is only one core, in which case rollouts are run in-process.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None:
+            num_workers = _num_workers
+            if num_workers is None:
+                num_workers = (os.cpu_count() or 1) - 1
+            if num_workers < 1:
+                return None
+            _logger.info("Starting %d rollout processes", num_workers)
+            # forking could copy ENGINE_LOCK while another thread holds it
+            _executor = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _executor_workers = num_workers
+        return _executor
+
+
+def rollout_workers() -> int:
+    """
+    :returns: the number of processes of `rollout_executor()`, 0 if rollouts
+              are run in-process.
+    """
+    rollout_executor()
+    return _executor_workers
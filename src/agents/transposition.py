@@ -0,0 +1,91 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import dgisim as ds
+
+__all__ = [
+    "TableEntry",
+    "TranspositionTable",
+]
+
+
+@dataclass
+class TableEntry:
+    results: int = 0
+    #: sum of the results' values for the searching player
+    value: float = 0.0
+
+    def mean(self) -> float:
+        return self.value / self.results if self.results else 0.5
+
+
+class TranspositionTable:
+    """
+    Search statistics shared by all nodes reaching the same position, e.g.
+    through tuning then playing a card or the other way round.
+
+    Keeps the `capacity` most recently used positions and is safe to share
+    between threads.
+    """
+
+    def __init__(self, capacity: int = 100_000) -> None:
+        self._capacity = capacity
+        self._entries: OrderedDict[int, TableEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(game_state: ds.GameState, pid: ds.Pid) -> int:
+        """
+        :returns: the key of `game_state` as seen by `pid`, so positions that
+                  only differ in the opponent's secrets share an entry.
+        """
+        return hash((pid, game_state.prespective_view(pid)))
+
+    def lookup(self, key: int) -> TableEntry:
+        """
+        :returns: the entry of `key`, which is added if missing.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                entry = self._entries[key] = TableEntry()
+                if len(self._entries) > self._capacity:
+                    self._entries.popitem(last=False)
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def add_result(self, entry: TableEntry, value: float) -> None:
+        with self._lock:
+            entry.results += 1
+            entry.value += value
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return self._hits / lookups if lookups else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -23,22 +23,29 @@ from qlet import QItem, QAlign, QAnchor
 
 from .components.navigation_bar import NavBar
 from .context import AppContext, Orientation, Size
+from .game_data import GameServices
+from .log import get_logger
 from .pages.base import QPage
 from .pages.deck_page import DeckPage
 from .pages.game.play_page import GamePlayPage
 from .pages.game_page import GamePage
 from .pages.not_found_page import NotFoundPage
 from .routes import Route
+from .timing import recorder
+
+_logger = get_logger(__name__)
 
 
 class DgisimApp():
-    def __init__(self, page: ft.Page):
-        print("app version 1.0.11")
+    @recorder.span("DgisimApp.__init__")
+    def __init__(self, page: ft.Page, services: GameServices | None = None):
+        _logger.info("app version 1.0.11")
         self._context = AppContext(
             current_route=Route.GAME,
             orientation=Orientation.PORTRAIT,
             page=page,
             reference_size=Size(page.width, page.height),
+            services=services,
         )
         self._context.on_orientation_changed_end.add(lambda _: page.update())
         self._page = page
@@ -61,6 +68,12 @@ class DgisimApp():
 
         self._context.on_current_route_changed.add(on_context_route_changed)
         self._context.on_reference_size_changed_end.add(lambda _: self._page.update())
+        # home page is rendered by now, so warming up the engine won't delay it
+        self._context.game_data.prewarm()
+
+    @property
+    def context(self) -> AppContext:
+        return self._context
 
     def on_resize(self, _: ft.Page) -> None:
         wh_ratio = self._page.width / self._page.height
@@ -70,6 +83,7 @@ class DgisimApp():
             self._context.orientation = Orientation.LANDSCAPE
         self._context.reference_size = Size(self._page.width, self._page.height)
 
+    @recorder.first_span("first navigate")
     def navigate(self, route: Route) -> None:
         if self._loaded_qpage is not None:
             self._loaded_qpage.pre_removal()
@@ -77,14 +91,16 @@ class DgisimApp():
         self._root_item.add_children(page := self._get_page_at_route(route)(
             anchor=QAnchor(left=0.0, top=0.0, right=1.0, bottom=1.0),
         ))
-        page.post_init(self._context)
+        with recorder.span(f"{type(page).__name__}.post_init"):
+            page.post_init(self._context)
         self._loaded_qpage = page
-        self._page.update()
+        with recorder.first_span("first page.update"):
+            self._page.update()
 
     def _get_page_at_route(self, route: Route) -> type[QPage]:
         if route in self._pages:
-            print("get page at", route)
+            _logger.debug("get page at %s", route)
             return self._pages[route]
         assert Route.NOT_FOUND in self._pages
-        print("get page not found")
+        _logger.debug("get page not found")
         return self._pages[Route.NOT_FOUND]
@@ -23,9 +23,12 @@ from typing import Any, Callable, Literal
 import flet as ft
 from dgisim import Pid
 
-from .game_data import GameData, PlayerSettings, GamePlaySettings
+from .game_data import GameData, GameServices, PlayerSettings, GamePlaySettings
+from .log import get_logger
 from .routes import Route
 
+_logger = get_logger(__name__)
+
 
 class AddSensitiveSet(set):
     def __init__(self, on_added: Callable[[Callable], Any], *args, **kwargs) -> None:
@@ -83,9 +86,15 @@ class AppContext:
             page: ft.Page,
             reference_size: Size,
             settings: Settings = Settings(),
+            services: GameServices | None = None,
     ) -> None:
         self._current_route = current_route
-        self._game_data = GameData()
+        self._game_data = GameData(
+            session_id=page.session_id,
+            services=services,
+            # seats of remote matches are retaken after the page is reloaded
+            seat_tokens=page.client_storage,
+        )
         self._on_curr_route_changed: set[Callable[[Route], None]] = AddSensitiveSet(
             lambda f: f(self._current_route)
         )
@@ -144,7 +153,7 @@ class AppContext:
         if self._orientation is new_orientation:
             return
         self._orientation = new_orientation
-        print("Orientation:", new_orientation.value)
+        _logger.debug("Orientation: %s", new_orientation.value)
         for f in self._on_orientation_changed:
             f(new_orientation)
         for f in self._on_orientation_changed_end:
@@ -0,0 +1,108 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import io
+import pickle
+import random
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+import dgisim as ds
+
+__all__ = [
+    "ENGINE_LOCK",
+    "THREADS_AVAILABLE",
+    "choose_action",
+    "load_engine_pickle",
+    "new_seed",
+    "seeded_engine",
+]
+
+#: dgisim draws randomness from the global `random` module, so seeded engine
+#: steps are only reproducible if no other thread touches it in between.
+ENGINE_LOCK = threading.RLock()
+
+#: False in web builds, where Pyodide can't start threads, so background work
+#: is skipped or done in place there.
+THREADS_AVAILABLE = sys.platform != "emscripten"
+
+_SEED_SOURCE = random.SystemRandom()
+
+
+def new_seed() -> int:
+    return _SEED_SOURCE.getrandbits(32)
+
+
+@contextmanager
+def seeded_engine(seed: int) -> Iterator[None]:
+    """
+    Holds `ENGINE_LOCK` and seeds the global `random` module, which dgisim
+    draws from, for the engine calls made inside, then restores its state so
+    that the process's other users of `random` are unaffected.
+    """
+    with ENGINE_LOCK:
+        saved = random.getstate()
+        random.seed(seed)
+        try:
+            yield
+        finally:
+            random.setstate(saved)
+
+
+class _EngineUnpickler(pickle.Unpickler):
+    """
+    Only rebuilds classes defined in dgisim's modules, and a few builtin
+    containers, so that a pickle can't reach any function to call.
+    """
+
+    _BUILTINS = frozenset({"frozenset", "set", "tuple", "list", "dict", "int", "str", "bool", "object"})
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module == "builtins" and name in self._BUILTINS:
+            return super().find_class(module, name)
+        # dotted names would reach attributes of attributes, e.g. other modules
+        if "." not in name and (module == "dgisim" or module.startswith("dgisim.")):
+            # only modules the engine already imported, nothing is imported here
+            value = getattr(sys.modules.get(module), name, None)
+            if isinstance(value, type) and value.__module__ == module:
+                return value
+        raise pickle.UnpicklingError(f"{module}.{name} is not an engine class")
+
+
+def load_engine_pickle(data: bytes) -> Any:
+    """
+    Unpickles engine objects, e.g. game states, from data that may not be
+    trusted. Raises `pickle.UnpicklingError` for anything else.
+    """
+    return _EngineUnpickler(io.BytesIO(data)).load()
+
+
+def choose_action(
+        agent: ds.PlayerAgent,
+        history: list[ds.GameState],
+        pid: ds.Pid,
+) -> ds.PlayerAction:
+    """
+    Lets `agent` choose an action, holding `ENGINE_LOCK` unless the agent sets
+    `locks_engine` to say it takes the lock around its own engine calls.
+    """
+    if getattr(agent, "locks_engine", False):
+        return agent.choose_action(history, pid)
+    with ENGINE_LOCK:
+        return agent.choose_action(history, pid)
@@ -0,0 +1,332 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+import weakref
+from concurrent.futures import Future, TimeoutError
+from typing import Any
+
+import dgisim as ds
+from dgisim import agents as dsa
+
+from .engine import ENGINE_LOCK, choose_action
+from .log import configure_logging, get_logger
+
+__all__ = [
+    "DEFAULT_ACTION_TIMEOUT",
+    "DEFAULT_QUEUE_TIMEOUT",
+    "EngineHost",
+    "EngineHostError",
+    "HostedAgent",
+    "default_engine_host",
+]
+
+_logger = get_logger(__name__)
+
+#: seconds an agent may take for an action, from when its worker starts on it
+#: (time queued behind other requests doesn't count), before the worker is
+#: taken for runaway and restarted
+DEFAULT_ACTION_TIMEOUT = 60.0
+
+#: seconds an agent's request may wait behind other requests for its worker
+#: before the agent gives up on it
+DEFAULT_QUEUE_TIMEOUT = 120.0
+
+WORKERS_ENV_VAR = "DGISIM_ENGINE_WORKERS"
+
+_agent_ids = itertools.count()
+
+
+class EngineHostError(RuntimeError):
+    """
+    Raised when a worker fails a request, crashes or runs out of time.
+    """
+    pass
+
+
+def _serve(conn: Any) -> None:
+    """
+    The worker loop: answers `(request_id, op, args)` requests with
+    `(request_id, ok, result)`, `result` being the traceback if not ok, after
+    sending `(request_id, None, None)` as it starts on the request.
+    """
+    from .agents.opening_book import with_opening_book
+    from .agents.rollout import set_rollout_workers
+    configure_logging()
+    # the workers are the parallelism, and daemon processes can't have children
+    set_rollout_workers(0)
+    agents: dict[int, ds.PlayerAgent] = {}
+    while True:
+        try:
+            request_id, op, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            conn.send((request_id, None, None))
+            if op == "choose_action":
+                agent_id, agent_class, history, pid = args
+                agent = agents.get(agent_id)
+                if agent is None:
+                    # also after a restart, which loses what the agent learned
+                    agent = agents[agent_id] = with_opening_book(agent_class())
+                result = choose_action(agent, history, pid)
+            elif op == "drop_agent":
+                agents.pop(args[0], None)
+                result = None
+            else:
+                raise ValueError(f"Unknown request {op!r}")
+        except Exception:
+            conn.send((request_id, False, traceback.format_exc()))
+        else:
+            conn.send((request_id, True, result))
+
+
+class _Request:
+    def __init__(self) -> None:
+        self.future: Future = Future()
+        #: set once the worker starts on the request, or it is done
+        self.started = threading.Event()
+        self.future.add_done_callback(lambda _: self.started.set())
+
+
+class _Worker:
+    """
+    One engine process, started on the first request and restarted on the
+    first request after it died or was killed.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._lock = threading.Lock()
+        self._process: Any = None
+        self._conn: Any = None
+        self._pending: dict[int, _Request] = {}
+        self._request_ids = itertools.count()
+        #: counts the processes started, to tell a restarted worker apart
+        self._generation = 0
+
+    def request(self, op: str, *args: Any) -> tuple[_Request, int]:
+        """
+        :returns: the request, with the future of its result, and the
+                  generation of the process it was sent to.
+        """
+        request = _Request()
+        with self._lock:
+            if self._process is None:
+                self._start()
+            request_id = next(self._request_ids)
+            self._pending[request_id] = request
+            generation = self._generation
+            try:
+                self._conn.send((request_id, op, args))
+            except (OSError, ValueError) as e:
+                del self._pending[request_id]
+                request.future.set_exception(EngineHostError(f"{self._name} is gone: {e}"))
+        return request, generation
+
+    def notify(self, op: str, *args: Any) -> None:
+        """
+        Sends a request whose result is not needed, unless the process is not
+        running, e.g. to drop state it may hold.
+        """
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._conn.send((next(self._request_ids), op, args))
+            except (OSError, ValueError):
+                pass
+
+    def abandon(self, request: _Request) -> None:
+        """
+        Drops `request`, whose result will be ignored. The process still
+        works on it when it gets to it.
+        """
+        with self._lock:
+            for request_id, pending in self._pending.items():
+                if pending is request:
+                    del self._pending[request_id]
+                    break
+
+    def kill(self, generation: int, reason: str, expected: bool = False) -> None:
+        """
+        Stops the process of `generation` if it is still the current one,
+        failing its pending requests.
+        """
+        with self._lock:
+            if generation != self._generation or self._process is None:
+                return
+            process, conn, pending = self._process, self._conn, self._pending
+            self._process, self._conn, self._pending = None, None, {}
+        _logger.log(logging.INFO if expected else logging.WARNING, "Stopping %s: %s", self._name, reason)
+        process.kill()
+        conn.close()
+        process.join(1.0)
+        for request in pending.values():
+            request.future.set_exception(EngineHostError(f"{self._name} stopped: {reason}"))
+
+    def close(self) -> None:
+        self.kill(self._generation, "closed", expected=True)
+
+    def _start(self) -> None:
+        # forking could copy ENGINE_LOCK while another thread holds it
+        context = multiprocessing.get_context("spawn")
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_serve, args=(child_conn,), name=self._name, daemon=True)
+        process.start()
+        child_conn.close()
+        self._generation += 1
+        self._process, self._conn = process, conn
+        _logger.info("Started %s, pid %s", self._name, process.pid)
+        threading.Thread(
+            target=self._read,
+            args=(conn, self._generation),
+            name=f"{self._name}-reader",
+            daemon=True,
+        ).start()
+
+    def _read(self, conn: Any, generation: int) -> None:
+        while True:
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                if ok is None:
+                    request = self._pending.get(request_id)
+                else:
+                    request = self._pending.pop(request_id, None)
+            if request is None:
+                continue
+            if ok is None:
+                request.started.set()
+            elif ok:
+                request.future.set_result(result)
+            else:
+                request.future.set_exception(EngineHostError(result))
+        self.kill(generation, "exited")
+
+
+class HostedAgent(ds.PlayerAgent):
+    """
+    An agent of `agent_class` living in an engine worker process, which this
+    forwards `choose_action()` to.
+
+    If the worker fails, crashes, runs out of time or is too long busy with
+    other requests, a random action is played instead, so neither a broken
+    agent nor a crowded worker can stall the match.
+    """
+
+    #: takes no engine lock in this process but around the fallback
+    locks_engine = True
+
+    def __init__(
+            self,
+            worker: _Worker,
+            agent_class: type[ds.PlayerAgent],
+            timeout: float,
+            queue_timeout: float,
+    ) -> None:
+        self.agent_class = agent_class
+        self._worker = worker
+        self._timeout = timeout
+        self._queue_timeout = queue_timeout
+        self._id = next(_agent_ids)
+        weakref.finalize(self, worker.notify, "drop_agent", self._id)
+
+    def choose_action(self, history: list[ds.GameState], pid: ds.Pid) -> ds.PlayerAction:
+        request, generation = self._worker.request(
+            "choose_action", self._id, self.agent_class, history[-1:], pid,
+        )
+        # queued behind other sessions' requests, which are timed themselves
+        if not request.started.wait(self._queue_timeout):
+            self._worker.abandon(request)
+            reason = f"worker busy for {self._queue_timeout}s"
+        else:
+            try:
+                return request.future.result(self._timeout)
+            except TimeoutError:
+                self._worker.kill(generation, f"no action {self._timeout}s after starting on it")
+                reason = "timed out"
+            except EngineHostError as e:
+                reason = str(e)
+        _logger.warning("%s failed, playing a random action: %s", self.agent_class.__name__, reason)
+        with ENGINE_LOCK:
+            return dsa.RandomAgent().choose_action(history, pid)
+
+
+class EngineHost:
+    """
+    A pool of worker processes that run the agents of every session, so that
+    their search neither competes with the UI for the GIL nor takes the
+    process down with it.
+    """
+
+    def __init__(
+            self,
+            workers: int = 1,
+            timeout: float = DEFAULT_ACTION_TIMEOUT,
+            queue_timeout: float = DEFAULT_QUEUE_TIMEOUT,
+    ) -> None:
+        """
+        :param timeout: seconds an action may take, see `DEFAULT_ACTION_TIMEOUT`.
+        :param queue_timeout: seconds an action may wait for its worker, see
+                              `DEFAULT_QUEUE_TIMEOUT`.
+        """
+        self._workers = [_Worker(f"engine-worker-{i}") for i in range(max(1, workers))]
+        self._timeout = timeout
+        self._queue_timeout = queue_timeout
+        self._next_worker = itertools.count()
+
+    def agent(self, agent_class: type[ds.PlayerAgent]) -> HostedAgent:
+        """
+        :returns: a new agent, placed on the workers in turn.
+        """
+        worker = self._workers[next(self._next_worker) % len(self._workers)]
+        return HostedAgent(worker, agent_class, self._timeout, self._queue_timeout)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.close()
+
+
+_default_host: EngineHost | None = None
+_default_host_lock = threading.Lock()
+
+
+def default_engine_host() -> EngineHost | None:
+    """
+    :returns: the host with the number of workers in `DGISIM_ENGINE_WORKERS`,
+              created once, or None if unset or 0, agents then running
+              in-process.
+    """
+    global _default_host
+    with _default_host_lock:
+        if _default_host is None:
+            try:
+                workers = int(os.environ.get(WORKERS_ENV_VAR) or 0)
+            except ValueError:
+                _logger.warning("Ignoring %s, not a number", WORKERS_ENV_VAR)
+                workers = 0
+            if workers > 0:
+                _default_host = EngineHost(workers)
+        return _default_host
@@ -15,8 +15,16 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
+import asyncio
+import functools
+import itertools
+import os
+import random
+import time
+from bisect import bisect_right
+from concurrent.futures import Executor
 from dataclasses import dataclass, field
-from typing import Callable, Literal
+from typing import TYPE_CHECKING, Any, Callable, Container, Hashable, Iterator, Literal, Protocol, TypeVar
 
 from typing_extensions import Self
 
@@ -27,19 +35,71 @@ from dgisim import status as dsst
 from dgisim import summon as dssm
 from dgisim import support as dssp
 
+from .agents.mcts import MCTSAgent
+from .agents.opening_book import with_opening_book
+from .engine import ENGINE_LOCK, choose_action, new_seed, seeded_engine
+from .engine_host import EngineHost, default_engine_host
+from .log import get_logger, session_logger
+from .match_pool import MatchPool
+from .match_journal import MatchJournal, default_journal_dir, journal_path, load_journal
+from .match_store import DEFAULT_MAX_MATCHES, DEFAULT_MAX_NODES, MatchCache
+from .match_tabs import MatchTab, TabRunner
+from .session_actor import SessionActor
+from .speculation import Speculator, speculation_executor
+from .state_diff import DiffCache, LazyDiff
+from .win_estimate import WinEstimator
+
+if TYPE_CHECKING:
+    from .remote_match import RemoteMatchClient
+
 __all__ = [
     "PlayerSettings",
     "GamePlaySettings",
     "Match",
     "GameData",
+    "GameDataEvents",
     "GameDataListener",
+    "GameServices",
+    "ReplayError",
+    "SeatTokenStore",
+    "Speculation",
 ]
 
+_logger = get_logger(__name__)
+
+DEFAULT_NODE_BUDGET = 5000
+#: seconds to wait for the first state of a remote match
+REMOTE_JOIN_TIMEOUT = 10.0
+#: matches a session can have open in tabs
+MAX_TABS = 8
+
+
+def _iter_nodes(root: MatchNode) -> Iterator[MatchNode]:
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+class ReplayError(Exception):
+    """
+    Raised when a node restored without its states cannot be replayed.
+    """
+    pass
+
 
 @dataclass(kw_only=True)
 class PlayerSettings:
     player_type: Literal["P", "E"]
     random_deck: bool = False
+    #: the agent playing for an "E" player
+    agent: Literal["random", "mcts"] = "random"
+
+    def agent_class(self) -> type[ds.PlayerAgent]:
+        if self.agent == "mcts":
+            return MCTSAgent
+        return dsa.RandomAgent
 
     def as_tuple(self) -> tuple[str, bool]:
         return (self.player_type, self.random_deck)
@@ -51,13 +111,21 @@ class GamePlaySettings:
     primary_settings: PlayerSettings
     oppo_settings: PlayerSettings
     local: bool
+    #: URL of the match server of a remote game
+    server: str | None = None
+    #: id of the match on the server, which both players join
+    match_id: str | None = None
+    #: True to watch the remote match from the primary player's seat
+    spectating: bool = False
+    #: True for a spectator who sees neither player's secrets
+    neutral_view: bool = False
 
     @classmethod
     def from_random_PVE(cls) -> None:
         return GamePlaySettings(
             primary_player=ds.Pid.P1,
             primary_settings=PlayerSettings(player_type="P", random_deck=True),
-            oppo_settings=PlayerSettings(player_type="E", random_deck=True),
+            oppo_settings=PlayerSettings(player_type="E", random_deck=True, agent="mcts"),
             local=True,
         )
 
@@ -70,6 +138,33 @@ class GamePlaySettings:
             local=True,
         )
 
+    @classmethod
+    def from_remote_PVP(cls, server: str, match_id: str, pid: ds.Pid) -> GamePlaySettings:
+        return GamePlaySettings(
+            primary_player=pid,
+            primary_settings=PlayerSettings(player_type="P", random_deck=True),
+            oppo_settings=PlayerSettings(player_type="P", random_deck=True),
+            local=False,
+            server=server,
+            match_id=match_id,
+        )
+
+    @classmethod
+    def from_remote_watch(cls, server: str, match_id: str, perspective: ds.Pid | None) -> GamePlaySettings:
+        """
+        :param perspective: whose view to watch, None for neither's secrets.
+        """
+        return GamePlaySettings(
+            primary_player=ds.Pid.P1 if perspective is None else perspective,
+            primary_settings=PlayerSettings(player_type="P", random_deck=True),
+            oppo_settings=PlayerSettings(player_type="P", random_deck=True),
+            local=False,
+            server=server,
+            match_id=match_id,
+            spectating=True,
+            neutral_view=perspective is None,
+        )
+
     @classmethod
     def from_random_EVE(cls) -> None:
         return GamePlaySettings(
@@ -99,9 +194,38 @@ class MatchNode:
     parent: Self | None = None
     inter_states: list[ds.GameState] = field(default_factory=list)
     stop_state: ds.GameState | None = None
-    action: ds.PlayerAction | None = None
+    #: the action taken at the parent's stop state that led to this node
+    in_action: ds.PlayerAction | None = None
     inter_fork: bool = False
+    #: alternative branches that were played from this node's stop state
     children: list[Self] = field(default_factory=list)
+    #: index of the child on the current line
+    selected: int = 0
+    #: seed of the action step into this node and the auto steps within it
+    seed: int = 0
+    #: whether the states follow from `in_action` and `seed`, which isn't the
+    #: case for states mirrored from elsewhere
+    replayable: bool = True
+    #: when this node was last visited, used to prune the stalest branches
+    last_visit: int = 0
+    #: estimated chance of player 1 winning from here, see `WinEstimator`
+    win_estimate: float | None = None
+    #: unpacks the states of a node loaded without them, see `Match.realize()`
+    packed_states: Callable[[], list[ds.GameState]] | None = None
+
+    @property
+    def action(self) -> ds.PlayerAction | None:
+        """
+        The action taken towards the selected child.
+        """
+        if not self.children:
+            return None
+        return self.children[self.selected].in_action
+
+    def selected_child(self) -> Self | None:
+        if not self.children:
+            return None
+        return self.children[self.selected]
 
     def is_terminal(self) -> bool:
         return self.stop_state is not None and self.stop_state.game_end()
@@ -115,78 +239,398 @@ class MatchNode:
         return self.inter_fork or self.stop_state is not None
 
 
+@dataclass(eq=False)
+class Speculation:
+    """
+    Nodes computed ahead for `action` at `parent`, not yet part of the tree.
+    """
+    parent: MatchNode
+    action: ds.PlayerAction
+    #: a chain, each node being the only child of the one before
+    nodes: list[MatchNode]
+    #: state of the match's seed generator the nodes were computed from
+    seed_state_before: tuple
+    #: state of the match's seed generator after the nodes
+    seed_state_after: tuple
+
+
 class Match:
     def __init__(
             self,
             initial_state: ds.GameState | None = None,
             agent1: ds.PlayerAgent = dsa.RandomAgent(),
             agent2: ds.PlayerAgent = dsa.RandomAgent(),
+            seed: int | None = None,
+            node_budget: int = DEFAULT_NODE_BUDGET,
     ) -> None:
+        """
+        :param seed: seeds the initial state (if not given) and every step of
+                     the match, so the same seed and actions give the same game.
+        :param node_budget: when there are more nodes than this, the least
+                            recently visited branches off the current line are
+                            pruned.
+        """
         self._agent1 = agent1
         self._agent2 = agent2
+        self._seed = new_seed() if seed is None else seed
+        self._seed_rng = random.Random(self._seed)
+        self._node_budget = node_budget
+        self._node_count = 1
+        self._tick = 0
+        self._node_listeners: list[Callable[[MatchNode], None]] = []
 
         if initial_state is None:
             # TODO: init game state according to settings
-            initial_state = ds.GameState.from_default()
+            with seeded_engine(self._seed):
+                initial_state = ds.GameState.from_default()
 
         if initial_state.waiting_for() is None:
-            self._root_match_node = MatchNode(inter_states=[initial_state])
+            self._root_match_node = MatchNode(inter_states=[initial_state], seed=self._seed)
             self._auto_complete_matchnode(self._root_match_node)
         else:
-            self._root_match_node = MatchNode(stop_state=initial_state)
+            self._root_match_node = MatchNode(stop_state=initial_state, seed=self._seed)
 
-        self._curr_match_node = self._root_match_node
-        self._focused_index = -1
+        #: the current node and the index of the focused state among its
+        #: intermediate states, -1 for its stop state; always replaced as a
+        #: whole, so that other threads read a consistent pair
+        self._position: tuple[MatchNode, int] = (self._root_match_node, -1)
+        self._line_index: tuple[list[MatchNode], list[int]] | None = None
+
+    @classmethod
+    def from_tree(
+            cls,
+            root: MatchNode,
+            curr_node: MatchNode,
+            seed: int,
+            agent1: ds.PlayerAgent = dsa.RandomAgent(),
+            agent2: ds.PlayerAgent = dsa.RandomAgent(),
+            node_budget: int = DEFAULT_NODE_BUDGET,
+    ) -> Match:
+        """
+        Creates a match over an existing node tree, nodes of which can be left
+        unrealized (see `realize()`).
+        """
+        match = cls.__new__(cls)
+        match._agent1 = agent1
+        match._agent2 = agent2
+        match._seed = seed
+        match._seed_rng = random.Random(new_seed())
+        match._node_budget = node_budget
+        match._node_count = sum(1 for _ in _iter_nodes(root))
+        match._tick = 0
+        match._node_listeners = []
+        match._root_match_node = root
+        match._position = (root, -1)
+        match._line_index = None
+        node: MatchNode | None = curr_node
+        while node is not None and not match._goto(node):
+            node = node.parent
+        return match
+
+    @property
+    def seed(self) -> int:
+        return self._seed
+
+    @property
+    def root_node(self) -> MatchNode:
+        return self._root_match_node
+
+    @property
+    def node_count(self) -> int:
+        return self._node_count
 
     @property
     def curr_node(self) -> MatchNode:
-        return self._curr_match_node
+        return self._position[0]
     
-    def new_node(self, init_state: ds.GameState) -> None:
+    def new_node(
+            self,
+            init_state: ds.GameState,
+            seed: int | None = None,
+            in_action: ds.PlayerAction | None = None,
+    ) -> None:
+        """
+        Adds a node after the current node and moves to it. If the current node
+        already has children, the new node starts a new branch, sharing all
+        states before it with the existing branches.
+        """
+        parent = self.curr_node
         new_node = MatchNode(
-            depth=self._curr_match_node.depth + 1,
-            parent=self._curr_match_node,
+            depth=parent.depth + 1,
+            parent=parent,
             inter_states=[init_state],
+            in_action=in_action,
+            seed=self._seed_rng.getrandbits(32) if seed is None else seed,
         )
         self._auto_complete_matchnode(new_node)
-        self._curr_match_node.children.append(new_node)
-        self._curr_match_node = new_node
+        parent.children.append(new_node)
+        parent.selected = len(parent.children) - 1
+        self._node_count += 1
+        self._line_index = None
+        self._goto(new_node)
+        if self._node_count > self._node_budget:
+            self._prune()
+        self._notify_new_node(new_node)
+
+    def add_node_listener(self, listener: Callable[[MatchNode], None]) -> None:
+        """
+        `listener` is called with every node added to the match and moved to,
+        right after it is added.
+        """
+        self._node_listeners.append(listener)
+
+    def remove_node_listener(self, listener: Callable[[MatchNode], None]) -> None:
+        self._node_listeners.remove(listener)
+
+    def _notify_new_node(self, node: MatchNode) -> None:
+        for listener in list(self._node_listeners):
+            listener(node)
+
+    def apply_action(self, pid: ds.Pid, action: ds.PlayerAction) -> None:
+        """
+        Executes `action` on the current node and moves to the resulting node.
+
+        Raises if the action is invalid.
+        """
+        seed = self._seed_rng.getrandbits(32)
+        with ENGINE_LOCK:
+            next_state = self.curr_node.latest_state().action_step(pid, action, seed=seed)
+        assert next_state is not None
+        self.new_node(next_state, seed, action)
+
+    def extend_line(
+            self,
+            stop_state: ds.GameState,
+            in_action: ds.PlayerAction | None = None,
+    ) -> None:
+        """
+        Adds a node holding only `stop_state` after the last node of the
+        current line, without moving away from the current node. This is how
+        matches played elsewhere are mirrored.
+        """
+        tail = self.curr_node
+        while tail.children:
+            tail = tail.selected_child()
+        tail.children.append(MatchNode(
+            depth=tail.depth + 1,
+            parent=tail,
+            stop_state=stop_state,
+            in_action=in_action,
+            replayable=False,
+        ))
+        tail.selected = len(tail.children) - 1
+        self._node_count += 1
+        self._line_index = None
+
+    def speculation_base(self) -> tuple[MatchNode, tuple]:
+        """
+        :returns: the current node and the seed generator state that
+                  `speculate()` computes from.
+        """
+        return self.curr_node, self._seed_rng.getstate()
+
+    def speculate(
+            self,
+            parent: MatchNode,
+            seed_state: tuple,
+            pid: ds.Pid,
+            action: ds.PlayerAction,
+            agent_pids: Container[ds.Pid],
+            cancelled: Callable[[], bool] = lambda: False,
+    ) -> Speculation | None:
+        """
+        Computes the nodes `apply_action()` would add for `action` at `parent`,
+        followed by the replies of the agents of `agent_pids`, without
+        changing the match. Safe to call from other threads.
+
+        :returns: None if `action` is invalid.
+        """
+        rng = random.Random()
+        rng.setstate(seed_state)
+        nodes: list[MatchNode] = []
+        node = parent
+        while not cancelled():
+            seed = rng.getrandbits(32)
+            try:
+                with ENGINE_LOCK:
+                    next_state = node.latest_state().action_step(pid, action, seed=seed)
+                assert next_state is not None
+            except Exception:
+                break
+            next_node = MatchNode(
+                depth=node.depth + 1,
+                parent=node,
+                inter_states=[next_state],
+                in_action=action,
+                seed=seed,
+            )
+            self._auto_complete_matchnode(next_node)
+            if nodes:
+                node.children.append(next_node)
+            nodes.append(next_node)
+            node = next_node
+            waiting_for = node.stop_state.waiting_for()
+            if node.is_terminal() or waiting_for not in agent_pids:
+                break
+            pid = waiting_for
+            try:
+                action = choose_action(self.agent(pid), [node.stop_state], pid)
+            except Exception:
+                break
+        if not nodes:
+            return None
+        return Speculation(
+            parent=parent,
+            action=nodes[0].in_action,
+            nodes=nodes,
+            seed_state_before=seed_state,
+            seed_state_after=rng.getstate(),
+        )
+
+    def commit(self, speculation: Speculation) -> bool:
+        """
+        Adds the nodes of `speculation` after the current node and moves to the
+        last of them, as if their actions were applied one by one.
+
+        :returns: False if the match has moved on since the speculation.
+        """
+        parent = self.curr_node
+        if (
+                speculation.parent is not parent
+                or speculation.seed_state_before != self._seed_rng.getstate()
+        ):
+            return False
+        parent.children.append(speculation.nodes[0])
+        parent.selected = len(parent.children) - 1
+        self._seed_rng.setstate(speculation.seed_state_after)
+        self._node_count += len(speculation.nodes)
+        self._line_index = None
+        self._goto(speculation.nodes[-1])
+        if self._node_count > self._node_budget:
+            self._prune()
+        for node in speculation.nodes:
+            self._notify_new_node(node)
+        return True
+
+    def branch_index(self) -> tuple[int, int]:
+        """
+        :returns: the index of the current node among its siblings and the
+                  number of siblings.
+        """
+        parent = self.curr_node.parent
+        if parent is None:
+            return (0, 1)
+        return (parent.children.index(self.curr_node), len(parent.children))
+
+    def switch_branch(self, offset: int) -> None:
+        """
+        Moves to the sibling `offset` away from the current node, which makes
+        its branch the current line.
+        """
+        parent = self.curr_node.parent
+        if parent is None:
+            return
+        index, num = self.branch_index()
+        sibling = parent.children[(index + offset) % num]
+        if self._goto(sibling):
+            parent.selected = parent.children.index(sibling)
+            self._line_index = None
+
+    def _prune(self) -> None:
+        """
+        Drops the least recently visited branches off the current line until
+        the node budget is met.
+        """
+        line, _ = self._line()
+        on_line = set(map(id, line))
+        # (last visit in the branch, size, branch root)
+        branches: list[tuple[int, int, MatchNode]] = []
+        for node in line:
+            for child in node.children:
+                if id(child) in on_line:
+                    continue
+                nodes = list(_iter_nodes(child))
+                branches.append((max(n.last_visit for n in nodes), len(nodes), child))
+        branches.sort(key=lambda branch: branch[0])
+        for _, size, child in branches:
+            if self._node_count <= self._node_budget:
+                break
+            parent = child.parent
+            assert parent is not None
+            selected_child = parent.selected_child()
+            parent.children.remove(child)
+            parent.selected = parent.children.index(selected_child)
+            self._node_count -= size
+
+    def realize(self, node: MatchNode) -> None:
+        """
+        Computes the states of a node that was restored without them, by
+        unpacking its `packed_states` if any, otherwise by replaying its
+        `in_action` from the parent's stop state.
+
+        Raises `ReplayError` if the states cannot be unpacked or the action is
+        no longer valid, which can happen when the node was saved by another
+        process (dgisim's iteration order over some sets depends on the
+        process).
+        """
+        if node.is_state_complete():
+            return
+        if node.packed_states is not None:
+            try:
+                states = node.packed_states()
+            except Exception as e:
+                raise ReplayError(f"Cannot unpack the states at depth {node.depth}") from e
+            node.inter_states = states[:-1]
+            node.stop_state = states[-1]
+            node.packed_states = None
+            return
+        if not node.inter_states:
+            parent = node.parent
+            assert parent is not None and node.in_action is not None
+            self.realize(parent)
+            parent_state = parent.latest_state()
+            try:
+                with ENGINE_LOCK:
+                    init_state = parent_state.action_step(
+                        parent_state.waiting_for(),
+                        node.in_action,
+                        seed=node.seed,
+                    )
+                assert init_state is not None
+            except Exception as e:
+                raise ReplayError(f"Cannot replay {node.in_action} at depth {parent.depth}") from e
+            node.inter_states = [init_state]
+        self._auto_complete_matchnode(node)
+
+    def _goto(self, node: MatchNode) -> bool:
+        """
+        Moves to the stop state of `node`, or stays put and returns False if
+        `node` cannot be realized.
+        """
+        try:
+            self.realize(node)
+        except ReplayError:
+            _logger.warning("Cannot move to node", exc_info=True, extra={"depth": node.depth})
+            return False
+        self._position = (node, -1)
+        self._tick += 1
+        node.last_visit = self._tick
+        return True
 
     tmp = True
 
     def _auto_complete_matchnode(self, node: MatchNode) -> None:
         if node.is_state_complete():
             return
-        gsm = ds.GameStateMachine(node.inter_states[-1], self._agent1, self._agent2)
-        # # Fake Death Swap
-        # es = gsm.get_game_state().get_effect_stack()
-        # from dgisim import effect as dsef
-        # if any(
-        #         (
-        #             isinstance(e, dsef.CastSkillEffect)
-        #             and e.target.pid is ds.Pid.P2
-        #         )
-        #         for e in es._effects
-        # ):
-        #     gsm.step_until_holds(
-        #         lambda gs: (
-        #             (es := gs.get_effect_stack()).is_not_empty()
-        #             and isinstance(es.peek(), dsef.AliveMarkCheckerEffect)
-        #         )
-        #     )
-        #     gsm._history[-1] = gsm._history[-1].factory().f_effect_stack(
-        #         lambda es: es.push_one(dsef.ReferredDamageEffect(
-        #             source=ds.StaticTarget.from_support(ds.Pid.P2, 1),
-        #             target=ds.DynamicCharacterTarget.OPPO_ACTIVE,
-        #             element=ds.Element.PIERCING,
-        #             damage=100,
-        #             damage_type=ds.DamageType(status=True, no_boost=True),
-        #         ))
-        #     ).build()
-        #     gsm._game_state = gsm._history[-1]
-        gsm.auto_step()
-        node.inter_states = gsm.get_history()[:-1]
-        node.stop_state = gsm.get_history()[-1]
+        rng = random.Random(node.seed)
+        history = list(node.inter_states)
+        game_state = history[-1]
+        with ENGINE_LOCK:
+            while not game_state.game_end() and game_state.waiting_for() is None:
+                game_state = game_state.step(seed=rng.random())
+                history.append(game_state)
+        node.inter_states = history[:-1]
+        node.stop_state = history[-1]
 
         # from dgisim import char as dscr
         # if dscr.Dehya not in node.stop_state.get_player1().get_characters():
@@ -229,146 +673,813 @@ class Match:
         #     ).build()
         #     self.tmp = False
 
+    def surrender(self, pid: ds.Pid) -> None:
+        """
+        Ends the match with all characters of `pid` defeated.
+        """
+        self.new_node(
+            self.curr_node.latest_state().factory().f_phase(
+                lambda mode: mode.game_end_phase()
+            ).f_player(
+                pid,
+                lambda p: p.factory().f_characters(
+                    lambda cs: cs.factory().f_characters(
+                        lambda chs: tuple([
+                            char.factory().alive(False).build()
+                            for char in chs
+                        ])
+                    ).build()
+                ).build()
+            ).build()
+        )
+
     def agent(self, pid: ds.Pid) -> ds.PlayerAgent:
         if pid is ds.Pid.P1:
             return self._agent1
         else:
             return self._agent2
 
+    def set_agent(self, pid: ds.Pid, agent: ds.PlayerAgent) -> None:
+        if pid is ds.Pid.P1:
+            self._agent1 = agent
+        else:
+            self._agent2 = agent
+
     def agent_action_step(self, pid: ds.Pid) -> None:
         assert (
-            self._curr_match_node.stop_state is not None
-            and self._curr_match_node.stop_state.waiting_for() is pid
+            self.curr_node.stop_state is not None
+            and self.curr_node.stop_state.waiting_for() is pid
         )
         agent = self.agent(pid)
         try:
-            action = agent.choose_action([self._curr_match_node.stop_state], pid)
-        except Exception as e:
-            print("Agent cannot provide a valid action:", e)
+            action = choose_action(agent, [self.curr_node.stop_state], pid)
+        except Exception:
+            _logger.warning(
+                "Agent cannot provide a valid action",
+                exc_info=True,
+                extra={"depth": self.curr_node.depth, "pid": pid},
+            )
             return
-        print(f"{pid} taking action: {action}")
-        self._curr_match_node.action = action
+        _logger.debug(
+            "%s taking action: %s", pid, action,
+            extra={"depth": self.curr_node.depth, "pid": pid},
+        )
         try:
-            next_state = self._curr_match_node.stop_state.action_step(pid, action)
-            assert next_state is not None
-        except Exception as e:
-            print(e)
-            return
-        self.new_node(next_state)
+            self.apply_action(pid, action)
+        except Exception:
+            _logger.warning(
+                "Agent action %s failed", action,
+                exc_info=True,
+                extra={"depth": self.curr_node.depth, "pid": pid},
+            )
 
     def latest_state(self) -> ds.GameState:
-        return self._curr_match_node.latest_state()
+        return self.curr_node.latest_state()
+
+    def _focus(self, index: int) -> None:
+        self._position = (self._position[0], index)
+
+    @staticmethod
+    def _state_at(node: MatchNode, index: int) -> ds.GameState:
+        if index == -1:
+            return node.latest_state()
+        return node.inter_states[index]
 
     def curr_state(self) -> ds.GameState:
-        if self._focused_index == -1:
-            return self.latest_state()
-        else:
-            return self._curr_match_node.inter_states[self._focused_index]
+        return self._state_at(*self._position)
+
+    def previous_state(self, whole_action: bool = False) -> ds.GameState | None:
+        """
+        :param whole_action: if True, the state before the action that led to
+                             the current node is returned instead.
+        :returns: the state right before the current one in the current line,
+                  or None if there is none.
+        """
+        node, index = self._position
+        if index == -1:
+            index = len(node.inter_states)
+        if index > 0 and not whole_action:
+            return node.inter_states[index - 1]
+        if node.parent is None:
+            return None
+        return node.parent.stop_state
 
     def is_at_latest(self) -> bool:
-        return (
-            len(self._curr_match_node.children) == 0
-            and self.curr_state() is self._curr_match_node.latest_state()
-        )
+        node, index = self._position
+        return len(node.children) == 0 and self._state_at(node, index) is node.latest_state()
 
     def action_back(self) -> None:
-        curr_node = self._curr_match_node
-        if curr_node.parent is None:
-            return
-        self._curr_match_node = curr_node.parent
-        self._focused_index = -1
+        # nodes that cannot be realized are skipped, the root always has a state
+        node = self.curr_node.parent
+        while node is not None and not self._goto(node):
+            node = node.parent
+        if node is None:
+            self._focus(-1)
 
     def action_forward(self) -> None:
-        if len(self._curr_match_node.children) == 0:
-            self._focused_index = -1
-            return
-        self._curr_match_node = self._curr_match_node.children[0]
-        self._focused_index = -1
+        node = self.curr_node.selected_child()
+        while node is not None and not self._goto(node):
+            node = node.selected_child()
+        if node is None:
+            self._focus(-1)
 
     def step_back(self) -> None:
-        if self._focused_index == -1:
-            self._focused_index = len(self._curr_match_node.inter_states) - 1
-            if self._focused_index == -1:
-                self.action_back()
-        elif self._focused_index > 0:
-            self._focused_index -= 1
-        elif self._focused_index == 0:
-            if self._curr_match_node.parent is not None:
+        node, index = self._position
+        if index == -1:
+            if node.inter_states:
+                self._focus(len(node.inter_states) - 1)
+            else:
                 self.action_back()
-                self._focused_index = -1
+        elif index > 0:
+            self._focus(index - 1)
+        elif node.parent is not None:
+            self.action_back()
 
     def step_forward(self) -> None:
-        if self._focused_index == -1:
-            if len(self._curr_match_node.children) != 0:
+        node, index = self._position
+        if index == -1:
+            if len(node.children) != 0:
                 self.action_forward()
-                if self._curr_match_node.inter_states:
-                    self._focused_index = 0
-        elif self._focused_index < len(self._curr_match_node.inter_states) - 1:
-            self._focused_index += 1
-        elif self._focused_index == len(self._curr_match_node.inter_states) - 1:
-            self._focused_index = -1
+                if self.curr_node.inter_states:
+                    self._focus(0)
+        elif index < len(node.inter_states) - 1:
+            self._focus(index + 1)
+        else:
+            self._focus(-1)
 
     def curr_state_index(self) -> tuple[int, int]:
-        return (
-            self._curr_match_node.depth,
-            self._focused_index if self._focused_index != -1 else len(self._curr_match_node.inter_states),
+        node, index = self._position
+        return (node.depth, index if index != -1 else len(node.inter_states))
+
+    def _line(self) -> tuple[list[MatchNode], list[int]]:
+        """
+        :returns: the nodes of the current line (the path to the current node
+                  followed by the selected children) indexed by
+                  depth, and the position of each node's first state when all
+                  states of the line are laid out flat.
+
+        A node takes `len(inter_states) + 1` positions, the last being its stop
+        state. A node that cannot be replayed takes a single position.
+        """
+        if self._line_index is not None:
+            return self._line_index
+        nodes: list[MatchNode] = []
+        node: MatchNode | None = self.curr_node
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        while nodes[-1].children:
+            nodes.append(nodes[-1].selected_child())
+        offsets = [0]
+        for node in nodes:
+            try:
+                self.realize(node)
+                offsets.append(offsets[-1] + len(node.inter_states) + 1)
+            except ReplayError:
+                offsets.append(offsets[-1] + 1)
+        self._line_index = (nodes, offsets)
+        return self._line_index
+
+    def line_size(self) -> int:
+        """
+        :returns: the number of states in the current line.
+        """
+        _, offsets = self._line()
+        return offsets[-1]
+
+    def line_position(self) -> int:
+        """
+        :returns: the position of the current state in the current line.
+        """
+        _, offsets = self._line()
+        depth, index = self.curr_state_index()
+        return offsets[depth] + index
+
+    def seek(self, depth: int, index: int = -1) -> None:
+        """
+        Jumps to the `index`-th intermediate state of the node at `depth` of the
+        current line, `index` of -1 or past the intermediate states means the
+        node's stop state.
+        """
+        nodes, _ = self._line()
+        depth = max(0, min(depth, len(nodes) - 1))
+        node = nodes[depth]
+        if not self._goto(node):
+            return
+        if 0 <= index < len(node.inter_states):
+            self._focus(index)
+
+    def seek_position(self, position: int) -> None:
+        """
+        Jumps to the state at `position` of the current line.
+        """
+        nodes, offsets = self._line()
+        position = max(0, min(position, offsets[-1] - 1))
+        depth = bisect_right(offsets, position) - 1
+        self.seek(depth, position - offsets[depth])
+
+    def seek_round(self, round: int) -> None:
+        """
+        Jumps to the first state of round `round` in the current line, or the
+        last state if the line ends before that round.
+        """
+        nodes, _ = self._line()
+        # rounds never decrease along a line, so search on each node's stop state
+        lo, hi = 0, len(nodes) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            try:
+                self.realize(nodes[mid])
+                reached = nodes[mid].stop_state.round >= round
+            except ReplayError:
+                reached = False
+            if reached:
+                hi = mid
+            else:
+                lo = mid + 1
+        node = nodes[lo]
+        index = next(
+            (i for i, state in enumerate(node.inter_states) if state.round >= round),
+            -1,
         )
+        self.seek(lo, index)
 
 GameDataGenre = Literal["latest", "history"]
 
-class GameData:
+
+@dataclass
+class GameServices:
+    """
+    The caches and background workers of a `GameData`, which the sessions of
+    a server share instead of each building their own.
+    """
+    match_pool: MatchPool[Match] = field(default_factory=lambda: MatchPool(Match))
+    diff_cache: DiffCache = field(default_factory=DiffCache)
+    win_estimator: WinEstimator = field(default_factory=WinEstimator)
+    #: matches kept in memory per session, beyond which they go to disk
+    max_matches: int = DEFAULT_MAX_MATCHES
+    #: match nodes kept in memory per session, beyond which matches go to disk
+    max_match_nodes: int = DEFAULT_MAX_NODES
+    #: where sessions write evicted matches; the temporary directory if None
+    match_dir: str | None = None
+    #: runs the agents out of process; in-process if None
+    engine_host: EngineHost | None = field(default_factory=default_engine_host)
+    #: advances the matches of tabs where agents play both sides
+    tab_runner: TabRunner = field(default_factory=TabRunner)
+    #: runs the speculations of the sessions' players, see `Speculator`
+    speculation_executor: Executor = field(default_factory=speculation_executor)
+    #: where the active match is journaled, to be resumed after a crash or
+    #: restart; not journaled if None
+    journal_dir: str | None = field(default_factory=default_journal_dir)
+
+    def close(self) -> None:
+        """
+        Stops the services' background threads, once no session uses them.
+        The engine host is left running, as it may be the process's default
+        one.
+        """
+        self.win_estimator.close()
+        self.speculation_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _agent_class_of(agent: ds.PlayerAgent) -> type[ds.PlayerAgent]:
+    """
+    :returns: the class of the agent that decides, behind books and hosts.
+    """
+    hosted_class = getattr(agent, "agent_class", None)
+    if hosted_class is not None:
+        return hosted_class
+    return type(getattr(agent, "fallback", agent))
+
+
+class SeatTokenStore(Protocol):
+    """
+    Where a session keeps the tokens of the remote seats it took, e.g. the
+    page's `client_storage`, which outlives the session on a reload.
+    """
+
+    def get(self, key: str) -> Any: ...
+
+    def set(self, key: str, value: Any) -> Any: ...
+
+
+class _SessionSeatTokens:
     def __init__(self) -> None:
+        self._tokens: dict[str, Any] = {}
+
+    def get(self, key: str) -> Any:
+        return self._tokens.get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        self._tokens[key] = value
+
+
+def _seat_token_key(server: str, match_id: str, pid: ds.Pid) -> str:
+    return f"dgisim.seat-token.{pid.value}.{match_id}@{server}"
+
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+
+def _serialized(key: str | None = None) -> Callable[[_F], _F]:
+    """
+    Runs the decorated `GameData` method on the session's actor and waits for
+    it, so that it never interleaves with another.
+
+    :param key: a waiting call with the same key is replaced by the newer one,
+                e.g. only the latest of a burst of seeks is carried out.
+    """
+    def decorator(method: _F) -> _F:
+        @functools.wraps(method)
+        def wrapper(self: GameData, *args: Any) -> Any:
+            return self._actor.call(method, self, *args, key=key)
+        return wrapper  # type: ignore[return-value]
+    return decorator
+
+
+class GameData:
+    def __init__(
+            self,
+            session_id: str | None = None,
+            services: GameServices | None = None,
+            seat_tokens: SeatTokenStore | None = None,
+    ) -> None:
+        """
+        :param seat_tokens: keeps the tokens of remote seats, so that the seats
+                            can be retaken by a later session; only for the
+                            session's lifetime if None.
+        """
+        self._logger = session_logger(__name__, session_id)
         self.curr_game_mode: GamePlaySettings | None = None
-        self.matches: dict[tuple, Match] = {}
+        self.curr_match: Match | None = None
+        services = GameServices() if services is None else services
+        self.matches = MatchCache(
+            max_matches=services.max_matches,
+            max_nodes=services.max_match_nodes,
+            root=services.match_dir,
+        )
         self.genred_listeners: dict[GameDataGenre, list[GameDataListener]] = {}
+        self._match_pool = services.match_pool
+        self._diff_cache = services.diff_cache
+        self._speculator = Speculator(services.speculation_executor)
+        self._win_estimator = services.win_estimator
+        self._engine_host = services.engine_host
+        self._tab_runner = services.tab_runner
+        self._tabs: dict[int, MatchTab] = {}
+        self._focused_tab: MatchTab | None = None
+        self._tab_ids = itertools.count(1)
+        self._journal_dir = services.journal_dir
+        self._journal: MatchJournal | None = None
+        #: `time.monotonic()` of the last game started, resumed or played
+        self.last_active = time.monotonic()
+        self._remote: RemoteMatchClient | None = None
+        self._seat_tokens = _SessionSeatTokens() if seat_tokens is None else seat_tokens
+        #: the node of the remote match the player was last moved to
+        self._remote_followed: MatchNode | None = None
+        #: runs the commands that change the session, one at a time
+        self._actor = SessionActor(name=f"session-{session_id}" if session_id else "session")
+
+    def prewarm(self) -> None:
+        """
+        Starts building ready-to-play matches in the background, so that
+        `init_game()` can hand one out instantly. Does nothing where threads
+        can't be started, e.g. in web builds.
+        """
+        self._match_pool.start()
 
+    @_serialized()
     def init_game(self) -> None:
         """
         Called to initialize or resume a match under the current game mode.
         """
+        self.last_active = time.monotonic()
+        self._speculator.discard()
+        if not self.curr_game_mode.local:
+            self._focus(None)
+            self._init_remote_game()
+            return
         curr_mode_tuple = self.curr_game_mode.as_tuple()
-        if (
-                curr_mode_tuple not in self.matches
-                or self.matches[curr_mode_tuple].curr_node.is_terminal()
-        ):
-            self.matches[curr_mode_tuple] = Match()
-        self.curr_match = self.matches[curr_mode_tuple]
+        # marked first, so the match can't be evicted while it is looked up
+        self.matches.active = curr_mode_tuple
+        match = self.matches.get(curr_mode_tuple)
+        if match is None:
+            match = self._load_journal(curr_mode_tuple)
+            if match is not None:
+                self.matches[curr_mode_tuple] = match
+        if match is None or match.curr_node.is_terminal():
+            match = self._match_pool.take()
+            self.matches[curr_mode_tuple] = match
+        self._set_agents(match, self.curr_game_mode)
+        self._keep_journal(curr_mode_tuple, match)
+        tab = next((tab for tab in self._tabs.values() if tab.key == curr_mode_tuple), None)
+        if tab is None:
+            tab = MatchTab(next(self._tab_ids), self.curr_game_mode, match, key=curr_mode_tuple)
+            self._tabs[tab.tab_id] = tab
+        tab.mode, tab.match = self.curr_game_mode, match
+        self._focus(tab)
+        self._try_auto_step()
+
+    def _load_journal(self, key: tuple) -> Match | None:
+        """
+        :returns: the match journaled for `key`, None if there is none.
+        """
+        if self._journal_dir is None:
+            return None
+        path = journal_path(self._journal_dir, key)
+        if not os.path.exists(path):
+            return None
+        try:
+            match = load_journal(path)
+        except Exception:
+            self._logger.warning("Cannot resume from journal %s", path, exc_info=True)
+            return None
+        self._logger.info("Resumed match from journal %s at depth %d", path, match.curr_node.depth)
+        return match
+
+    def _keep_journal(self, key: tuple, match: Match) -> None:
+        """
+        Journals `match` from now on, unless it already is.
+        """
+        if self._journal_dir is None:
+            return
+        journal = self._journal
+        if journal is not None and journal.match is match and not journal.closed:
+            return
+        self._close_journal()
+        if match.curr_node.is_terminal():
+            return
+        self._journal = MatchJournal(journal_path(self._journal_dir, key), match)
+
+    def _close_journal(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _set_agents(self, match: Match, mode: GamePlaySettings) -> None:
+        for pid in (ds.Pid.P1, ds.Pid.P2):
+            # agents are kept when resuming, as search agents learn over the match
+            agent_class = mode.setting_of(pid).agent_class()
+            if _agent_class_of(match.agent(pid)) is not agent_class:
+                match.set_agent(pid, self._new_agent(agent_class))
+
+    @property
+    def tabs(self) -> list[MatchTab]:
+        """
+        The matches open in this session: one per game mode played with
+        `init_game()`, and those opened with `open_tab()`.
+        """
+        return list(self._tabs.values())
+
+    @property
+    def focused_tab(self) -> MatchTab | None:
+        return self._focused_tab
+
+    @_serialized()
+    def open_tab(self, mode: GamePlaySettings) -> int:
+        """
+        Starts a new match under `mode` in a tab of its own and focuses it.
+        Matches where agents play both sides go on in the background while
+        other tabs are focused; they are not saved with `matches`.
+
+        :returns: the id of the tab.
+        """
+        if not mode.local:
+            raise ValueError("Only local matches can be opened in tabs")
+        if len(self._tabs) >= MAX_TABS:
+            for tab in self.tabs:
+                if tab is not self._focused_tab and tab.is_ended():
+                    self._close(tab)
+        if len(self._tabs) >= MAX_TABS:
+            raise ValueError(f"At most {MAX_TABS} matches can be open")
+        self.last_active = time.monotonic()
+        match = self._match_pool.take()
+        self._set_agents(match, mode)
+        tab = MatchTab(next(self._tab_ids), mode, match)
+        self._tabs[tab.tab_id] = tab
+        self._focus(tab)
         self._try_auto_step()
+        return tab.tab_id
+
+    @_serialized()
+    def focus_tab(self, tab_id: int) -> None:
+        """
+        Switches to the match of the tab, only this match notifies listeners.
+        """
+        tab = self._tabs[tab_id]
+        self.last_active = time.monotonic()
+        if tab.key is not None:
+            # resumed from `matches`, as it may have gone to disk meanwhile
+            self.curr_game_mode = tab.mode
+            self.init_game()
+            return
+        self._focus(tab)
+        if not tab.match.curr_node.is_terminal():
+            self._try_auto_step()
+
+    @_serialized()
+    def close_tab(self, tab_id: int) -> None:
+        """
+        Stops and drops the match of a tab other than the focused one.
+        """
+        tab = self._tabs[tab_id]
+        if tab is self._focused_tab:
+            raise ValueError("The focused tab cannot be closed")
+        self._close(tab)
+
+    @_serialized()
+    def close_tabs(self) -> None:
+        """
+        Stops the matches of all tabs, their journal, the connection to a
+        remote match, and the session's actor thread once idle, e.g. when the
+        session ends.
+        """
+        self._close_journal()
+        self._close_remote()
+        self._focus(None)
+        for tab in self.tabs:
+            self._close(tab)
+        self._actor.close()
+
+    def _close(self, tab: MatchTab) -> None:
+        with tab.lock:
+            tab.closed = True
+        del self._tabs[tab.tab_id]
+
+    def _focus(self, tab: MatchTab | None) -> None:
+        old = self._focused_tab
+        if old is tab:
+            return
+        if old is not None:
+            with old.lock:
+                old.focused = False
+            if old.key is not None:
+                # lives on in `matches`, and is resumed from there
+                old.release()
+            elif old.is_autonomous():
+                self._run_tab(old)
+        self._focused_tab = tab
+        # only the match being played is kept from going to disk
+        self.matches.active = None if tab is None else tab.key
+        self._speculator.discard()
+        if tab is None:
+            return
+        with tab.lock:
+            tab.focused = True
+        self.curr_game_mode = tab.mode
+        self.curr_match = tab.match
+
+    def _run_tab(self, tab: MatchTab) -> None:
+        self._tab_runner.schedule(tab, self._advance_tab)
+
+    def _resume_focused_tab(self) -> None:
+        """
+        Lets an autonomous focused match go on once back at its latest state.
+        """
+        tab = self._focused_tab
+        if tab is not None and tab.is_autonomous() and tab.match.is_at_latest():
+            self._run_tab(tab)
+
+    def _advance_tab(self, tab: MatchTab) -> bool:
+        """
+        Takes the next agent action of the tab's match, on the actor if it is
+        the focused match.
+
+        :returns: whether the match can go on.
+        """
+        if tab.focused and not self._actor.on_actor_thread():
+            return self._actor.call(self._advance_tab, tab)
+        with tab.lock:
+            if tab.closed:
+                return False
+            if tab.focused and not self._actor.on_actor_thread():
+                # focused meanwhile, the next slice goes through the actor
+                return True
+            match = tab.match
+            if tab.focused and not match.is_at_latest():
+                # paused while the history is looked at
+                return False
+            node = match.curr_node
+            if node.is_terminal():
+                return False
+            waiting_for = node.latest_state().waiting_for()
+            if waiting_for is None or tab.mode.setting_of(waiting_for).player_type != "E":
+                return False
+            match.agent_action_step(waiting_for)
+            progressed = match.curr_node is not node
+            focused = tab.focused
+        if focused:
+            self.notify_listeners("latest")
+        return progressed
+
+    def _new_agent(self, agent_class: type[ds.PlayerAgent]) -> ds.PlayerAgent:
+        if self._engine_host is not None:
+            return self._engine_host.agent(agent_class)
+        return with_opening_book(agent_class())
+
+    def _init_remote_game(self) -> None:
+        """
+        Joins the match on the server, remote matches live there rather than
+        in `matches`.
+
+        Raises `ConnectionError` if the match cannot be joined in time.
+        """
+        from .remote_match import RemoteMatchClient
+        mode = self.curr_game_mode
+        pid = None if mode.neutral_view else mode.primary_player
+        token_key = None if mode.spectating else _seat_token_key(mode.server, mode.match_id, pid)
+        remote = self._remote
+        joining = remote is None or (remote.url, remote.match_id, remote.pid, remote.spectator) != (
+            mode.server, mode.match_id, pid, mode.spectating
+        )
+        if joining:
+            self._close_remote()
+            self._remote = remote = RemoteMatchClient(
+                mode.server,
+                mode.match_id,
+                pid,
+                on_update=self._on_remote_update,
+                spectator=mode.spectating,
+                token=None if token_key is None else self._load_seat_token(token_key),
+            )
+        if not remote.wait_ready(REMOTE_JOIN_TIMEOUT):
+            self._close_remote()
+            raise ConnectionError(f"Cannot join match {mode.match_id} at {mode.server}")
+        if joining and token_key is not None:
+            self._keep_seat_token(token_key, remote.token)
+        self.curr_match = remote.match
+        self._remote_followed = remote.match.curr_node
+
+    def _load_seat_token(self, key: str) -> str | None:
+        try:
+            token = self._seat_tokens.get(key)
+        except Exception:
+            # e.g. the page went away while it was asked
+            self._logger.warning("Cannot read seat token %s", key, exc_info=True)
+            return None
+        return token if isinstance(token, str) else None
+
+    def _keep_seat_token(self, key: str, token: str | None) -> None:
+        if token is None:
+            return
+        try:
+            self._seat_tokens.set(key, token)
+        except Exception:
+            self._logger.warning("Cannot keep seat token %s", key, exc_info=True)
+
+    def _close_remote(self) -> None:
+        if self._remote is not None:
+            self._remote.close()
+            self._remote = None
+            self._remote_followed = None
+
+    def _on_remote_update(self) -> None:
+        self._actor.submit(self._follow_remote, key="remote")
+
+    def _follow_remote(self) -> None:
+        match = self.curr_match
+        if self._remote is None or match is None or match is not self._remote.match:
+            return
+        # follows the game to its latest node, unless the player has moved
+        # away from where it was last followed to, e.g. back in history
+        node = match.curr_node
+        if node is self._remote_followed and match.curr_state() is node.latest_state():
+            tail = node
+            while tail.children:
+                tail = tail.selected_child()
+            if tail is not node:
+                match.seek(tail.depth)
+                self._remote_followed = tail
+                self.notify_listeners("latest")
+                return
+        self.notify_listeners("history")
+
+    def node_count(self) -> int:
+        """
+        :returns: the number of match nodes held in memory, the measure of the
+                  memory a session uses.
+        """
+        return self.matches.node_count() + sum(
+            tab.match.node_count for tab in self.tabs if tab.key is None
+        )
+
+    @_serialized()
+    def spill(self) -> int:
+        """
+        Moves every match but the current one to disk; they are reloaded when
+        resumed.
+
+        :returns: the number of match nodes released.
+        """
+        released = self.matches.evict()
+        if released:
+            self._logger.info("Spilled matches, %d nodes released", released)
+        return released
+
+    def has_spilled(self) -> bool:
+        return self.matches.on_disk() > 0
+
+    def discard_spill(self) -> None:
+        self.matches.discard()
+
+    @_serialized()
+    def save_matches(self, path: str) -> None:
+        """
+        Writes all matches to `path` in the compact match save format.
+        """
+        from .match_codec import encode_matches
+        data = encode_matches(dict(self.matches))
+        with open(path, "wb") as f:
+            f.write(data)
+
+    @_serialized()
+    def load_matches(self, path: str) -> None:
+        """
+        Restores matches saved by `save_matches()`, replacing the ones of the
+        same game modes.
+        """
+        from .match_codec import decode_matches
+        with open(path, "rb") as f:
+            self.matches.update(decode_matches(f.read()))
 
     def take_action(self, pid: ds.Pid, action: ds.PlayerAction) -> None:
         """
         Execuate action and update the current match node.
+
+        The action is queued on the session's actor and this returns at once,
+        listeners are notified when the match has moved on. If the actor's
+        queue is full, this waits for room instead of dropping the action, as
+        the player's prompt is already gone. An action is only taken at the
+        node it was chosen at, so repeated submissions of it are taken once.
+        """
+        args, key = self._action_command(pid, action)
+        self._actor.submit(self._take_action, *args, key=key, block=True)
+
+    async def take_action_async(self, pid: ds.Pid, action: ds.PlayerAction) -> None:
         """
-        assert self._require_action(pid)
-        print(f"{pid} taking action: {action}")
-        self.curr_match.curr_node.action = action
+        Like `take_action()`, but returns once the action and the agents'
+        replies have been taken.
+        """
+        args, key = self._action_command(pid, action)
+        await self._actor.call_async(self._take_action, *args, key=key)
+
+    def _action_command(
+            self,
+            pid: ds.Pid,
+            action: ds.PlayerAction,
+    ) -> tuple[tuple[ds.Pid, ds.PlayerAction, MatchNode], Hashable | None]:
+        node = self.curr_match.curr_node
+        key: Hashable | None = ("take_action", pid, action, node.depth)
         try:
-            next_state = self.curr_match.curr_node.latest_state().action_step(pid, action)
-            assert next_state is not None
-        except Exception as e:
-            print(e)
+            hash(key)
+        except TypeError:
+            key = None
+        return (pid, action, node), key
+
+    def _take_action(self, pid: ds.Pid, action: ds.PlayerAction, node: MatchNode) -> None:
+        if self.curr_match.curr_node is not node or not self._require_action(pid):
+            # e.g. a double click, the first one already moved the match on
+            self._logger.debug("Dropped stale action %s", action, extra={"pid": pid})
+            return
+        self.last_active = time.monotonic()
+        depth = self.curr_match.curr_node.depth
+        self._logger.debug(
+            "%s taking action: %s", pid, action,
+            extra={"depth": depth, "pid": pid},
+        )
+        if self._remote is not None and not self.curr_game_mode.local:
+            # the server applies it and sends back the resulting state
+            self._remote.send_action(action)
+            return
+        speculation = self._speculator.take(action)
+        try:
+            if speculation is None or not self.curr_match.commit(speculation):
+                self.curr_match.apply_action(pid, action)
+        except Exception:
+            self._logger.warning(
+                "Action %s failed", action,
+                exc_info=True,
+                extra={"depth": depth, "pid": pid},
+            )
             return
-        self.curr_match.new_node(next_state)
         self._try_auto_step()
 
+    @_serialized()
     def surrender(self, pid: ds.Pid) -> None:
-        self.curr_match.new_node(
-            self.curr_match.curr_node.latest_state().factory().f_phase(
-                lambda mode: mode.game_end_phase()
-            ).f_player(
-                pid,
-                lambda p: p.factory().f_characters(
-                    lambda cs: cs.factory().f_characters(
-                        lambda chs: tuple([
-                            char.factory().alive(False).build()
-                            for char in chs
-                        ])
-                    ).build()
-                ).build()
-            ).build()
-        )
+        self.last_active = time.monotonic()
+        self._speculator.discard()
+        if self._remote is not None and not self.curr_game_mode.local:
+            self._remote.surrender()
+            return
+        self.curr_match.surrender(pid)
 
     def _try_auto_step(self) -> None:
+        tab = self._focused_tab
+        if tab is not None and tab.is_autonomous():
+            # played in slices by the tab runner, the actor stays responsive
+            self.notify_listeners("latest")
+            self._run_tab(tab)
+            return
         waiting_for = self.curr_match.curr_node.latest_state().waiting_for()
         assert waiting_for is not None
         player_settings = self.curr_game_mode.setting_of(waiting_for)
@@ -377,6 +1488,15 @@ class GameData:
             self._try_auto_step()
         else:
             self.notify_listeners("latest")
+            # the opponent's reply is worked out while the player is thinking
+            self._speculator.start(
+                self.curr_match,
+                waiting_for,
+                [
+                    pid for pid in (ds.Pid.P1, ds.Pid.P2)
+                    if self.curr_game_mode.setting_of(pid).player_type == "E"
+                ],
+            )
 
     def _require_action(self, perspective: ds.Pid) -> bool:
         return self.curr_match.curr_state().waiting_for() is perspective
@@ -392,28 +1512,152 @@ class GameData:
             return None
         return self.curr_match.curr_node.action  # TODO: perspective
 
+    def state_changes(self, perspective: ds.Pid, whole_action: bool = False) -> LazyDiff | None:
+        """
+        :returns: the changes from the previous state to the current state
+                  (see `Match.previous_state()`), computed as they are read.
+        """
+        before = self.curr_match.previous_state(whole_action)
+        if before is None:
+            return None
+        return self._diff_cache.get(before, self.curr_match.curr_state(), perspective)
+
+    def win_estimate(
+            self,
+            perspective: ds.Pid,
+            on_ready: Callable[[float], None] | None = None,
+    ) -> float | None:
+        """
+        :returns: the estimated chance of `perspective` winning from the
+                  current node, or None while it is computed in the background,
+                  `on_ready` then being called with it from another thread.
+                  Asking about another node drops the session's earlier
+                  requests that haven't started.
+        """
+
+        def for_perspective(p1_estimate: float) -> float:
+            return p1_estimate if perspective is ds.Pid.P1 else 1.0 - p1_estimate
+
+        estimate = self._win_estimator.estimate(
+            self.curr_match.curr_node,
+            None if on_ready is None else lambda p1_estimate: on_ready(for_perspective(p1_estimate)),
+            owner=self,
+        )
+        return None if estimate is None else for_perspective(estimate)
+
     def is_at_latest(self) -> bool:
         return self.curr_match.is_at_latest()
 
+    @_serialized()
     def action_back(self) -> None:
         self.curr_match.action_back()
 
+    @_serialized()
     def action_forward(self) -> None:
         self.curr_match.action_forward()
+        self._resume_focused_tab()
 
+    @_serialized()
     def step_back(self) -> None:
         self.curr_match.step_back()
 
+    @_serialized()
     def step_forward(self) -> None:
         self.curr_match.step_forward()
+        self._resume_focused_tab()
 
     def curr_state_index(self) -> tuple[int, int]:
         return self.curr_match.curr_state_index()
 
+    def history_size(self) -> int:
+        return self.curr_match.line_size()
+
+    def history_position(self) -> int:
+        return self.curr_match.line_position()
+
+    @_serialized(key="seek")
+    def seek(self, depth: int, index: int = -1) -> None:
+        self.curr_match.seek(depth, index)
+        self._resume_focused_tab()
+
+    @_serialized(key="seek")
+    def seek_position(self, position: int) -> None:
+        self.curr_match.seek_position(position)
+        self._resume_focused_tab()
+
+    @_serialized(key="seek")
+    def seek_round(self, round: int) -> None:
+        self.curr_match.seek_round(round)
+        self._resume_focused_tab()
+
+    def branch_index(self) -> tuple[int, int]:
+        return self.curr_match.branch_index()
+
+    @_serialized()
+    def switch_branch(self, offset: int) -> None:
+        self.curr_match.switch_branch(offset)
+
+    @_serialized()
+    def resume_here(self) -> None:
+        """
+        Continues the match from the current history node, the next action
+        starts a new branch and the old line is kept.
+        """
+        match = self.curr_match
+        if not self.curr_game_mode.local:
+            # remote matches only go on from the server's latest state
+            return
+        match.seek(match.curr_node.depth)
+        if match.curr_node.is_terminal():
+            return
+        self._try_auto_step()
+
+    # The async counterparts of the commands, which await the session's actor
+    # instead of blocking a thread on it.
+
+    async def init_game_async(self) -> None:
+        await self._actor.call_async(self.init_game)
+
+    async def surrender_async(self, pid: ds.Pid) -> None:
+        await self._actor.call_async(self.surrender, pid)
+
+    async def action_back_async(self) -> None:
+        await self._actor.call_async(self.action_back)
+
+    async def action_forward_async(self) -> None:
+        await self._actor.call_async(self.action_forward)
+
+    async def step_back_async(self) -> None:
+        await self._actor.call_async(self.step_back)
+
+    async def step_forward_async(self) -> None:
+        await self._actor.call_async(self.step_forward)
+
+    async def seek_async(self, depth: int, index: int = -1) -> None:
+        await self._actor.call_async(self.seek, depth, index, key="seek")
+
+    async def seek_position_async(self, position: int) -> None:
+        await self._actor.call_async(self.seek_position, position, key="seek")
+
+    async def seek_round_async(self, round: int) -> None:
+        await self._actor.call_async(self.seek_round, round, key="seek")
+
+    async def switch_branch_async(self, offset: int) -> None:
+        await self._actor.call_async(self.switch_branch, offset)
+
+    async def resume_here_async(self) -> None:
+        await self._actor.call_async(self.resume_here)
+
     def new_listener(self) -> GameDataListener:
         listener = GameDataListener(self, "latest")
         return listener
 
+    def new_event_stream(self, genre: GameDataGenre = "latest") -> GameDataEvents:
+        """
+        Must be called from the event loop that iterates the stream.
+        """
+        return GameDataEvents(self, genre)
+
     def listener_unsubscribe(self, listener: GameDataListener, genre: GameDataGenre) -> None:
         self.genred_listeners[genre].remove(listener)
 
@@ -425,7 +1669,7 @@ class GameData:
     def notify_listeners(self, genre: GameDataGenre) -> None:
         if genre not in self.genred_listeners:
             return
-        for listener in self.genred_listeners[genre]:
+        for listener in list(self.genred_listeners[genre]):
             listener.on_update()
 
 class GameDataListener:
@@ -444,3 +1688,54 @@ class GameDataListener:
 
     def unsubscribe(self) -> None:
         self._game_data.listener_unsubscribe(self, self._genre)
+
+
+class GameDataEvents:
+    """
+    The updates of a `GameData` as an async stream, for async handlers:
+
+        async for _ in game_data.new_event_stream():
+            await rerender_async()
+
+    Updates arriving while the consumer is still busy with an earlier one are
+    merged into one.
+    """
+
+    def __init__(self, game_data: GameData, genre: GameDataGenre = "latest") -> None:
+        self._loop = asyncio.get_running_loop()
+        self._updated = asyncio.Event()
+        self._closed = False
+        self._listener = GameDataListener(game_data, genre)
+        self._listener.on_update = self._on_update
+
+    def _on_update(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._updated.set)
+        except RuntimeError:
+            # the loop is closed, so nobody is listening anymore
+            self.unsubscribe()
+
+    def set_subscription(self, genre: GameDataGenre) -> None:
+        self._listener.set_subscription(genre)
+
+    def unsubscribe(self) -> None:
+        """
+        Ends the stream.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._listener.unsubscribe()
+        try:
+            self._loop.call_soon_threadsafe(self._updated.set)
+        except RuntimeError:
+            pass
+
+    def __aiter__(self) -> GameDataEvents:
+        return self
+
+    async def __anext__(self) -> None:
+        await self._updated.wait()
+        self._updated.clear()
+        if self._closed:
+            raise StopAsyncIteration
@@ -0,0 +1,153 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Any, MutableMapping
+
+__all__ = [
+    "FIELDS",
+    "StructuredFormatter",
+    "configure_logging",
+    "get_logger",
+    "session_logger",
+]
+
+#: Set this environment variable to configure levels, e.g. "info" or
+#: "warning,game_data=debug,pages.game.play_page=debug". Logger names are
+#: relative to the app package.
+LEVEL_ENV_VAR = "DGISIM_LOG"
+#: Set this environment variable to a non-empty value to write logs from a
+#: background thread instead of the thread that logs.
+QUEUE_ENV_VAR = "DGISIM_LOG_QUEUE"
+
+#: Structured fields that are rendered when passed through `extra=`.
+FIELDS = ("session", "depth", "pid")
+
+_ROOT_NAME = __name__.rpartition(".")[0]
+_listener: logging.handlers.QueueListener | None = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Appends the structured fields a record carries as `key=value` pairs.
+    """
+
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = [
+            f"{field}={getattr(record, field)}"
+            for field in FIELDS
+            if getattr(record, field, None) is not None
+        ]
+        if fields:
+            text = f"{text} [{' '.join(fields)}]"
+        return text
+
+
+class _SessionAdapter(logging.LoggerAdapter):
+    """
+    Adds the session field to every record, while keeping the `extra` given
+    at the call site (which the default adapter discards).
+    """
+
+    def process(self, msg: Any, kwargs: MutableMapping[str, Any]) -> tuple[Any, MutableMapping[str, Any]]:
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    :param name: the `__name__` of the calling module.
+    """
+    return logging.getLogger(name)
+
+
+def session_logger(name: str, session: str | None) -> logging.LoggerAdapter:
+    """
+    :returns: a logger of module `name` that tags every record with `session`.
+    """
+    return _SessionAdapter(logging.getLogger(name), {"session": session})
+
+
+def _parse_levels(spec: str) -> dict[str, int]:
+    levels: dict[str, int] = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, level = part.rpartition("=")
+        full_name = f"{_ROOT_NAME}.{name}" if name else _ROOT_NAME
+        levels[full_name] = logging.getLevelName(level.upper())
+        if not isinstance(levels[full_name], int):
+            raise ValueError(f"Unknown log level in {LEVEL_ENV_VAR}: {part}")
+    return levels
+
+
+def _stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def configure_logging(
+        spec: str | None = None,
+        queued: bool | None = None,
+) -> None:
+    """
+    Sets up the app's loggers, this should be called once at startup.
+
+    :param spec: per-module levels, defaults to the value of `DGISIM_LOG` or "warning".
+    :param queued: whether records are handled by a background thread, defaults
+                   to whether `DGISIM_LOG_QUEUE` is set.
+    """
+    global _listener
+    if spec is None:
+        spec = os.environ.get(LEVEL_ENV_VAR, "warning")
+    if queued is None:
+        queued = bool(os.environ.get(QUEUE_ENV_VAR))
+
+    root = logging.getLogger(_ROOT_NAME)
+    root.setLevel(logging.WARNING)
+    for name, level in _parse_levels(spec).items():
+        logging.getLogger(name).setLevel(level)
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _stop_listener()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter())
+    if queued:
+        records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(records))
+        _listener = logging.handlers.QueueListener(
+            records,
+            stream_handler,
+            respect_handler_level=True,
+        )
+        _listener.start()
+    else:
+        root.addHandler(stream_handler)
+    root.propagate = False
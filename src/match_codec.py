@@ -0,0 +1,561 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import functools
+import pickle
+import zlib
+from dataclasses import fields, is_dataclass
+from enum import Enum
+from typing import Any, Callable, Sequence
+
+import dgisim as ds
+from dgisim import agents as dsa
+from dgisim import card as dscd
+from dgisim import char as dsch
+from dgisim import status as dsst
+from dgisim import summon as dssm
+from dgisim import support as dssp
+
+from .engine import load_engine_pickle
+from .game_data import Match, MatchNode, ReplayError
+
+__all__ = [
+    "DEFAULT_SNAPSHOT_EVERY",
+    "FORMAT_VERSION",
+    "MatchFormatError",
+    "PackedStates",
+    "decode_action",
+    "decode_match",
+    "decode_matches",
+    "encode_action",
+    "encode_match",
+    "encode_matches",
+    "snapshot_match",
+]
+
+"""
+Match save format (all integers are unsigned LEB128 varints):
+
+- header: b"DGSM", format version, dgisim version (length prefixed)
+- body (zlib compressed):
+  - match seed, pre-order index of the current node
+  - every node in pre-order:
+    - seed, has-action flag (+ the action that led to the node), child count,
+      index of the selected child
+    - number of states (0 for a node saved without them), then each state of
+      the node (its intermediate states and its stop state) pickled and zlib
+      compressed, with the pickle of the node's previous state as the zlib
+      dictionary; a node's first state is compressed on its own
+
+Snapshot nodes carry their states: the root, every `snapshot_every`-th depth,
+the current node, and nodes that can't be replayed from their action (e.g.
+surrenders, mirrored remote states). A loaded snapshot is only unpickled
+when first visited, with `load_engine_pickle()`, which only rebuilds engine
+classes. The nodes in between are replayed from their action and seed,
+starting at the nearest snapshot above them.
+
+Replaying is only exact within a process, as dgisim's iteration order over
+some sets depends on the process's hash seed. In another process a replayed
+node may differ from the saved one, or fail to replay, in which case
+navigation skips it. Either way this only holds until the next snapshot.
+
+Nodes of older versions carry fewer states:
+
+- version 2 had a snapshot interval after the seed, and a snapshot flag (+ the
+  pickled first state) instead of the states, only the root, the current
+  node, every snapshot interval-th depth and nodes not reached by an action
+  carried a state;
+- version 1 also stored the action taken at each node instead of the one
+  leading to it, and had no selected child.
+
+Nodes of these versions that fail to replay are skipped when navigating.
+"""
+
+FORMAT_MAGIC = b"DGSM"
+FORMAT_VERSION = 3
+
+#: depths at which `encode_match()` stores states by default
+DEFAULT_SNAPSHOT_EVERY = 16
+
+_MATCHES_MAGIC = b"DGMS"
+
+# The position in these tuples is the on-disk code, so only append to them.
+_CLASSES: tuple[type, ...] = (
+    ds.CardsSelectAction,
+    ds.DiceSelectAction,
+    ds.CharacterSelectAction,
+    ds.EndRoundAction,
+    ds.ElementalTuningAction,
+    ds.CardAction,
+    ds.SkillAction,
+    ds.SwapAction,
+    ds.DeathSwapAction,
+    ds.DiceOnlyInstruction,
+    ds.StaticTargetInstruction,
+    ds.SourceTargetInstruction,
+    ds.StaticTarget,
+)
+_ENUMS: tuple[type[Enum], ...] = (
+    ds.Element,
+    ds.CharacterSkill,
+    ds.Pid,
+    ds.Zone,
+)
+
+_TAG_NONE = 0
+_TAG_INT = 1
+_TAG_ENUM = 2
+_TAG_ITEM = 3
+_TAG_DICE = 4
+_TAG_CARDS = 5
+_TAG_DATACLASS = 6
+_TAG_NAMED_ITEM = 7
+
+
+class MatchFormatError(ValueError):
+    pass
+
+
+class _Writer:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def uint(self, value: int) -> None:
+        assert value >= 0
+        while value > 0x7F:
+            self.buffer.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def int(self, value: int) -> None:
+        self.uint(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def blob(self, data: bytes) -> None:
+        self.uint(len(data))
+        self.buffer += data
+
+
+class _Reader:
+    def __init__(self, data: bytes) -> None:
+        self._data = memoryview(data)
+        self._pos = 0
+
+    @property
+    def offset(self) -> int:
+        return self._pos
+
+    def uint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            if self._pos >= len(self._data):
+                raise MatchFormatError("Unexpected end of data")
+            byte = self._data[self._pos]
+            self._pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def int(self) -> int:
+        value = self.uint()
+        return (value >> 1) ^ -(value & 1)
+
+    def blob(self) -> bytes:
+        size = self.uint()
+        if self._pos + size > len(self._data):
+            raise MatchFormatError("Unexpected end of data")
+        data = bytes(self._data[self._pos:self._pos + size])
+        self._pos += size
+        return data
+
+
+@functools.cache
+def _named_items() -> dict[str, type]:
+    """
+    :returns: the item classes dgisim exports, by module and qualified name,
+              which are the only names an action may refer to.
+    """
+    return {
+        f"{value.__module__}:{value.__qualname__}": value
+        for module in (dscd, dsch, dsst, dssm, dssp)
+        for value in vars(module).values()
+        if isinstance(value, type) and value.__module__.startswith("dgisim.")
+    }
+
+
+def _write_value(w: _Writer, value: Any) -> None:
+    if value is None:
+        w.uint(_TAG_NONE)
+    elif isinstance(value, Enum):
+        w.uint(_TAG_ENUM)
+        w.uint(_ENUMS.index(type(value)))
+        w.int(value.value)
+    elif isinstance(value, int):
+        w.uint(_TAG_INT)
+        w.int(value)
+    elif isinstance(value, type):
+        code = ds.encoding_plan.code_for(value)
+        if code > 0:
+            w.uint(_TAG_ITEM)
+            w.uint(code)
+        else:
+            # not every item has a code in dgisim's encoding plan
+            name = f"{value.__module__}:{value.__qualname__}"
+            if _named_items().get(name) is not value:
+                raise MatchFormatError(f"Cannot encode {value!r}")
+            w.uint(_TAG_NAMED_ITEM)
+            w.blob(name.encode())
+    elif isinstance(value, ds.ActualDice):
+        w.uint(_TAG_DICE)
+        dice = value.to_dict()
+        w.uint(len(dice))
+        for elem, num in dice.items():
+            w.uint(elem.value)
+            w.int(num)
+    elif isinstance(value, ds.Cards):
+        w.uint(_TAG_CARDS)
+        cards = value.to_dict()
+        w.uint(len(cards))
+        for card, num in cards.items():
+            w.uint(ds.encoding_plan.code_for(card))
+            w.int(num)
+    elif is_dataclass(value) and type(value) in _CLASSES:
+        w.uint(_TAG_DATACLASS)
+        w.uint(_CLASSES.index(type(value)))
+        for f in fields(value):
+            _write_value(w, getattr(value, f.name))
+    else:
+        raise MatchFormatError(f"Cannot encode {value!r}")
+
+
+def _read_value(r: _Reader) -> Any:
+    tag = r.uint()
+    if tag == _TAG_NONE:
+        return None
+    elif tag == _TAG_ENUM:
+        return _ENUMS[r.uint()](r.int())
+    elif tag == _TAG_INT:
+        return r.int()
+    elif tag == _TAG_ITEM:
+        item = ds.encoding_plan.type_for(r.uint())
+        if item is None:
+            raise MatchFormatError("Unknown item code")
+        return item
+    elif tag == _TAG_NAMED_ITEM:
+        name = r.blob().decode()
+        item = _named_items().get(name)
+        if item is None:
+            raise MatchFormatError(f"{name} is not an engine item")
+        return item
+    elif tag == _TAG_DICE:
+        return ds.ActualDice(dict(
+            (ds.Element(r.uint()), r.int())
+            for _ in range(r.uint())
+        ))
+    elif tag == _TAG_CARDS:
+        return ds.Cards(dict(
+            (ds.encoding_plan.type_for(r.uint()), r.int())
+            for _ in range(r.uint())
+        ))
+    elif tag == _TAG_DATACLASS:
+        cls = _CLASSES[r.uint()]
+        return cls(**{
+            f.name: _read_value(r)
+            for f in fields(cls)
+        })
+    raise MatchFormatError(f"Unknown value tag {tag}")
+
+
+def encode_action(action: ds.PlayerAction) -> bytes:
+    w = _Writer()
+    _write_value(w, action)
+    return bytes(w.buffer)
+
+
+def decode_action(data: bytes) -> ds.PlayerAction:
+    try:
+        action = _read_value(_Reader(data))
+    except (IndexError, TypeError, ValueError) as e:
+        raise MatchFormatError("Corrupted action") from e
+    if not isinstance(action, ds.PlayerAction):
+        raise MatchFormatError(f"{action!r} is not an action")
+    return action
+
+
+def _compress(data: bytes, previous: bytes | None) -> bytes:
+    if previous is None:
+        compressor = zlib.compressobj(9)
+    else:
+        compressor = zlib.compressobj(9, zdict=previous)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data: bytes, previous: bytes | None) -> bytes:
+    if previous is None:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = zlib.decompressobj(zdict=previous)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class PackedStates:
+    """
+    The states of a node, each pickled and zlib compressed with the pickle of
+    the previous one as the dictionary. Calling it unpacks them, see
+    `MatchNode.packed_states`.
+    """
+
+    __slots__ = ("blobs",)
+
+    def __init__(self, blobs: list[bytes]) -> None:
+        self.blobs = blobs
+
+    @classmethod
+    def pack(cls, states: Sequence[ds.GameState]) -> PackedStates:
+        blobs = []
+        previous = None
+        for state in states:
+            data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+            blobs.append(_compress(data, previous))
+            previous = data
+        return cls(blobs)
+
+    def __call__(self) -> list[ds.GameState]:
+        states = []
+        previous = None
+        for blob in self.blobs:
+            data = _decompress(blob, previous)
+            states.append(load_engine_pickle(data))
+            previous = data
+        return states
+
+
+def _load_state(data: bytes) -> ds.GameState:
+    try:
+        return load_engine_pickle(data)
+    except Exception as e:
+        raise MatchFormatError("Corrupted state in match save") from e
+
+
+def _is_snapshot(node: MatchNode, curr_node: MatchNode, snapshot_every: int) -> bool:
+    if node.parent is None or node is curr_node or node.depth % snapshot_every == 0:
+        return True
+    if node.in_action is None or node.inter_fork or not node.replayable:
+        return True
+    # saved with its states, e.g. as a snapshot at another interval
+    return isinstance(node.packed_states, PackedStates)
+
+
+def _node_states(match: Match, node: MatchNode) -> PackedStates | list[ds.GameState]:
+    """
+    :returns: the states of `node`, none if it can't be replayed.
+    """
+    if isinstance(node.packed_states, PackedStates):
+        # never visited since loaded, so still as saved
+        return node.packed_states
+    try:
+        match.realize(node)
+    except ReplayError:
+        return []
+    return [*node.inter_states, node.stop_state]
+
+
+def snapshot_match(match: Match, snapshot_every: int = DEFAULT_SNAPSHOT_EVERY) -> Callable[[], bytes]:
+    """
+    Collects what the save of `match` needs, realizing its snapshot nodes,
+    and returns the function that encodes it, which can be called later and
+    on another thread as it no longer reads the match.
+
+    :param snapshot_every: the depths at which nodes carry their states, see
+                           the format description.
+    """
+    order: list[MatchNode] = []
+    stack = [match.root_node]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(reversed(node.children))
+    seed = match.seed
+    curr_node = match.curr_node
+    curr_index = order.index(curr_node)
+    nodes = [
+        (
+            node.seed,
+            node.in_action,
+            len(node.children),
+            node.selected,
+            _node_states(match, node) if _is_snapshot(node, curr_node, snapshot_every) else [],
+        )
+        for node in order
+    ]
+
+    def encode() -> bytes:
+        w = _Writer()
+        w.uint(seed)
+        w.uint(curr_index)
+        for node_seed, in_action, num_children, selected, states in nodes:
+            w.uint(node_seed)
+            if in_action is None:
+                w.uint(0)
+            else:
+                w.uint(1)
+                _write_value(w, in_action)
+            w.uint(num_children)
+            w.uint(selected)
+            if not isinstance(states, PackedStates):
+                states = PackedStates.pack(states)
+            w.uint(len(states.blobs))
+            for blob in states.blobs:
+                w.blob(blob)
+
+        header = _Writer()
+        header.buffer += FORMAT_MAGIC
+        header.uint(FORMAT_VERSION)
+        header.blob(ds.__version__.encode())
+        return bytes(header.buffer) + zlib.compress(bytes(w.buffer))
+
+    return encode
+
+
+def encode_match(match: Match, snapshot_every: int = DEFAULT_SNAPSHOT_EVERY) -> bytes:
+    return snapshot_match(match, snapshot_every)()
+
+
+def decode_match(
+        data: bytes,
+        agent1: ds.PlayerAgent = dsa.RandomAgent(),
+        agent2: ds.PlayerAgent = dsa.RandomAgent(),
+) -> Match:
+    if not data.startswith(FORMAT_MAGIC):
+        raise MatchFormatError("Not a match save")
+    header = _Reader(data[len(FORMAT_MAGIC):])
+    version = header.uint()
+    if version not in (1, 2, FORMAT_VERSION):
+        raise MatchFormatError(f"Unsupported format version {version}")
+    engine_version = header.blob().decode()
+    if engine_version != ds.__version__:
+        raise MatchFormatError(
+            f"Saved with dgisim {engine_version}, running {ds.__version__}"
+        )
+    try:
+        body = zlib.decompress(data[len(FORMAT_MAGIC) + header.offset:])
+    except zlib.error as e:
+        raise MatchFormatError("Corrupted match save") from e
+
+    r = _Reader(body)
+    seed = r.uint()
+    if version < 3:
+        r.uint()  # snapshot interval, only needed when writing
+    curr_index = r.uint()
+
+    root: MatchNode | None = None
+    curr: MatchNode | None = None
+    # (parent, number of children still to be read)
+    pending: list[list[Any]] = []
+    outgoing_actions: dict[int, ds.PlayerAction] = {}
+    index = 0
+    while root is None or pending:
+        parent = pending[-1][0] if pending else None
+        node_seed = r.uint()
+        try:
+            action = _read_value(r) if r.uint() else None
+        except (IndexError, TypeError, ValueError) as e:
+            raise MatchFormatError("Corrupted action in match save") from e
+        num_children = r.uint()
+        selected = r.uint() if version >= 2 else 0
+        node = MatchNode(
+            depth=0 if parent is None else parent.depth + 1,
+            parent=parent,
+            selected=selected,
+            seed=node_seed,
+        )
+        if version >= 2:
+            node.in_action = action
+        elif action is not None:
+            # version 1 has the action taken at the node, which led to its only child
+            outgoing_actions[id(node)] = action
+        if version == 1 and parent is not None:
+            node.in_action = outgoing_actions.get(id(parent))
+        if version >= 3:
+            blobs = [r.blob() for _ in range(r.uint())]
+            if blobs:
+                node.packed_states = PackedStates(blobs)
+        elif r.uint():
+            state = _load_state(r.blob())
+            if parent is None and state.waiting_for() is not None:
+                node.stop_state = state
+            else:
+                node.inter_states = [state]
+        if parent is None and node.packed_states is None and not node.inter_states and node.stop_state is None:
+            raise MatchFormatError("Root node has no state")
+
+        if parent is None:
+            root = node
+        else:
+            parent.children.append(node)
+            pending[-1][1] -= 1
+        if index == curr_index:
+            curr = node
+        index += 1
+        if num_children > 0:
+            pending.append([node, num_children])
+        while pending and pending[-1][1] == 0:
+            pending.pop()
+
+    if curr is None:
+        raise MatchFormatError("Current node is missing")
+    return Match.from_tree(root, curr, seed, agent1, agent2)
+
+
+def _encode_mode_key(w: _Writer, key: tuple) -> None:
+    pid, primary, oppo = key
+    w.uint(pid.value)
+    for player_type, random_deck in (primary, oppo):
+        w.blob(player_type.encode())
+        w.uint(int(random_deck))
+
+
+def _decode_mode_key(r: _Reader) -> tuple:
+    pid = ds.Pid(r.uint())
+    primary = (r.blob().decode(), bool(r.uint()))
+    oppo = (r.blob().decode(), bool(r.uint()))
+    return (pid, primary, oppo)
+
+
+def encode_matches(matches: dict[tuple, Match]) -> bytes:
+    """
+    Encodes `GameData.matches`, which is keyed by `GamePlaySettings.as_tuple()`.
+    """
+    w = _Writer()
+    w.buffer += _MATCHES_MAGIC
+    w.uint(len(matches))
+    for key, match in matches.items():
+        _encode_mode_key(w, key)
+        w.blob(encode_match(match))
+    return bytes(w.buffer)
+
+
+def decode_matches(data: bytes) -> dict[tuple, Match]:
+    if not data.startswith(_MATCHES_MAGIC):
+        raise MatchFormatError("Not a matches save")
+    r = _Reader(data[len(_MATCHES_MAGIC):])
+    matches: dict[tuple, Match] = {}
+    for _ in range(r.uint()):
+        key = _decode_mode_key(r)
+        matches[key] = decode_match(r.blob())
+    return matches
@@ -0,0 +1,349 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import hashlib
+import os
+import queue
+import struct
+import threading
+import time
+import weakref
+import zlib
+from typing import TYPE_CHECKING, Callable
+
+import dgisim as ds
+
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from .game_data import Match, MatchNode
+
+__all__ = [
+    "DEFAULT_SYNC_INTERVAL",
+    "MatchJournal",
+    "default_journal_dir",
+    "journal_path",
+    "load_journal",
+]
+
+"""
+Match journal format:
+
+- header: b"DGMJ", format version (u16), dgisim version (u16 length prefixed)
+- base: a match save (see `match_codec`, u32 length prefixed), whose nodes
+  are numbered in pre-order
+- records, one per node added after the base, each a u32 payload length and
+  the crc32 of the payload, followed by the payload:
+  - number of the parent node (u32), seed (u32), flags (u8)
+  - if flagged, the action that led to the node (u16 length prefixed,
+    `match_codec.encode_action()`)
+  - number of states (u16), then each state of the node (u32 length
+    prefixed), packed as in a match save (see `match_codec.PackedStates`)
+
+Records are numbered on from the base. A torn or corrupted record ends the
+journal, so a crash loses at most the records not yet synced. Every node
+carries its states, the base being saved with a snapshot at every node, so a
+resumed match needs no replays.
+"""
+
+_MAGIC = b"DGMJ"
+_VERSION = 2
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_FRAME = struct.Struct("<II")
+_NODE = struct.Struct("<IIB")
+_HAS_ACTION = 1
+
+#: most seconds between a node being added and it being synced to disk
+DEFAULT_SYNC_INTERVAL = 1.0
+
+JOURNAL_ENV_VAR = "DGISIM_JOURNAL_DIR"
+
+_logger = get_logger(__name__)
+
+
+def default_journal_dir() -> str | None:
+    """
+    :returns: the directory in `DGISIM_JOURNAL_DIR`, None if unset, in which
+              case matches are not journaled.
+    """
+    return os.environ.get(JOURNAL_ENV_VAR) or None
+
+
+def journal_path(journal_dir: str, key: tuple) -> str:
+    """
+    :returns: where the match of a game mode key is journaled.
+    """
+    name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return os.path.join(journal_dir, f"{name}.journal")
+
+
+def _preorder(root: MatchNode) -> list[MatchNode]:
+    # the order `encode_match()` stores nodes in
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(reversed(node.children))
+    return order
+
+
+def _header() -> bytes:
+    version = ds.__version__.encode()
+    return _MAGIC + _U16.pack(_VERSION) + _U16.pack(len(version)) + version
+
+
+def _encode_record(parent_id: int, node: MatchNode) -> bytes:
+    from .match_codec import PackedStates, encode_action
+    flags = 0
+    parts = []
+    if node.in_action is not None:
+        flags |= _HAS_ACTION
+        action = encode_action(node.in_action)
+        parts += [_U16.pack(len(action)), action]
+    # nodes are complete when added, and their states never change after
+    states = PackedStates.pack([*node.inter_states, node.stop_state])
+    parts.append(_U16.pack(len(states.blobs)))
+    for blob in states.blobs:
+        parts += [_U32.pack(len(blob)), blob]
+    payload = _NODE.pack(parent_id, node.seed, flags) + b"".join(parts)
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def load_journal(path: str) -> Match:
+    """
+    Rebuilds the journaled match, at the last node journaled.
+
+    Raises `OSError` or `MatchFormatError` if there is no readable journal.
+    """
+    from .game_data import Match, MatchNode
+    from .match_codec import MatchFormatError, PackedStates, decode_action, decode_match
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(_MAGIC):
+        raise MatchFormatError("Not a match journal")
+    offset = len(_MAGIC)
+    try:
+        (version,) = _U16.unpack_from(data, offset)
+        (length,) = _U16.unpack_from(data, offset + 2)
+        engine_version = data[offset + 4:offset + 4 + length].decode()
+        offset += 4 + length
+        (base_length,) = _U32.unpack_from(data, offset)
+        offset += 4
+    except (struct.error, UnicodeDecodeError) as e:
+        raise MatchFormatError("Corrupted match journal") from e
+    if version != _VERSION:
+        raise MatchFormatError(f"Unsupported journal version {version}")
+    if engine_version != ds.__version__:
+        raise MatchFormatError(f"Journaled with dgisim {engine_version}, running {ds.__version__}")
+    base = decode_match(data[offset:offset + base_length])
+    offset += base_length
+    nodes = _preorder(base.root_node)
+    curr = base.curr_node
+    while offset + _FRAME.size <= len(data):
+        length, crc = _FRAME.unpack_from(data, offset)
+        payload = data[offset + _FRAME.size:offset + _FRAME.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            _logger.info("Journal %s ends in a torn record", path)
+            break
+        offset += _FRAME.size + length
+        try:
+            parent_id, seed, flags = _NODE.unpack_from(payload)
+            if parent_id >= len(nodes):
+                raise MatchFormatError(f"Unknown parent node {parent_id}")
+            pos = _NODE.size
+            action = None
+            if flags & _HAS_ACTION:
+                (action_length,) = _U16.unpack_from(payload, pos)
+                action = decode_action(payload[pos + 2:pos + 2 + action_length])
+                pos += 2 + action_length
+            (num_states,) = _U16.unpack_from(payload, pos)
+            pos += 2
+            blobs = []
+            for _ in range(num_states):
+                (blob_length,) = _U32.unpack_from(payload, pos)
+                blobs.append(payload[pos + 4:pos + 4 + blob_length])
+                pos += 4 + blob_length
+        except struct.error as e:
+            raise MatchFormatError("Corrupted journal record") from e
+        parent = nodes[parent_id]
+        node = MatchNode(depth=parent.depth + 1, parent=parent, in_action=action, seed=seed)
+        if blobs:
+            # unpacked when visited, like the nodes of the base
+            node.packed_states = PackedStates(blobs)
+        parent.children.append(node)
+        parent.selected = len(parent.children) - 1
+        nodes.append(node)
+        curr = node
+    return Match.from_tree(base.root_node, curr, base.seed)
+
+
+class MatchJournal:
+    """
+    Appends every node added to a match to a journal file, from a background
+    thread that syncs the file at most every `sync_interval` seconds. Adding
+    nodes only queues them.
+
+    When the match ends, the journal is compacted into a plain save of the
+    match and closed. If writing fails, the journal closes itself.
+    """
+
+    def __init__(self, path: str, match: Match, sync_interval: float = DEFAULT_SYNC_INTERVAL) -> None:
+        """
+        Starts the journal at `path` over with a save of `match`. The save is
+        only collected by the calling thread, it is encoded and written by the
+        journal's thread.
+        """
+        from .match_codec import snapshot_match
+        self.path = path
+        self.match = match
+        self._sync_interval = sync_interval
+        #: node number by id(), with a weak reference to tell reused ids apart
+        self._ids: dict[int, tuple[weakref.ref, int]] = {}
+        for i, node in enumerate(_preorder(match.root_node)):
+            self._ids[id(node)] = (weakref.ref(node), i)
+        self._next_id = len(self._ids)
+        self._queue: queue.SimpleQueue[MatchNode | None] = queue.SimpleQueue()
+        self._closed = False
+        # a journal is resumed by another process, where replays aren't exact
+        encode_base = snapshot_match(match, snapshot_every=1)
+        match.add_node_listener(self._on_new_node)
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(encode_base,),
+            name="match-journal",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _number(self, node: MatchNode) -> int | None:
+        entry = self._ids.get(id(node))
+        if entry is None or entry[0]() is not node:
+            return None
+        return entry[1]
+
+    def _on_new_node(self, node: MatchNode) -> None:
+        if self._closed:
+            return
+        self._queue.put(node)
+
+    @property
+    def closed(self) -> bool:
+        """
+        Whether nodes are no longer journaled, after `close()` or once the
+        match ended.
+        """
+        return self._closed
+
+    def close(self) -> None:
+        """
+        Writes out the queued nodes and stops the journal, leaving the file.
+        """
+        if self._closed:
+            return
+        self._stop()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self, encode_base: Callable[[], bytes]) -> None:
+        try:
+            self._write(encode_base)
+        except Exception:
+            _logger.exception("Journal %s failed, no longer journaling", self.path)
+            self._stop()
+            # nothing will write the queued nodes
+            while not self._queue.empty():
+                self._queue.get_nowait()
+
+    def _stop(self) -> None:
+        self._closed = True
+        try:
+            self.match.remove_node_listener(self._on_new_node)
+        except ValueError:
+            # already stopped by `close()` as the match ended
+            pass
+
+    def _write(self, encode_base: Callable[[], bytes]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # replaces the journal the match may have been resumed from only once
+        # the new one is on disk
+        self._write_base(encode_base())
+        with open(self.path, "ab") as f:
+            ended = False
+            while not ended:
+                node = self._queue.get()
+                batch = [node]
+                deadline = time.monotonic() + self._sync_interval
+                while node is not None and not node.is_terminal():
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        node = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    batch.append(node)
+                records = []
+                for node in batch:
+                    if node is None:
+                        ended = True
+                        break
+                    records.append(self._record(node))
+                    if node.is_terminal():
+                        ended = True
+                        break
+                f.write(b"".join(filter(None, records)))
+                f.flush()
+                os.fsync(f.fileno())
+        if node is not None and node.is_terminal():
+            self._stop()
+            self._compact()
+
+    def _record(self, node: MatchNode) -> bytes | None:
+        parent_id = None if node.parent is None else self._number(node.parent)
+        if parent_id is None:
+            _logger.warning("Node at depth %d has no journaled parent", node.depth)
+            return None
+        self._ids[id(node)] = (weakref.ref(node), self._next_id)
+        self._next_id += 1
+        return _encode_record(parent_id, node)
+
+    def _write_base(self, base: bytes) -> None:
+        """
+        Replaces the journal with one holding only `base`.
+        """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_header() + _U32.pack(len(base)) + base)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _compact(self) -> None:
+        """
+        Rewrites the journal as a base without records, from the journal
+        itself, so the live match is not touched.
+        """
+        from .match_codec import MatchFormatError, encode_match
+        try:
+            base = encode_match(load_journal(self.path), snapshot_every=1)
+        except (OSError, MatchFormatError):
+            _logger.warning("Cannot compact journal %s", self.path, exc_info=True)
+            return
+        self._write_base(base)
+        _logger.info("Compacted journal %s, %d bytes", self.path, len(base))
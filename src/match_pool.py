@@ -0,0 +1,77 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import queue
+import threading
+from typing import Callable, Generic, TypeVar
+
+from .engine import THREADS_AVAILABLE
+from .log import get_logger
+
+__all__ = [
+    "MatchPool",
+]
+
+_T = TypeVar("_T")
+
+_logger = get_logger(__name__)
+
+
+class MatchPool(Generic[_T]):
+    """
+    Keeps a few freshly built matches ready so that starting a game doesn't pay
+    for building the initial state and auto-stepping it to the first decision.
+
+    Matches are built by `factory` on a background thread once `start()` is
+    called. `take()` never waits for the thread, it builds a match in place if
+    the pool happens to be empty, as it always is where threads can't be
+    started.
+    """
+
+    def __init__(self, factory: Callable[[], _T], size: int = 2) -> None:
+        self._factory = factory
+        self._ready: queue.Queue[_T] = queue.Queue(maxsize=size)
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None or not THREADS_AVAILABLE:
+            return
+        self._thread = threading.Thread(
+            target=self._fill,
+            name="match-pool",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def take(self) -> _T:
+        try:
+            return self._ready.get_nowait()
+        except queue.Empty:
+            return self._factory()
+
+    def ready_count(self) -> int:
+        return self._ready.qsize()
+
+    def _fill(self) -> None:
+        while True:
+            try:
+                match = self._factory()
+            except Exception:
+                _logger.exception("Match pool stopped")
+                return
+            # blocks while the pool is full, and resumes as soon as a match is taken
+            self._ready.put(match)
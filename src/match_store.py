@@ -0,0 +1,267 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable, Iterator, MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from .engine import THREADS_AVAILABLE
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from .game_data import Match
+
+__all__ = [
+    "MatchCache",
+]
+
+_logger = get_logger(__name__)
+
+DEFAULT_MAX_MATCHES = 4
+DEFAULT_MAX_NODES = 20_000
+
+
+class MatchCache(MutableMapping):
+    """
+    Matches keyed by `GamePlaySettings.as_tuple()`, of which the least
+    recently used are written to disk once there are more than `max_matches`
+    in memory or they hold more than `max_nodes` nodes. Matches on disk are
+    reloaded when accessed, so callers use this as a plain dict.
+
+    Matches are encoded and written by a background thread, and stay in
+    memory until written, so accessing one meanwhile just keeps it.
+    """
+
+    def __init__(
+            self,
+            max_matches: int = DEFAULT_MAX_MATCHES,
+            max_nodes: int = DEFAULT_MAX_NODES,
+            root: str | None = None,
+    ) -> None:
+        """
+        :param root: the directory under which the cache makes its own; the
+                     system temporary directory if not given.
+        """
+        self._max_matches = max_matches
+        self._max_nodes = max_nodes
+        self._root = root
+        self._dir: str | None = None
+        self._memory: OrderedDict[tuple, Match] = OrderedDict()
+        self._on_disk: dict[tuple, str] = {}
+        #: matches being written, by key, with the write's future
+        self._spilling: dict[tuple, tuple[Match, Future]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+        #: key of the match being played, which is never evicted
+        self.active: tuple | None = None
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key: tuple) -> Match:
+        with self._lock:
+            match = self._memory.get(key)
+            if match is not None:
+                self._memory.move_to_end(key)
+                return match
+            spilling = self._spilling.pop(key, None)
+            if spilling is not None:
+                # the write finds itself superseded and drops its file
+                match = spilling[0]
+                self._memory[key] = match
+                self._evict()
+                return match
+            if key not in self._on_disk:
+                raise KeyError(key)
+            match = self._load(key)
+            self._memory[key] = match
+            self._evict()
+            return match
+
+    def __setitem__(self, key: tuple, match: Match) -> None:
+        with self._lock:
+            self._spilling.pop(key, None)
+            self._drop_file(key)
+            self._memory[key] = match
+            self._memory.move_to_end(key)
+            self._evict()
+
+    def __delitem__(self, key: tuple) -> None:
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            self._memory.pop(key, None)
+            self._spilling.pop(key, None)
+            self._drop_file(key)
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return key in self._memory or key in self._spilling or key in self._on_disk
+
+    def __iter__(self) -> Iterator[tuple]:
+        with self._lock:
+            keys = [*self._memory, *self._spilling, *self._on_disk]
+        return iter(keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._memory) + len(self._spilling) + len(self._on_disk)
+
+    def in_memory(self) -> int:
+        """
+        :returns: the number of matches in memory, counting those being written.
+        """
+        return len(self._memory) + len(self._spilling)
+
+    def on_disk(self) -> int:
+        return len(self._on_disk)
+
+    def node_count(self) -> int:
+        """
+        :returns: the number of nodes of the matches in memory, counting
+                  those being written.
+        """
+        with self._lock:
+            return (
+                sum(match.node_count for match in self._memory.values())
+                + sum(match.node_count for match, _ in self._spilling.values())
+            )
+
+    def evict(self) -> int:
+        """
+        Writes every match but the active one to disk.
+
+        :returns: the number of nodes released once the writes finish.
+        """
+        with self._lock:
+            return sum(self._spill(key) for key in list(self._memory) if key != self.active)
+
+    def flush(self) -> None:
+        """
+        Waits for the matches being written to disk.
+        """
+        with self._lock:
+            futures = [future for _, future in self._spilling.values()]
+        for future in futures:
+            future.result()
+
+    def discard(self) -> None:
+        """
+        Forgets the matches on disk or being written, and removes the cache
+        directory.
+        """
+        with self._lock:
+            self._on_disk.clear()
+            self._spilling.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
+
+    def _evict(self) -> None:
+        nodes = sum(match.node_count for match in self._memory.values())
+        for key in list(self._memory):
+            if len(self._memory) <= self._max_matches and nodes <= self._max_nodes:
+                return
+            if key != self.active:
+                nodes -= self._spill(key)
+
+    def _spill(self, key: tuple) -> int:
+        """
+        Moves the match of `key` out of the matches counted as in memory, and
+        has it written by the background thread. Only collecting what the save
+        needs happens here, as that reads the match.
+        """
+        from .match_codec import snapshot_match
+        match = self._memory.pop(key)
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="dgisim-matches-", dir=self._root)
+            weakref.finalize(self, shutil.rmtree, self._dir, ignore_errors=True)
+        path = os.path.join(self._dir, hashlib.sha1(repr(key).encode()).hexdigest())
+        encode = snapshot_match(match)
+        future: Future = Future()
+        self._spilling[key] = (match, future)
+        if not THREADS_AVAILABLE:
+            self._write(key, future, path, encode)
+            return match.node_count
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="match-cache")
+        self._executor.submit(self._write, key, future, path, encode)
+        return match.node_count
+
+    def _write(self, key: tuple, future: Future, path: str, encode: Callable[[], bytes]) -> None:
+        try:
+            if not self._is_spilling(key, future):
+                return
+            try:
+                with open(path, "wb") as f:
+                    f.write(encode())
+            except (OSError, ValueError):
+                _logger.warning("Cannot write match to %s, keeping it in memory", path, exc_info=True)
+                written = False
+            else:
+                written = True
+            with self._lock:
+                if not self._is_spilling(key, future):
+                    # accessed, replaced or deleted while being written
+                    if written:
+                        _remove(path)
+                    return
+                match, _ = self._spilling.pop(key)
+                if not written:
+                    self._memory[key] = match
+                    self._memory.move_to_end(key, last=False)
+                    return
+                self._on_disk[key] = path
+            _logger.debug("Evicted match %s, %d nodes", key, match.node_count)
+        finally:
+            future.set_result(None)
+
+    def _is_spilling(self, key: tuple, future: Future) -> bool:
+        with self._lock:
+            spilling = self._spilling.get(key)
+            return spilling is not None and spilling[1] is future
+
+    def _load(self, key: tuple) -> Match:
+        from .match_codec import decode_match
+        path = self._on_disk.pop(key)
+        try:
+            with open(path, "rb") as f:
+                return decode_match(f.read())
+        except (OSError, ValueError):
+            _logger.warning("Cannot reload match from %s, dropping it", path, exc_info=True)
+            raise KeyError(key)
+        finally:
+            _remove(path)
+
+    def _drop_file(self, key: tuple) -> None:
+        path = self._on_disk.pop(key, None)
+        if path is not None:
+            _remove(path)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,133 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable
+
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from .game_data import GamePlaySettings, Match
+
+__all__ = [
+    "DEFAULT_TIME_SLICE",
+    "MatchTab",
+    "TabRunner",
+]
+
+_logger = get_logger(__name__)
+
+#: seconds of agent steps a match runs before the next one gets a turn
+DEFAULT_TIME_SLICE = 0.5
+
+
+@dataclass(eq=False)
+class MatchTab:
+    """
+    A match open in a session, focused or running in the background.
+    """
+    tab_id: int
+    mode: GamePlaySettings
+    #: None while a tab kept in `GameData.matches` is not focused, so that
+    #: the match can go to disk; it is resumed from there when focused
+    match: Match | None
+    #: the key of the match in `GameData.matches`, None if it is not kept there
+    key: tuple | None = None
+    #: how the match stood when its tab last held it
+    last_status: str = ""
+    focused: bool = False
+    closed: bool = False
+    #: held while the match is changed
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    #: whether a slice of the match is queued or running on the runner
+    scheduled: bool = False
+
+    def is_autonomous(self) -> bool:
+        """
+        :returns: whether agents play both sides, so the match can go on
+                  without anyone watching.
+        """
+        return all(
+            settings.player_type == "E"
+            for settings in (self.mode.primary_settings, self.mode.oppo_settings)
+        )
+
+    def is_ended(self) -> bool:
+        return self.match is not None and self.match.curr_node.is_terminal()
+
+    def release(self) -> None:
+        """
+        Lets go of the match of a tab kept in `GameData.matches`.
+        """
+        assert self.key is not None
+        self.last_status = self._status()
+        self.match = None
+
+    def title(self) -> str:
+        kind = "EVE" if self.is_autonomous() else "PVE" if any(
+            settings.player_type == "E"
+            for settings in (self.mode.primary_settings, self.mode.oppo_settings)
+        ) else "PVP"
+        return f"{self.tab_id}: {kind}, {self._status()}"
+
+    def _status(self) -> str:
+        if self.match is None:
+            return self.last_status
+        if self.match.curr_node.is_terminal():
+            return "ended"
+        return f"round {self.match.latest_state().round}"
+
+
+class TabRunner:
+    """
+    Advances autonomous matches on a few worker threads, one time slice at a
+    time, so matches take turns and one long game can't hold up the rest.
+    """
+
+    def __init__(self, max_workers: int = 2, time_slice: float = DEFAULT_TIME_SLICE) -> None:
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="match-tab")
+        self._time_slice = time_slice
+        self._lock = threading.Lock()
+
+    def schedule(self, tab: MatchTab, step: Callable[[MatchTab], bool]) -> None:
+        """
+        Runs `step(tab)` until it returns False, unless it is already running.
+        """
+        with self._lock:
+            if tab.scheduled or tab.closed:
+                return
+            tab.scheduled = True
+        self._executor.submit(self._run_slice, tab, step)
+
+    def _run_slice(self, tab: MatchTab, step: Callable[[MatchTab], bool]) -> None:
+        deadline = time.monotonic() + self._time_slice
+        more = True
+        try:
+            while more and time.monotonic() < deadline:
+                more = step(tab)
+        except Exception:
+            _logger.warning("Match tab %d stopped", tab.tab_id, exc_info=True)
+            more = False
+        finally:
+            with self._lock:
+                tab.scheduled = False
+        if more:
+            # back of the queue, behind the other matches
+            self.schedule(tab, step)
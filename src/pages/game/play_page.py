@@ -16,6 +16,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
 from collections import defaultdict, Counter
+from itertools import islice
 from math import pi
 from typing import Any, Callable, cast
 
@@ -31,13 +32,21 @@ from qlet import QItem, QAnchor, QAlign, QImage, QText
 from ...components.wip import WIP
 from ...components.centre import make_centre
 from ...context import AppContext, GamePlaySettings, PlayerSettings
+from ...log import get_logger
 from ...routes import Route
 from ..base import QPage
 
+_logger = get_logger(__name__)
+
+#: number of state changes listed in the history overlay
+_MAX_SHOWN_CHANGES = 12
+
 
 class GamePlayPage(QPage):
     def pre_removal(self) -> None:
         self._listener.unsubscribe()
+        self._win_bar_token = None
+        self._history_token = None
 
     def _swap_view(self, _: ft.ControlEvent) -> None:
         self._home_pid = self._home_pid.other()
@@ -105,11 +114,15 @@ class GamePlayPage(QPage):
             style=self._context.settings.button_style,
         )
 
-        self._home_pid = ds.Pid.P1
+        self._home_pid = context.game_data.curr_game_mode.primary_player
         self._base_act_gen: ds.ActionGenerator | None = None
         self._act_gen: list[ds.ActionGenerator] = []
         self._listener = self._context.game_data.new_listener()
         self._in_history = False
+        # identifies the latest win bar, so late estimates for old ones are dropped
+        self._win_bar_token: object | None = None
+        # likewise for the history overlay
+        self._history_token: object | None = None
 
         def on_update() -> None:
             self.rerender()
@@ -141,6 +154,7 @@ class GamePlayPage(QPage):
         game_mode = self._context.game_data.curr_game_mode
         if (
                 self._curr_state.waiting_for() is self._home_pid
+                and not game_mode.spectating
                 and (
                     self._home_pid is game_mode.primary_player
                     or (
@@ -202,6 +216,7 @@ class GamePlayPage(QPage):
             self._support_summon_zone(0.665, 0.09, self._home_pid, game_state),
             self._card_zone(0.765, 0.22, self._home_pid, game_state),
             self._end_round(self._home_pid, game_state),
+            self._win_bar(),
         ))
 
     def render_prompt_action(self) -> None:
@@ -264,11 +279,14 @@ class GamePlayPage(QPage):
                 elif issubclass(choices[0], ds.Card):
                     self._show_select_card()
                 else:
-                    print("choices:", choices)
-                    print("len actions:", len(self._act_gen))
-                    print("action type:", type(self._act_gen[-1].action))
+                    _logger.warning(
+                        "Unhandled choices: %s, len actions: %d, action type: %s",
+                        choices,
+                        len(self._act_gen),
+                        type(self._act_gen[-1].action),
+                    )
             else:
-                print("choices:", choices)
+                _logger.warning("Unhandled choices: %s", choices)
 
     def _prompt_layer_bg(self) -> tuple[QItem, QItem]:
         reveal = QItem(
@@ -359,7 +377,7 @@ class GamePlayPage(QPage):
                 )
             )
 
-        if (
+        if not self._context.game_data.curr_game_mode.spectating and (
                 self._home_pid is self._context.game_data.curr_game_mode.primary_player
                 or (
                     self._context.game_data.curr_game_mode.local
@@ -380,6 +398,28 @@ class GamePlayPage(QPage):
                 )
             )
 
+        game_data = self._context.game_data
+        for tab in game_data.tabs:
+            if tab is game_data.focused_tab:
+                continue
+
+            def focus(_: ft.ControlEvent, tab_id: int = tab.tab_id) -> None:
+                self._context.game_data.focus_tab(tab_id)
+                self._home_pid = self._context.game_data.curr_game_mode.primary_player
+                self._in_history = False
+                self._prompt_action_layer.clear()
+                self.rerender()
+                self.root_component.update()
+
+            buttons_col.controls.append(
+                ft.TextButton(
+                    text=tab.title(),
+                    icon=ft.icons.TAB,
+                    on_click=focus,
+                    style=self._context.settings.button_style,
+                )
+            )
+
         self._prompt_action_layer.root_component.update()
 
     def _show_history(self, _: ft.ControlEvent) -> None:
@@ -392,7 +432,7 @@ class GamePlayPage(QPage):
             self._prompt_action_layer.clear()
             self._prompt_action_layer.root_component.update()
             if self._context.game_data.is_at_latest():
-                print("======== is at latest")
+                _logger.debug("history closed at latest state")
                 self._in_history = False
                 self.rerender()
                 self.root_component.update()
@@ -411,10 +451,33 @@ class GamePlayPage(QPage):
             f"Round: {self._curr_state.round}",
             f"Phase: {self._curr_state.phase.__class__.__name__}",
         ]
+        token = self._history_token = object()
+
+        def on_ready(_: float) -> None:
+            # called from the estimator's thread, shown if still looked at
+            if self._history_token is token and self._in_history:
+                self._show_history(None)
+
+        estimate = self._context.game_data.win_estimate(self._home_pid, on_ready)
+        contents.append(
+            "Win estimate: " + ("pending" if estimate is None else f"{estimate:.0%}")
+        )
+        branch_index, num_branches = self._context.game_data.branch_index()
+        if num_branches > 1:
+            contents.append(f"Branch: {branch_index + 1}/{num_branches}")
         action_taken = self._context.game_data.action_taken_at_curr(self._home_pid)
         if action_taken is not None:
             contents.append(f"Action from: {self._curr_state.waiting_for().name}")
             contents.append(f"Action: {action_taken}")
+        changes = self._context.game_data.state_changes(self._home_pid)
+        if changes is not None:
+            # only as many changes as are shown get computed
+            shown = list(islice(changes, _MAX_SHOWN_CHANGES + 1))
+            if shown:
+                contents.append("Changes:")
+                contents.extend(f"  {change}" for change in shown[:_MAX_SHOWN_CHANGES])
+            if len(shown) > _MAX_SHOWN_CHANGES:
+                contents.append("  ...")
         text_content = '\n'.join(contents)
 
         background.add_children(
@@ -442,6 +505,32 @@ class GamePlayPage(QPage):
             ),
         ))
 
+        def seek(e: ft.ControlEvent) -> None:
+            self._context.game_data.seek_position(int(float(e.data)))
+            self.rerender()
+            self.root_component.update()
+
+        history_size = self._context.game_data.history_size()
+        background.add_children((
+            QItem(
+                width_pct=1.0,
+                height_pct=0.1,
+                anchor=QAnchor(left=0.0, bottom=0.9),
+                flets=(
+                    ft.Slider(
+                        min=0,
+                        max=max(1, history_size - 1),
+                        divisions=max(1, history_size - 1),
+                        value=self._context.game_data.history_position(),
+                        active_color=self._context.settings.theme_colour_light,
+                        # only the state the slider is released at gets rendered
+                        on_change_end=seek,
+                        expand=True,
+                    ),
+                )
+            ),
+        ))
+
         def action_back(_: ft.ControlEvent) -> None:
             self._context.game_data.action_back()
             self.rerender()
@@ -462,6 +551,21 @@ class GamePlayPage(QPage):
             self.rerender()
             self.root_component.update()
 
+        def switch_branch(offset: int) -> Callable[[ft.ControlEvent], None]:
+            def f(_: ft.ControlEvent) -> None:
+                self._context.game_data.switch_branch(offset)
+                self.rerender()
+                self.root_component.update()
+            return f
+
+        def resume(_: ft.ControlEvent) -> None:
+            _logger.debug("resuming play from history")
+            self._prompt_action_layer.clear()
+            self._in_history = False
+            self._context.game_data.resume_here()
+            self.rerender()
+            self.root_component.update()
+
         control_row.controls.append(
             ft.IconButton(
                 icon=ft.icons.KEYBOARD_DOUBLE_ARROW_LEFT,
@@ -490,6 +594,28 @@ class GamePlayPage(QPage):
                 style=self._context.settings.button_style,
             )
         )
+        if num_branches > 1:
+            control_row.controls.append(
+                ft.IconButton(
+                    icon=ft.icons.KEYBOARD_ARROW_UP,
+                    on_click=switch_branch(-1),
+                    style=self._context.settings.button_style,
+                )
+            )
+            control_row.controls.append(
+                ft.IconButton(
+                    icon=ft.icons.KEYBOARD_ARROW_DOWN,
+                    on_click=switch_branch(1),
+                    style=self._context.settings.button_style,
+                )
+            )
+        control_row.controls.append(
+            ft.IconButton(
+                icon=ft.icons.PLAY_ARROW,
+                on_click=resume,
+                style=self._context.settings.button_style,
+            )
+        )
 
         self.root_component.update()
 
@@ -1290,7 +1416,7 @@ class GamePlayPage(QPage):
                 name = support_target.__class__.__name__
                 src_addr = f"assets/cards/{name.removesuffix('Support') + 'Card'}.png"
             else:
-                print(f"ERROR: {target.zone} not catched")
+                _logger.error("%s not catched", target.zone)
                 continue
             target_row.controls.append(
                 QItem(
@@ -2217,6 +2343,39 @@ class GamePlayPage(QPage):
             ))
         return item
 
+    def _win_bar(self) -> QItem:
+        bar = ft.ProgressBar(
+            value=None,
+            color=self._context.settings.theme_colour_light,
+            bgcolor=ft.colors.with_opacity(0.3, "#FFFFFF"),
+            expand=True,
+        )
+        label = ft.Text("...", color="#FFFFFF", size=12)
+        row = ft.Row(controls=[label, bar], expand=True)
+        token = self._win_bar_token = object()
+
+        def show(estimate: float) -> None:
+            bar.value = estimate
+            label.value = f"{estimate:.0%}"
+
+        def on_ready(estimate: float) -> None:
+            # called from the estimator's thread, possibly after a rerender
+            if self._win_bar_token is not token:
+                return
+            show(estimate)
+            row.update()
+
+        # an indeterminate bar shows the estimate is pending
+        estimate = self._context.game_data.win_estimate(self._home_pid, on_ready)
+        if estimate is not None:
+            show(estimate)
+        return QItem(
+            height_pct=0.03,
+            width_pct=0.16,
+            align=QAlign(x_pct=0.1, y_pct=0.43),
+            flets=(row,),
+        )
+
     def _end_round(
             self,
             pid: ds.Pid,
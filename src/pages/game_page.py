@@ -15,6 +15,7 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
+import os
 from typing import Any
 
 import flet as ft
@@ -27,6 +28,11 @@ from ..context import AppContext, GamePlaySettings
 from ..routes import Route
 from .base import QPage
 
+#: Set this environment variable to the URL of the match server to suggest.
+MATCH_SERVER_ENV_VAR = "DGISIM_MATCH_SERVER"
+
+_NEUTRAL_SEAT = "Neutral (watch only)"
+
 
 class GamePage(QPage):
     def post_init(self, context: AppContext) -> None:
@@ -49,12 +55,18 @@ class GamePage(QPage):
                 on_click=self.goto_random_local_PVP,
                 style=context.settings.button_style,
             ),
-            # ft.ElevatedButton(
-            #     text="Random EVE",
-            #     col=button_col,
-            #     on_click=self.goto_random_EVE,
-            #     style=context.settings.button_style,
-            # ),
+            ft.ElevatedButton(
+                text="Online PVP",
+                col=button_col,
+                on_click=self.show_remote_PVP,
+                style=context.settings.button_style,
+            ),
+            ft.ElevatedButton(
+                text="Random EVE",
+                col=button_col,
+                on_click=self.goto_random_EVE,
+                style=context.settings.button_style,
+            ),
             # ft.ElevatedButton(
             #     text="WIP",
             #     col=button_col,
@@ -81,7 +93,59 @@ class GamePage(QPage):
         self._context.game_data.init_game()
         self._context.current_route = Route.GAME_PLAY
 
+    def show_remote_PVP(self, _: Any) -> None:
+        page = self._context.page
+        server = ft.TextField(label="Server", value=os.environ.get(MATCH_SERVER_ENV_VAR, "ws://127.0.0.1:8765"))
+        match_id = ft.TextField(label="Match", value="1")
+        seat = ft.Dropdown(
+            label="Seat",
+            value=dgisim.Pid.P1.name,
+            options=[
+                *(ft.dropdown.Option(pid.name) for pid in (dgisim.Pid.P1, dgisim.Pid.P2)),
+                ft.dropdown.Option(_NEUTRAL_SEAT),
+            ],
+        )
+
+        def join(e: ft.ControlEvent) -> None:
+            watch = e.control.data == "watch"
+            if not watch and seat.value == _NEUTRAL_SEAT:
+                page.show_snack_bar(ft.SnackBar(ft.Text("Pick a seat to play")))
+                return
+            page.dialog.open = False
+            page.update()
+            if watch:
+                self._context.game_mode = GamePlaySettings.from_remote_watch(
+                    server.value,
+                    match_id.value,
+                    None if seat.value == _NEUTRAL_SEAT else dgisim.Pid[seat.value],
+                )
+            else:
+                self._context.game_mode = GamePlaySettings.from_remote_PVP(
+                    server.value, match_id.value, dgisim.Pid[seat.value],
+                )
+            try:
+                self._context.game_data.init_game()
+            except ConnectionError as e:
+                page.show_snack_bar(ft.SnackBar(ft.Text(str(e))))
+                return
+            self._context.current_route = Route.GAME_PLAY
+
+        page.dialog = ft.AlertDialog(
+            title=ft.Text("Online PVP"),
+            content=ft.Column([server, match_id, seat], tight=True),
+            actions=[
+                ft.TextButton("Watch", on_click=join, data="watch"),
+                ft.TextButton("Join", on_click=join, data="join"),
+            ],
+            open=True,
+        )
+        page.update()
+
     def goto_random_EVE(self, _: Any) -> None:
-        self._context.game_mode = GamePlaySettings.from_random_EVE()
-        self._context.game_data.init_game()
+        # in a tab of its own, so it plays on in the background when left
+        try:
+            self._context.game_data.open_tab(GamePlaySettings.from_random_EVE())
+        except ValueError as e:
+            self._context.page.show_snack_bar(ft.SnackBar(ft.Text(str(e))))
+            return
         self._context.current_route = Route.GAME_PLAY
@@ -0,0 +1,664 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import argparse
+import json
+import pickle
+import queue
+import secrets
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import dgisim as ds
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.client import connect
+from websockets.sync.server import ServerConnection, serve
+
+from .engine import load_engine_pickle
+from .game_data import Match, MatchNode
+from .log import configure_logging, get_logger
+
+__all__ = [
+    "MatchServer",
+    "RemoteMatchClient",
+    "ViewDecoder",
+    "ViewEncoder",
+]
+
+_logger = get_logger(__name__)
+
+"""
+Protocol: every message is a binary frame of a JSON header, a zero byte and
+an optional payload.
+
+- client -> server
+  - {"type": "join", "match": id, "pid": 1 | 2, "token": str | null, "known": n}
+    takes (or with the seat's token, retakes) a seat; the server then sends
+    the states of the current line from depth `known` on
+  - {"type": "action", "depth": d} + encoded action, valid only when the
+    match is at depth `d`, so duplicates and stale submissions are dropped
+  - {"type": "surrender"}
+  - {"type": "watch", "match": id, "perspective": 1 | 2 | null} spectates
+    the view of a player, or with both players' secrets hidden
+- server -> client
+  - {"type": "joined", "pid": 1 | 2, "token": str}
+  - {"type": "state", "depth": d, "action": n, "key": bool} + n bytes of
+    encoded action + `ViewEncoder` payload of the perspective view; a key
+    state is compressed on its own, it restarts the decoder's chain
+  - {"type": "error", "message": str}
+"""
+
+DEFAULT_PORT = 8765
+
+#: payloads are zlib-compressed already
+_COMPRESSION = None
+#: a room nobody is connected to is dropped after this many seconds
+DEFAULT_ROOM_TTL = 600.0
+_RECONNECT_DELAYS = (0.5, 1.0, 2.0, 5.0)
+
+
+def _pack(header: dict[str, Any], *payloads: bytes) -> bytes:
+    return json.dumps(header, separators=(",", ":")).encode() + b"\0" + b"".join(payloads)
+
+
+def _unpack(message: bytes | str) -> tuple[dict[str, Any], bytes]:
+    if isinstance(message, str):
+        message = message.encode()
+    header, _, payload = message.partition(b"\0")
+    parsed = json.loads(header)
+    if not isinstance(parsed, dict):
+        raise ValueError(f"Header is a {type(parsed).__name__}")
+    return parsed, payload
+
+
+def _compress(data: bytes, previous: bytes | None) -> bytes:
+    if previous is None:
+        compressor = zlib.compressobj(9)
+    else:
+        compressor = zlib.compressobj(9, zdict=previous)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _neutral_view(state: ds.GameState) -> ds.GameState:
+    return state.prespective_view(ds.Pid.P1).prespective_view(ds.Pid.P2)
+
+
+class ViewEncoder:
+    """
+    Encodes a stream of states, each compressed with the previous one as the
+    zlib dictionary, so a state costs about the size of its change.
+    """
+
+    def __init__(self) -> None:
+        self._previous: bytes | None = None
+
+    def encode(self, state: ds.GameState) -> bytes:
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        payload = _compress(data, self._previous)
+        self._previous = data
+        return payload
+
+    def reset(self) -> None:
+        self._previous = None
+
+
+class ViewDecoder:
+    """
+    Decodes what a `ViewEncoder` wrote, in the same order.
+    """
+
+    def __init__(self) -> None:
+        self._previous: bytes | None = None
+
+    def decode(self, payload: bytes) -> ds.GameState:
+        if self._previous is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=self._previous)
+        data = decompressor.decompress(payload) + decompressor.flush()
+        self._previous = data
+        # a peer can't make the client run code, see `load_engine_pickle()`
+        state = load_engine_pickle(data)
+        if not isinstance(state, ds.GameState):
+            raise pickle.UnpicklingError(f"{type(state).__name__} is not a game state")
+        return state
+
+    def reset(self) -> None:
+        self._previous = None
+
+
+def _encode_action(action: ds.PlayerAction | None) -> bytes:
+    from .match_codec import encode_action
+    return b"" if action is None else encode_action(action)
+
+
+def _line(match: Match) -> list[MatchNode]:
+    nodes: list[MatchNode] = []
+    node: MatchNode | None = match.root_node
+    while node is not None:
+        nodes.append(node)
+        node = node.selected_child()
+    return nodes
+
+
+class _Seat:
+    """
+    Messages are queued under the room's lock, in order, and sent from the
+    seat's own thread, so a slow or dead connection holds up no one else.
+    """
+
+    def __init__(self, pid: ds.Pid, token: str) -> None:
+        self.pid = pid
+        self.token = token
+        self.connection: ServerConnection | None = None
+        self.encoder = ViewEncoder()
+        #: None stops the seat's thread
+        self._outbox: queue.SimpleQueue[tuple[ServerConnection, bytes] | None] = queue.SimpleQueue()
+        threading.Thread(target=self._write, name=f"match-seat-{pid.name}", daemon=True).start()
+
+    def send(self, message: bytes) -> None:
+        if self.connection is not None:
+            self._outbox.put((self.connection, message))
+
+    def send_nodes(self, nodes: list[MatchNode]) -> None:
+        if self.connection is None:
+            return
+        for node in nodes:
+            action = _encode_action(node.in_action)
+            view = self.encoder.encode(node.latest_state().prespective_view(self.pid))
+            header = {"type": "state", "depth": node.depth, "action": len(action)}
+            self.send(_pack(header, action, view))
+
+    def close(self) -> None:
+        self.connection = None
+        self._outbox.put(None)
+
+    def _write(self) -> None:
+        while (item := self._outbox.get()) is not None:
+            connection, message = item
+            # messages for a replaced connection are sent again on rejoining
+            if connection is not self.connection:
+                continue
+            try:
+                connection.send(message)
+            except ConnectionClosed:
+                pass
+
+
+@dataclass(frozen=True)
+class _Frame:
+    depth: int
+    #: the state compressed on its own
+    key_message: bytes
+    #: the state compressed against the previous frame, None for the first
+    delta_message: bytes | None
+
+
+class _Spectator:
+    """
+    Sends the latest frame from its own thread. A frame offered while one is
+    pending replaces it, so a slow spectator skips to the latest state.
+    """
+
+    def __init__(self, connection: ServerConnection) -> None:
+        self._connection = connection
+        self._pending: _Frame | None = None
+        self._sent_depth: int | None = None
+        self._closed = False
+        self._cond = threading.Condition()
+        threading.Thread(target=self._write, name="match-spectator", daemon=True).start()
+
+    def offer(self, frame: _Frame) -> None:
+        with self._cond:
+            self._pending = frame
+            self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _write(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or self._closed)
+                if self._closed:
+                    return
+                frame, self._pending = self._pending, None
+            in_sync = frame.delta_message is not None and self._sent_depth == frame.depth - 1
+            try:
+                self._connection.send(frame.delta_message if in_sync else frame.key_message)
+            except ConnectionClosed:
+                return
+            self._sent_depth = frame.depth
+
+
+class _Feed:
+    """
+    The states of a match as seen from one perspective, encoded once per node
+    for all of its spectators.
+    """
+
+    def __init__(self, perspective: ds.Pid | None) -> None:
+        self.perspective = perspective
+        self.spectators: set[_Spectator] = set()
+        self.latest: _Frame | None = None
+        self._previous: bytes | None = None
+
+    def publish(self, node: MatchNode) -> None:
+        if not self.spectators:
+            # nobody could decode a delta against a frame nobody received
+            self.latest = None
+            self._previous = None
+            return
+        state = node.latest_state()
+        view = _neutral_view(state) if self.perspective is None else state.prespective_view(self.perspective)
+        data = pickle.dumps(view, protocol=pickle.HIGHEST_PROTOCOL)
+        action = _encode_action(node.in_action)
+
+        def message(key: bool) -> bytes:
+            header = {"type": "state", "depth": node.depth, "action": len(action), "key": key}
+            return _pack(header, action, _compress(data, None if key else self._previous))
+
+        self.latest = _Frame(
+            depth=node.depth,
+            key_message=message(True),
+            delta_message=None if self._previous is None else message(False),
+        )
+        self._previous = data
+        for spectator in self.spectators:
+            spectator.offer(self.latest)
+
+
+class _Room:
+    def __init__(self, match: Match) -> None:
+        self.match = match
+        self.seats: dict[ds.Pid, _Seat] = {}
+        self.feeds: dict[ds.Pid | None, _Feed] = {}
+        self.lock = threading.Lock()
+        #: connections in the room, guarded by the server's lock
+        self.connections = 0
+        #: when the last connection left, None while there are connections
+        self.idle_since: float | None = None
+        match.add_node_listener(self._on_new_node)
+
+    def _on_new_node(self, node: MatchNode) -> None:
+        # called under the room's lock, as the match only changes under it
+        for seat in self.seats.values():
+            seat.send_nodes([node])
+        for feed in self.feeds.values():
+            feed.publish(node)
+
+    def watch(self, connection: ServerConnection, perspective: ds.Pid | None) -> _Spectator:
+        spectator = _Spectator(connection)
+        with self.lock:
+            feed = self.feeds.get(perspective)
+            if feed is None:
+                feed = self.feeds[perspective] = _Feed(perspective)
+            feed.spectators.add(spectator)
+            if feed.latest is None:
+                feed.publish(self.match.curr_node)
+            else:
+                spectator.offer(feed.latest)
+        return spectator
+
+    def unwatch(self, spectator: _Spectator) -> None:
+        spectator.close()
+        with self.lock:
+            for feed in self.feeds.values():
+                feed.spectators.discard(spectator)
+
+    def close(self) -> None:
+        self.match.remove_node_listener(self._on_new_node)
+        with self.lock:
+            for seat in self.seats.values():
+                seat.close()
+
+
+class MatchServer:
+    """
+    Owns the authoritative matches of remote games, keyed by a match id.
+    Players send actions and get back the perspective view of every node.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, room_ttl: float = DEFAULT_ROOM_TTL) -> None:
+        """
+        :param port: 0 picks a free port, see `url`.
+        :param room_ttl: seconds a match is kept once nobody is connected to
+                         it, for players to reconnect.
+        """
+        self._host = host
+        self._port = port
+        self._room_ttl = room_ttl
+        self._rooms: dict[str, _Room] = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._stopped = threading.Event()
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None
+        host, port = self._server.socket.getsockname()[:2]
+        return f"ws://{host}:{port}"
+
+    def start(self) -> None:
+        """
+        Serves from a background thread.
+        """
+        if self._server is not None:
+            return
+        self._server = serve(self._handle, self._host, self._port, compression=_COMPRESSION)
+        self._stopped.clear()
+        threading.Thread(target=self._server.serve_forever, name="match-server", daemon=True).start()
+        threading.Thread(target=self._reap, name="match-server-reaper", daemon=True).start()
+        _logger.info("Match server at %s", self.url)
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._stopped.set()
+            self._server.shutdown()
+            self._server = None
+
+    def match(self, match_id: str) -> Match | None:
+        room = self._rooms.get(match_id)
+        return None if room is None else room.match
+
+    def _enter(self, match_id: str) -> _Room:
+        """
+        Counts a connection into the room of `match_id`, creating it if needed.
+        Each call is paired with a `_leave()`.
+        """
+        with self._lock:
+            room = self._rooms.get(match_id)
+            if room is None:
+                room = self._rooms[match_id] = _Room(Match())
+                _logger.info("Match %s created", match_id)
+            room.connections += 1
+            room.idle_since = None
+            return room
+
+    def _leave(self, room: _Room) -> None:
+        with self._lock:
+            room.connections -= 1
+            if room.connections == 0:
+                room.idle_since = time.monotonic()
+
+    def _reap(self) -> None:
+        """
+        Drops the rooms nobody has been connected to for `room_ttl` seconds,
+        stopping their seats' threads.
+        """
+        while not self._stopped.wait(min(60.0, self._room_ttl)):
+            now = time.monotonic()
+            with self._lock:
+                idle = {
+                    match_id: room
+                    for match_id, room in self._rooms.items()
+                    if room.idle_since is not None and now - room.idle_since >= self._room_ttl
+                }
+                for match_id in idle:
+                    del self._rooms[match_id]
+            for match_id, room in idle.items():
+                room.close()
+                _logger.info("Match %s dropped after being idle", match_id)
+
+    def _handle(self, connection: ServerConnection) -> None:
+        room: _Room | None = None
+        seat: _Seat | None = None
+        spectator: _Spectator | None = None
+        try:
+            for message in connection:
+                header, payload = _unpack(message)
+                if spectator is not None:
+                    # spectators have nothing more to say
+                    continue
+                if header.get("type") in ("join", "watch"):
+                    if room is not None:
+                        connection.send(_pack({"type": "error", "message": "already in a match"}))
+                        continue
+                    room = self._enter(str(header["match"]))
+                    if header["type"] == "join":
+                        seat = self._join(connection, room, header)
+                        if seat is None:
+                            self._leave(room)
+                            room = None
+                    else:
+                        perspective = header.get("perspective")
+                        spectator = room.watch(connection, None if perspective is None else ds.Pid(perspective))
+                elif room is None or seat is None:
+                    connection.send(_pack({"type": "error", "message": "join a match first"}))
+                elif header.get("type") == "action":
+                    self._act(room, seat, header["depth"], payload)
+                elif header.get("type") == "surrender":
+                    with room.lock:
+                        room.match.surrender(seat.pid)
+        except ConnectionClosed:
+            pass
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            _logger.warning("Bad message, closing connection: %r", e)
+        finally:
+            if room is not None and spectator is not None:
+                room.unwatch(spectator)
+            if room is not None and seat is not None:
+                with room.lock:
+                    if seat.connection is connection:
+                        seat.connection = None
+            if room is not None:
+                self._leave(room)
+
+    def _join(self, connection: ServerConnection, room: _Room, header: dict[str, Any]) -> _Seat | None:
+        pid = ds.Pid(header["pid"])
+        with room.lock:
+            seat = room.seats.get(pid)
+            if seat is None:
+                seat = room.seats[pid] = _Seat(pid, secrets.token_hex(16))
+            elif header.get("token") != seat.token:
+                seat = None
+            if seat is not None:
+                seat.connection = connection
+                seat.encoder.reset()
+                seat.send(_pack({"type": "joined", "pid": pid.value, "token": seat.token}))
+                seat.send_nodes(_line(room.match)[int(header.get("known", 0)):])
+        if seat is None:
+            connection.send(_pack({"type": "error", "message": f"seat {pid.name} is taken"}))
+            return None
+        _logger.info("%s joined match %s", pid, header["match"])
+        return seat
+
+    def _act(self, room: _Room, seat: _Seat, depth: int, payload: bytes) -> None:
+        from .match_codec import decode_action
+        action = decode_action(payload)
+        with room.lock:
+            match = room.match
+            if depth != match.curr_node.depth or match.latest_state().waiting_for() is not seat.pid:
+                _logger.debug("Dropped stale action %s of %s at depth %d", action, seat.pid, depth)
+                return
+            try:
+                match.apply_action(seat.pid, action)
+            except Exception:
+                _logger.warning("Action %s of %s failed", action, seat.pid, exc_info=True)
+                seat.send(_pack({"type": "error", "message": f"invalid action {action}"}))
+
+
+class RemoteMatchClient:
+    """
+    Plays one seat of a match on a `MatchServer`, or watches it, mirroring the
+    match locally from the views the server sends. Reconnects and catches up
+    on its own.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            match_id: str,
+            pid: ds.Pid | None,
+            on_update: Callable[[], None] = lambda: None,
+            spectator: bool = False,
+            token: str | None = None,
+    ) -> None:
+        """
+        :param pid: the seat to play, or the perspective to watch (None hides
+                    both players' secrets).
+        :param on_update: called from the client's thread after the mirrored
+                          match has been extended.
+        :param spectator: if True, the match is only watched. A spectator's
+                          mirror holds the states it was sent, which skip
+                          ahead when it falls behind.
+        :param token: the token of the seat from an earlier client, see
+                      `token`, to retake the seat with.
+        """
+        assert spectator or pid is not None
+        self.url = url
+        self.match_id = match_id
+        self.pid = pid
+        self.spectator = spectator
+        self.on_update = on_update
+        #: server depth of the latest state received
+        self._depth = -1
+        #: the local mirror, None until the first state has arrived
+        self.match: Match | None = None
+        self._token = token
+        #: whether the seat has been taken once
+        self._joined = False
+        self._connection = None
+        self._decoder = ViewDecoder()
+        self._closed = threading.Event()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="remote-match", daemon=True)
+        self._thread.start()
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        """
+        Waits for the first state of the match.
+
+        :returns: False on timeout or if the seat could not be taken.
+        """
+        self._ready.wait(timeout)
+        return self.match is not None
+
+    @property
+    def token(self) -> str | None:
+        """
+        The token the seat was given, which a later client retakes it with,
+        e.g. after the page is reloaded. None until joined.
+        """
+        return self._token
+
+    def send_action(self, action: ds.PlayerAction) -> None:
+        assert self.match is not None and not self.spectator
+        self._send({"type": "action", "depth": self._depth}, _encode_action(action))
+
+    def surrender(self) -> None:
+        self._send({"type": "surrender"})
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._connection is not None:
+            self._connection.close()
+
+    def _send(self, header: dict[str, Any], payload: bytes = b"") -> None:
+        connection = self._connection
+        if connection is None:
+            _logger.warning("Not connected, dropped %s", header["type"])
+            return
+        try:
+            connection.send(_pack(header, payload))
+        except ConnectionClosed:
+            _logger.warning("Connection lost, dropped %s", header["type"])
+
+    def _run(self) -> None:
+        attempt = 0
+        while not self._closed.is_set():
+            try:
+                with connect(self.url, compression=_COMPRESSION) as connection:
+                    self._connection = connection
+                    self._decoder.reset()
+                    if self.spectator:
+                        connection.send(_pack({
+                            "type": "watch",
+                            "match": self.match_id,
+                            "perspective": None if self.pid is None else self.pid.value,
+                        }))
+                    else:
+                        connection.send(_pack({
+                            "type": "join",
+                            "match": self.match_id,
+                            "pid": self.pid.value,
+                            "token": self._token,
+                            "known": self._depth + 1,
+                        }))
+                    for message in connection:
+                        attempt = 0
+                        self._receive(*_unpack(message))
+            except (OSError, ConnectionClosed) as e:
+                _logger.info("Disconnected from %s: %s", self.url, e)
+            except (ValueError, KeyError, IndexError, TypeError, pickle.UnpicklingError, zlib.error) as e:
+                # the next connection starts over from a fresh decoder
+                _logger.warning("Bad message from %s, reconnecting: %r", self.url, e)
+            finally:
+                self._connection = None
+            if self._closed.wait(_RECONNECT_DELAYS[min(attempt, len(_RECONNECT_DELAYS) - 1)]):
+                return
+            attempt += 1
+
+    def _receive(self, header: dict[str, Any], payload: bytes) -> None:
+        kind = header.get("type")
+        if kind == "joined":
+            self._token = header["token"]
+            self._joined = True
+        elif kind == "state":
+            from .match_codec import decode_action
+            action_size = header["action"]
+            action = decode_action(payload[:action_size]) if action_size else None
+            if header.get("key"):
+                self._decoder.reset()
+            state = self._decoder.decode(payload[action_size:])
+            if header["depth"] <= self._depth:
+                # a spectator rejoining is sent the state it has already
+                return
+            self._depth = header["depth"]
+            if self.match is None:
+                self.match = Match.from_tree(root := MatchNode(stop_state=state), root, seed=0)
+            else:
+                self.match.extend_line(state, action)
+            self._ready.set()
+            self.on_update()
+        elif kind == "error":
+            _logger.warning("Match server: %s", header["message"])
+            if not self._joined and not self.spectator:
+                # refused to join, retrying won't help
+                self._closed.set()
+                self._ready.set()
+
+
+def _main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Runs a match server for remote PVP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+    server = MatchServer(args.host, args.port)
+    server.start()
+    print(f"Serving matches at {server.url}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    _main()
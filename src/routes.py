@@ -17,6 +17,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 from enum import Enum
 
+from .log import get_logger
+
+_logger = get_logger(__name__)
+
 
 class Route(Enum):
     HOME = "/"
@@ -27,10 +31,10 @@ class Route(Enum):
 
     @classmethod
     def find_route(cls, route: str) -> Route:
-        print(f"{cls.__name__}::find_route::[try-find]{route}")
+        _logger.debug("find_route: [try-find] %s", route)
         for r in cls:
             if r.value == route:
-                print(f"{cls.__name__}::find_route::[found]{r}")
+                _logger.debug("find_route: [found] %s", r)
                 return r
-        print(f"{cls.__name__}::find_route::[found]{cls.NOT_FOUND}")
+        _logger.debug("find_route: [found] %s", cls.NOT_FOUND)
         return cls.NOT_FOUND
@@ -0,0 +1,292 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dgisim as ds
+from dgisim import encoding_plan
+
+from .agents.features import FEATURE_SIZE, require_numpy, encode, np
+from .agents.rollout import set_rollout_workers
+from .engine import ENGINE_LOCK
+from .game_data import Match
+from .log import get_logger
+from .tournament import DEFAULT_MAX_ACTIONS, make_agent
+
+__all__ = [
+    "ShardWriter",
+    "generate",
+    "row_dtype",
+]
+
+_logger = get_logger(__name__)
+
+INDEX_FILE = "index.json"
+DEFAULT_SHARD_ROWS = 1 << 16
+
+_ACTION_TYPES = tuple(ds.ActionType)
+_ACTION_SIZE = encoding_plan.action_encoding_size
+_ACTION_CLASS_TYPES = {
+    ds.CardsSelectAction: ds.ActionType.SELECT_CARDS,
+    ds.CharacterSelectAction: ds.ActionType.SELECT_ACTIVE_CHARACTER,
+    ds.DeathSwapAction: ds.ActionType.SELECT_ACTIVE_CHARACTER,
+    ds.DiceSelectAction: ds.ActionType.SELECT_DICE,
+    ds.CardAction: ds.ActionType.PLAY_CARD,
+    ds.SkillAction: ds.ActionType.CAST_SKILL,
+    ds.SwapAction: ds.ActionType.SWAP_CHARACTER,
+    ds.ElementalTuningAction: ds.ActionType.ELEMENTAL_TUNING,
+    ds.EndRoundAction: ds.ActionType.END_ROUND,
+}
+
+
+def row_dtype() -> np.dtype:
+    """
+    One row per decision: the state features from the deciding player's
+    view, which action types were legal, the action taken (encoded by
+    dgisim's encoding plan) and the game's outcome for the deciding player.
+    """
+    require_numpy()
+    return np.dtype([
+        ("features", np.float32, (FEATURE_SIZE,)),
+        ("legal", np.bool_, (len(_ACTION_TYPES),)),
+        ("action", np.int32, (_ACTION_SIZE,)),
+        ("action_type", np.int8),
+        ("pid", np.int8),
+        ("outcome", np.float32),
+        ("game", np.int32),
+        ("ply", np.int32),
+    ])
+
+
+def _action_type(action: ds.PlayerAction) -> ds.ActionType:
+    for cls, action_type in _ACTION_CLASS_TYPES.items():
+        if isinstance(action, cls):
+            return action_type
+    raise ValueError(f"Unknown action {action}")
+
+
+def _play_game(agent_spec: str, game: int, seed: int, max_actions: int) -> np.ndarray:
+    match = Match(agent1=make_agent(agent_spec), agent2=make_agent(agent_spec), seed=seed)
+    rows = []
+    state = match.latest_state()
+    while not state.game_end() and len(rows) < max_actions:
+        pid = state.waiting_for()
+        with ENGINE_LOCK:
+            choices = state.action_generator(pid).choices()
+        depth = match.curr_node.depth
+        match.agent_action_step(pid)
+        if match.curr_node.depth == depth:
+            break
+        action = match.curr_node.in_action
+        action_type = _action_type(action)
+        legal = np.zeros(len(_ACTION_TYPES), dtype=np.bool_)
+        if isinstance(choices, tuple) and all(isinstance(c, ds.ActionType) for c in choices):
+            for choice in choices:
+                legal[_ACTION_TYPES.index(choice)] = True
+        legal[_ACTION_TYPES.index(action_type)] = True
+        encoded = np.zeros(_ACTION_SIZE, dtype=np.int32)
+        try:
+            codes = action.encoding(encoding_plan)[:_ACTION_SIZE]
+            encoded[:len(codes)] = codes
+        except Exception:
+            # a few dgisim types have no code in 0.4.0, the action type is kept
+            pass
+        rows.append((encode(state, pid), legal, encoded, _ACTION_TYPES.index(action_type), pid.value, 0.5, game, len(rows)))
+        state = match.latest_state()
+
+    data = np.array(rows, dtype=row_dtype())
+    if state.game_end() and state.get_winner() is not None:
+        data["outcome"] = np.where(data["pid"] == state.get_winner().value, 1.0, 0.0)
+    return data
+
+
+class ShardWriter:
+    """
+    Writes rows into `.npy` shards of `shard_rows` rows each, memory-mapped so
+    only the shard being filled is touched, plus an `index.json` describing
+    them. The last shard may be partly filled, see its "rows" in the index.
+    """
+
+    def __init__(self, directory: str, shard_rows: int = DEFAULT_SHARD_ROWS) -> None:
+        require_numpy()
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._shard_rows = shard_rows
+        self._dtype = row_dtype()
+        self._shards: list[dict] = []
+        self._shard: np.memmap | None = None
+        self._filled = 0
+
+    def _new_shard(self) -> None:
+        self._close_shard()
+        name = f"shard-{len(self._shards):05d}.npy"
+        self._shard = np.lib.format.open_memmap(
+            os.path.join(self._directory, name),
+            mode="w+",
+            dtype=self._dtype,
+            shape=(self._shard_rows,),
+        )
+        self._shards.append({"file": name, "rows": 0})
+        self._filled = 0
+
+    def _close_shard(self) -> None:
+        if self._shard is not None:
+            self._shard.flush()
+            self._shards[-1]["rows"] = self._filled
+            self._shard = None
+
+    def write(self, rows: np.ndarray) -> None:
+        start = 0
+        while start < len(rows):
+            if self._shard is None or self._filled == self._shard_rows:
+                self._new_shard()
+            assert self._shard is not None
+            count = min(len(rows) - start, self._shard_rows - self._filled)
+            self._shard[self._filled:self._filled + count] = rows[start:start + count]
+            self._filled += count
+            start += count
+
+    def close(self, **info: object) -> None:
+        """
+        Flushes the last shard and writes the index, with `info` added to it.
+        """
+        self._close_shard()
+        with open(os.path.join(self._directory, INDEX_FILE), "w") as f:
+            json.dump({
+                "version": 1,
+                "dgisim": ds.__version__,
+                "feature_size": FEATURE_SIZE,
+                "action_types": [action_type.name for action_type in _ACTION_TYPES],
+                "dtype": np.lib.format.dtype_to_descr(self._dtype),
+                "shard_rows": self._shard_rows,
+                "rows": sum(shard["rows"] for shard in self._shards),
+                "shards": self._shards,
+                **info,
+            }, f, indent=2)
+
+
+def _init_worker() -> None:
+    set_rollout_workers(0)
+
+
+def generate(
+        directory: str,
+        num_games: int,
+        agent_spec: str = "random",
+        seed: int = 0,
+        shard_rows: int = DEFAULT_SHARD_ROWS,
+        num_workers: int | None = None,
+        max_actions: int = DEFAULT_MAX_ACTIONS,
+) -> int:
+    """
+    Plays `num_games` self-play games of `agent_spec` on a process pool and
+    writes their rows to shards in `directory`.
+
+    Games are written by a separate thread, so the game processes never wait
+    on the disk.
+
+    :returns: the number of rows written.
+    """
+    require_numpy()
+    writer = ShardWriter(directory, shard_rows)
+    pending: queue.Queue[np.ndarray | None] = queue.Queue(maxsize=64)
+    #: what stopped the writer thread, if anything did
+    errors: list[BaseException] = []
+    num_rows = 0
+
+    def write_loop() -> None:
+        try:
+            while (rows := pending.get()) is not None:
+                writer.write(rows)
+        except BaseException as e:
+            errors.append(e)
+
+    def hand_over(rows: np.ndarray | None) -> None:
+        # a dead writer would never make room in the queue
+        while True:
+            if errors:
+                raise errors[0]
+            try:
+                pending.put(rows, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    write_thread = threading.Thread(target=write_loop, name="selfplay-writer", daemon=True)
+    write_thread.start()
+    seeds = random.Random(seed)
+    try:
+        with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+        ) as executor:
+            futures = [
+                executor.submit(_play_game, agent_spec, game, seeds.getrandbits(32), max_actions)
+                for game in range(num_games)
+            ]
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    rows = future.result()
+                    num_rows += len(rows)
+                    hand_over(rows)
+                    _logger.info("game %d/%d done, %d rows", i + 1, num_games, num_rows)
+            except BaseException:
+                # don't play the games left only to throw them away
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        if not errors:
+            hand_over(None)
+        write_thread.join()
+        writer.close(games=num_games, agent=agent_spec, seed=seed)
+    if errors:
+        raise errors[0]
+    return num_rows
+
+
+def _main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Writes self-play games as training data.")
+    parser.add_argument("directory")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--agent", default="random", help="agent spec, as for src.tournament")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard-rows", type=int, default=DEFAULT_SHARD_ROWS)
+    parser.add_argument("--workers", type=int, default=None, help="game processes, defaults to one per core")
+    parser.add_argument("--max-actions", type=int, default=DEFAULT_MAX_ACTIONS)
+    args = parser.parse_args(argv)
+    num_rows = generate(
+        args.directory,
+        args.games,
+        agent_spec=args.agent,
+        seed=args.seed,
+        shard_rows=args.shard_rows,
+        num_workers=args.workers,
+        max_actions=args.max_actions,
+    )
+    print(f"{num_rows} rows written to {args.directory}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,276 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import flet as ft
+
+from .app import DgisimApp
+from .engine_host import EngineHost, default_engine_host
+from .game_data import GameData, GameServices
+from .log import configure_logging, get_logger
+from .match_store import DEFAULT_MAX_NODES
+
+__all__ = [
+    "ServerConfig",
+    "SessionRegistry",
+    "SessionStatus",
+    "serve",
+]
+
+_logger = get_logger(__name__)
+
+_DESCRIPTION = """
+Serves the app to browsers as a multi-session web server, e.g.
+
+    python -m src.server --port 8550 --status-port 8551 --max-sessions 300
+
+Sessions share the match pool, diff cache and win estimator. Matches beyond
+a session's node budget, and all inactive matches of idle sessions, are
+written to --spill-dir and reloaded when resumed.
+GET /status on the status port reports sessions, matches and memory.
+With --engine-workers, agents think in that many worker processes.
+"""
+
+
+@dataclass(frozen=True)
+class ServerConfig:
+    #: where the matches of idle sessions are written
+    spill_dir: str
+    #: seconds without a game started or played after which a session spills
+    idle_timeout: float = 600.0
+    #: match nodes a session keeps in memory before matches spill
+    session_node_budget: int = DEFAULT_MAX_NODES
+    #: new sessions beyond this are turned away
+    max_sessions: int = 500
+    #: seconds between session checks
+    check_interval: float = 30.0
+    #: processes running the agents of all sessions, None for the value of
+    #: `DGISIM_ENGINE_WORKERS`, 0 to run them in the server process
+    engine_workers: int | None = None
+
+
+@dataclass(frozen=True)
+class SessionStatus:
+    sessions: int
+    active_sessions: int
+    spilled_sessions: int
+    matches: int
+    match_nodes: int
+    rss_bytes: int
+    uptime: float
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # peak rather than current, where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SessionRegistry:
+    """
+    Tracks the `GameData` of every session, spilling the matches of idle
+    sessions to disk from a background thread.
+    """
+
+    def __init__(self, config: ServerConfig) -> None:
+        self._config = config
+        self._sessions: dict[str, GameData] = {}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._thread: threading.Thread | None = None
+
+    def open(self, session_id: str, game_data: GameData) -> bool:
+        """
+        :returns: False if the server is full and the session was not added.
+        """
+        with self._lock:
+            if len(self._sessions) >= self._config.max_sessions:
+                _logger.warning("Session limit %d reached", self._config.max_sessions)
+                return False
+            self._sessions[session_id] = game_data
+            count = len(self._sessions)
+        _logger.info("Session opened, %d in total", count, extra={"session": session_id})
+        return True
+
+    def is_full(self) -> bool:
+        with self._lock:
+            return len(self._sessions) >= self._config.max_sessions
+
+    def close(self, session_id: str) -> None:
+        with self._lock:
+            game_data = self._sessions.pop(session_id, None)
+            count = len(self._sessions)
+        if game_data is not None:
+            game_data.close_tabs()
+            game_data.discard_spill()
+            _logger.info("Session closed, %d in total", count, extra={"session": session_id})
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="session-registry", daemon=True)
+        self._thread.start()
+
+    def check(self) -> None:
+        """
+        Spills the inactive matches of idle sessions.
+        """
+        now = time.monotonic()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for game_data in sessions:
+            if now - game_data.last_active > self._config.idle_timeout:
+                game_data.spill()
+
+    def status(self) -> SessionStatus:
+        now = time.monotonic()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return SessionStatus(
+            sessions=len(sessions),
+            active_sessions=sum(
+                now - game_data.last_active <= self._config.idle_timeout
+                for game_data in sessions
+            ),
+            spilled_sessions=sum(game_data.has_spilled() for game_data in sessions),
+            matches=sum(len(game_data.matches) for game_data in sessions),
+            match_nodes=sum(game_data.node_count() for game_data in sessions),
+            rss_bytes=_rss_bytes(),
+            uptime=now - self._started,
+        )
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self._config.check_interval)
+            try:
+                self.check()
+            except Exception:
+                _logger.exception("Session check failed")
+
+
+def _status_server(registry: SessionRegistry, host: str, port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") != "/status":
+                self.send_error(404)
+                return
+            body = json.dumps(asdict(registry.status())).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            _logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="status-server", daemon=True).start()
+    return server
+
+
+def serve(
+        config: ServerConfig,
+        host: str | None = None,
+        port: int = 8550,
+        status_port: int | None = None,
+) -> None:
+    """
+    Runs the app as a web server until interrupted.
+    """
+    os.makedirs(config.spill_dir, exist_ok=True)
+    if config.engine_workers is None:
+        engine_host = default_engine_host()
+    else:
+        engine_host = EngineHost(config.engine_workers) if config.engine_workers > 0 else None
+    services = GameServices(
+        max_match_nodes=config.session_node_budget,
+        match_dir=config.spill_dir,
+        engine_host=engine_host,
+        # journals are kept per game mode, which sessions would overwrite
+        journal_dir=None,
+    )
+    services.match_pool.start()
+    registry = SessionRegistry(config)
+    registry.start()
+    if status_port is not None:
+        _status_server(registry, host or "127.0.0.1", status_port)
+        _logger.info("Status at http://%s:%d/status", host or "127.0.0.1", status_port)
+
+    def main(page: ft.Page) -> None:
+        session_id = page.session_id
+        if registry.is_full():
+            page.add(ft.Text("The server is full, please try again later."))
+            return
+        app = DgisimApp(page, services=services)
+        if registry.open(session_id, app.context.game_data):
+            page.on_close = lambda _: registry.close(session_id)
+
+    try:
+        ft.app(
+            target=main,
+            host=host,
+            port=port,
+            view=None,
+            assets_dir="assets",
+        )
+    finally:
+        services.close()
+
+
+def _main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=_DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=8550)
+    parser.add_argument("--status-port", type=int, default=None)
+    parser.add_argument("--spill-dir", default=None, help="defaults to a temporary directory")
+    parser.add_argument("--idle-timeout", type=float, default=ServerConfig.idle_timeout, help="seconds")
+    parser.add_argument("--session-nodes", type=int, default=ServerConfig.session_node_budget)
+    parser.add_argument("--max-sessions", type=int, default=ServerConfig.max_sessions)
+    parser.add_argument(
+        "--engine-workers", type=int, default=None,
+        help="processes running the agents, 0 to run them in the server",
+    )
+    args = parser.parse_args(argv)
+    config = ServerConfig(
+        spill_dir=args.spill_dir or tempfile.mkdtemp(prefix="dgisim-sessions-"),
+        idle_timeout=args.idle_timeout,
+        session_node_budget=args.session_nodes,
+        max_sessions=args.max_sessions,
+        engine_workers=args.engine_workers,
+    )
+    serve(config, host=args.host, port=args.port, status_port=args.status_port)
+
+
+if __name__ == "__main__":
+    configure_logging()
+    _main()
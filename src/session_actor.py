@@ -0,0 +1,217 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import asyncio
+import functools
+import threading
+from collections import deque
+from collections.abc import Hashable
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from .engine import THREADS_AVAILABLE
+from .log import get_logger
+
+__all__ = [
+    "SessionActor",
+]
+
+_logger = get_logger(__name__)
+
+DEFAULT_MAX_PENDING = 16
+
+
+class _Command:
+    def __init__(self, key: Hashable | None, fn: Callable[..., Any], args: tuple) -> None:
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.futures: list[Future] = []
+        #: whether a caller waits for the result, and so sees any exception
+        self.awaited = False
+
+
+class SessionActor:
+    """
+    Runs the commands of one session one at a time, in order, on its own
+    thread, so that event handlers on different threads never interleave.
+
+    A command submitted under the key of a command still waiting replaces
+    it, so repeated taps or drags run once with the latest arguments.
+
+    Where threads can't be started, e.g. in web builds, commands run in
+    order on the thread that submits them instead.
+    """
+
+    def __init__(
+            self,
+            name: str = "session",
+            max_pending: int = DEFAULT_MAX_PENDING,
+            threaded: bool = THREADS_AVAILABLE,
+    ) -> None:
+        self._name = name
+        self._max_pending = max_pending
+        self._threaded = threaded
+        self._queue: deque[_Command] = deque()
+        self._keyed: dict[Hashable, _Command] = {}
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        #: the thread running the queued commands in place, if not threaded
+        self._runner: threading.Thread | None = None
+        self._closing = False
+
+    def on_actor_thread(self) -> bool:
+        current = threading.current_thread()
+        return current is self._thread or current is self._runner
+
+    def submit(
+            self,
+            fn: Callable[..., Any],
+            *args: Any,
+            key: Hashable | None = None,
+            block: bool = False,
+    ) -> Future | None:
+        """
+        :param key: identifies commands that coalesce.
+        :param block: if True, waits for room in a full queue instead of
+                      dropping the command, or queues it over the limit when
+                      called from the actor itself.
+        :returns: the future of the command's result, None if it was dropped.
+        """
+        future = self._enqueue(fn, args, key, block, awaited=False)
+        if future is None:
+            _logger.warning("%s actor is full, dropped %s", self._name, getattr(fn, "__name__", fn))
+        return future
+
+    def call(self, fn: Callable[..., Any], *args: Any, key: Hashable | None = None) -> Any:
+        """
+        Runs `fn` on the actor and waits for its result, raising what it
+        raised. Runs it right away if already on the actor.
+        """
+        if self.on_actor_thread():
+            return fn(*args)
+        future = self._enqueue(fn, args, key, block=True, awaited=True)
+        assert future is not None
+        return future.result()
+
+    async def call_async(self, fn: Callable[..., Any], *args: Any, key: Hashable | None = None) -> Any:
+        """
+        Like `call()`, but awaits the result instead of blocking the thread.
+        """
+        future = self._enqueue(fn, args, key, block=not self._threaded, awaited=True)
+        if future is None:
+            # the queue is full, wait for room without holding up the loop
+            future = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self._enqueue, fn, args, key, True, True),
+            )
+        return await asyncio.wrap_future(future)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def close(self) -> None:
+        """
+        Lets the actor's thread end once it has run the commands queued so
+        far, e.g. when the session ends. A later command starts a new one.
+        """
+        with self._cond:
+            if self._thread is not None:
+                self._closing = True
+                self._cond.notify_all()
+
+    def _enqueue(
+            self,
+            fn: Callable[..., Any],
+            args: tuple,
+            key: Hashable | None,
+            block: bool,
+            awaited: bool,
+    ) -> Future | None:
+        future: Future = Future()
+        with self._cond:
+            command = None if key is None else self._keyed.get(key)
+            if command is not None:
+                command.fn = fn
+                command.args = args
+                command.futures.append(future)
+                command.awaited |= awaited
+                return future
+            if len(self._queue) >= self._max_pending:
+                if not block:
+                    return None
+                # the actor can't make room while waiting on itself
+                if not self.on_actor_thread():
+                    self._cond.wait_for(lambda: len(self._queue) < self._max_pending)
+            command = _Command(key, fn, args)
+            command.futures.append(future)
+            command.awaited = awaited
+            self._queue.append(command)
+            if key is not None:
+                self._keyed[key] = command
+            if not self._threaded:
+                if self._runner is not None:
+                    # runs after the command being run, e.g. the one submitting it
+                    return future
+                self._runner = threading.current_thread()
+            elif self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"{self._name}-actor", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        if not self._threaded:
+            try:
+                while self._run_next(wait=False):
+                    pass
+            finally:
+                with self._cond:
+                    self._runner = None
+        return future
+
+    def _run(self) -> None:
+        while self._run_next(wait=True):
+            pass
+
+    def _run_next(self, wait: bool) -> bool:
+        """
+        Runs the next command, waiting for one if `wait`, unless closing.
+
+        :returns: False if there was none to run, then the actor's thread ends.
+        """
+        with self._cond:
+            if wait:
+                self._cond.wait_for(lambda: self._queue or self._closing)
+            if not self._queue:
+                if wait:
+                    self._closing = False
+                    self._thread = None
+                return False
+            command = self._queue.popleft()
+            if command.key is not None:
+                del self._keyed[command.key]
+            self._cond.notify_all()
+            fn, args, futures = command.fn, command.args, command.futures
+        try:
+            result = fn(*args)
+        except Exception as e:
+            if not command.awaited:
+                _logger.exception("%s failed", getattr(fn, "__name__", fn))
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(result)
+        return True
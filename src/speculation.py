@@ -0,0 +1,189 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Container
+
+import dgisim as ds
+
+from .engine import ENGINE_LOCK, THREADS_AVAILABLE
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from .game_data import Match, Speculation
+
+__all__ = [
+    "Speculator",
+    "likely_actions",
+    "speculation_executor",
+]
+
+_logger = get_logger(__name__)
+
+#: The order action types are guessed in, most likely first.
+_LIKELY_ACTION_TYPES = (
+    ds.ActionType.CAST_SKILL,
+    ds.ActionType.END_ROUND,
+    ds.ActionType.PLAY_CARD,
+    ds.ActionType.SWAP_CHARACTER,
+    ds.ActionType.ELEMENTAL_TUNING,
+)
+
+#: Bounds the number of partially filled generators looked at per guess.
+_MAX_EXPANSIONS = 200
+
+#: Seconds `Speculator.take()` waits on a running speculation by default.
+DEFAULT_MAX_WAIT = 1.0
+
+
+def _likelihood(choice: object) -> int:
+    if choice in _LIKELY_ACTION_TYPES:
+        return _LIKELY_ACTION_TYPES.index(choice)
+    return len(_LIKELY_ACTION_TYPES)
+
+
+def likely_actions(action_generator: ds.ActionGenerator, limit: int) -> list[ds.PlayerAction]:
+    """
+    :returns: up to `limit` actions guessed from `action_generator`.
+
+    Discrete choices are explored breadth first, so simple actions like ending
+    the round come before long card plays. Dice are picked the way the play
+    page suggests them, and no cards or dice are redrawn or rerolled.
+    """
+    actions: list[ds.PlayerAction] = []
+    queue = deque([action_generator])
+    expansions = 0
+    while queue and len(actions) < limit and expansions < _MAX_EXPANSIONS:
+        act_gen = queue.popleft()
+        expansions += 1
+        if act_gen.filled():
+            actions.append(act_gen.generate_action())
+            continue
+        choices = act_gen.choices()
+        if isinstance(choices, tuple):
+            queue.extend(act_gen.choose(choice) for choice in sorted(choices, key=_likelihood))
+        elif isinstance(choices, ds.AbstractDice):
+            selection = act_gen.dice_available().smart_selection(
+                choices,
+                act_gen.game_state.get_player(act_gen.pid).characters,
+            )
+            if selection is not None:
+                queue.append(act_gen.choose(selection))
+        elif isinstance(choices, ds.Cards):
+            queue.append(act_gen.choose(ds.Cards({})))
+        elif isinstance(choices, ds.ActualDice):
+            queue.append(act_gen.choose(ds.ActualDice({})))
+    return actions
+
+
+def speculation_executor(max_workers: int = 2) -> ThreadPoolExecutor:
+    """
+    :returns: an executor for `Speculator`s, which those of a server's sessions
+              share, see `GameServices`.
+    """
+    return ThreadPoolExecutor(max_workers, thread_name_prefix="speculation")
+
+
+class Speculator:
+    """
+    Precomputes what follows the likely actions of a player that is thinking,
+    including the replies of agents, on background threads.
+    """
+
+    def __init__(
+            self,
+            executor: Executor,
+            max_actions: int = 3,
+            max_wait: float = DEFAULT_MAX_WAIT,
+    ) -> None:
+        """
+        :param executor: runs the speculations, it is not owned by the
+                         speculator.
+        :param max_wait: the most seconds `take()` waits on a speculation that
+                         is being computed, before computing the action anew.
+        """
+        self._max_actions = max_actions
+        self._max_wait = max_wait
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._pending: list[tuple[ds.PlayerAction, Future[Speculation | None]]] = []
+
+    def start(self, match: Match, pid: ds.Pid, agent_pids: Container[ds.Pid]) -> None:
+        """
+        Starts speculating on the actions `pid` may take at the current node of
+        `match`, replacing earlier speculations. Does nothing where threads
+        can't be started, e.g. in web builds.
+
+        :param agent_pids: players whose replies are precomputed too.
+        """
+        self.discard()
+        if not THREADS_AVAILABLE:
+            return
+        parent, seed_state = match.speculation_base()
+        assert parent.stop_state is not None
+        with ENGINE_LOCK:
+            act_gen = parent.stop_state.action_generator(pid)
+            actions = [] if act_gen is None else likely_actions(act_gen, self._max_actions)
+        with self._lock:
+            generation = self._generation
+
+            def cancelled() -> bool:
+                return self._generation != generation
+
+            self._pending = [
+                (action, self._executor.submit(
+                    match.speculate, parent, seed_state, pid, action, agent_pids, cancelled,
+                ))
+                for action in actions
+            ]
+
+    def take(self, action: ds.PlayerAction) -> Speculation | None:
+        """
+        :returns: the speculation on `action` if there is one, waiting up to
+                  `max_wait` seconds for it if it is being computed. All other
+                  speculations are dropped.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        speculation = None
+        for guess, future in pending:
+            if guess != action:
+                future.cancel()
+            elif not future.cancel():
+                # already running, which is a head start over computing it now
+                try:
+                    speculation = future.result(self._max_wait)
+                except FutureTimeoutError:
+                    # `discard()` below makes it stop early
+                    _logger.debug("Speculation took over %.1fs", self._max_wait)
+                except Exception:
+                    _logger.warning("Speculation failed", exc_info=True)
+        self.discard()
+        _logger.debug("speculation %s", "hit" if speculation is not None else "miss")
+        return speculation
+
+    def discard(self) -> None:
+        with self._lock:
+            self._generation += 1
+            for _, future in self._pending:
+                future.cancel()
+            self._pending = []
@@ -0,0 +1,222 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Iterator
+
+import dgisim as ds
+
+__all__ = [
+    "Change",
+    "DiffCache",
+    "LazyDiff",
+    "diff_states",
+]
+
+#: Engine internals that are never rendered, so changes to them are noise.
+_SKIPPED_FIELDS = frozenset({
+    "card_checker",
+    "swap_checker",
+    "skill_checker",
+    "elem_tuning_checker",
+    "hidden_statuses",
+    "hiddens",
+    "initial_deck",
+})
+
+
+@dataclass(frozen=True)
+class Change:
+    #: dotted path of the changed field, e.g. "player1.characters.Klee.hp"
+    path: str
+    #: None if the field was added
+    before: Any
+    #: None if the field was removed
+    after: Any
+
+    def __str__(self) -> str:
+        return f"{self.path}: {_describe(self.before)} -> {_describe(self.after)}"
+
+
+def diff_states(before: ds.GameState, after: ds.GameState) -> Iterator[Change]:
+    """
+    Yields the field-level changes from `before` to `after`.
+
+    Substructures shared by both states are skipped by identity, so the cost
+    is proportional to the size of the change rather than of the states.
+    """
+    yield from _diff("", before, after)
+
+
+def _is_engine_object(value: Any) -> bool:
+    return (
+        type(value).__module__.startswith("dgisim")
+        and hasattr(value, "__dict__")
+        and not isinstance(value, Enum)
+    )
+
+
+def _name(key: Any) -> str:
+    if isinstance(key, type):
+        return key.__name__
+    if isinstance(key, Enum):
+        return key.name
+    return str(key)
+
+
+def _describe(value: Any) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, (type, Enum)):
+        return _name(value)
+    if _is_engine_object(value):
+        return type(value).__name__
+    if isinstance(value, Mapping):
+        return "{" + ", ".join(f"{_name(k)}: {_describe(v)}" for k, v in value.items()) + "}"
+    return repr(value)
+
+
+def _join(path: str, name: str) -> str:
+    return f"{path}.{name}" if path else name
+
+
+def _keyed(items: tuple) -> dict[str, Any]:
+    """
+    Keys engine objects in a tuple by class name, numbering repeated classes.
+    """
+    seen: Counter[str] = Counter()
+    keyed: dict[str, Any] = {}
+    for item in items:
+        name = type(item).__name__
+        seen[name] += 1
+        keyed[name if seen[name] == 1 else f"{name}#{seen[name]}"] = item
+    return keyed
+
+
+def _diff_mappings(path: str, before: Mapping, after: Mapping) -> Iterator[Change]:
+    for key, value in before.items():
+        sub_path = _join(path, _name(key))
+        if key in after:
+            yield from _diff(sub_path, value, after[key])
+        else:
+            yield Change(sub_path, value, None)
+    for key, value in after.items():
+        if key not in before:
+            yield Change(_join(path, _name(key)), None, value)
+
+
+def _diff(path: str, before: Any, after: Any) -> Iterator[Change]:
+    if before is after:
+        return
+    if type(before) is not type(after):
+        yield Change(path, before, after)
+    elif isinstance(before, Mapping):
+        yield from _diff_mappings(path, before, after)
+    elif isinstance(before, tuple):
+        if all(map(_is_engine_object, before + after)):
+            yield from _diff_mappings(path, _keyed(before), _keyed(after))
+        elif len(before) == len(after):
+            for i, (b, a) in enumerate(zip(before, after)):
+                yield from _diff(f"{path}[{i}]", b, a)
+        else:
+            yield Change(path, before, after)
+    elif _is_engine_object(before):
+        class_name = type(before).__name__.lower()
+        after_fields = vars(after)
+        for attr, value in vars(before).items():
+            name = attr.lstrip("_")
+            if name in _SKIPPED_FIELDS:
+                continue
+            # wrappers like Cards._cards or Statuses._statuses add no information
+            sub_path = path if class_name.endswith(name) else _join(path, name)
+            yield from _diff(sub_path, value, after_fields.get(attr))
+    elif before != after:
+        yield Change(path, before, after)
+
+
+class LazyDiff:
+    """
+    The changes between two states, computed only as far as they are iterated
+    and kept for later iterations.
+    """
+
+    def __init__(self, before: ds.GameState, after: ds.GameState) -> None:
+        self.before = before
+        self.after = after
+        self._computed: list[Change] = []
+        self._pending: Iterator[Change] | None = diff_states(before, after)
+        self._lock = threading.Lock()
+
+    def _compute_next(self) -> bool:
+        with self._lock:
+            if self._pending is None:
+                return False
+            change = next(self._pending, None)
+            if change is None:
+                self._pending = None
+                return False
+            self._computed.append(change)
+            return True
+
+    def __iter__(self) -> Iterator[Change]:
+        i = 0
+        while i < len(self._computed) or self._compute_next():
+            yield self._computed[i]
+            i += 1
+
+
+class DiffCache:
+    """
+    Keeps the diffs of the latest `max_pairs` state pairs.
+    """
+
+    def __init__(self, max_pairs: int = 256) -> None:
+        self._max_pairs = max_pairs
+        self._diffs: OrderedDict[tuple[int, int, ds.Pid | None], LazyDiff] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            before: ds.GameState,
+            after: ds.GameState,
+            perspective: ds.Pid | None = None,
+    ) -> LazyDiff:
+        """
+        :param perspective: if given, the opponent's secrets are hidden from
+                            the diff.
+        """
+        key = (id(before), id(after), perspective)
+        with self._lock:
+            diff = self._diffs.get(key)
+            if diff is not None:
+                self._diffs.move_to_end(key)
+                return diff
+        if perspective is None:
+            diff = LazyDiff(before, after)
+        else:
+            diff = LazyDiff(before.prespective_view(perspective), after.prespective_view(perspective))
+        # the key holds the ids of the raw states, so keep those alive instead
+        diff.before, diff.after = before, after
+        with self._lock:
+            self._diffs[key] = diff
+            while len(self._diffs) > self._max_pairs:
+                self._diffs.popitem(last=False)
+        return diff
@@ -0,0 +1,111 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+__all__ = [
+    "Span",
+    "TimingRecorder",
+    "recorder",
+    "report_enabled",
+]
+
+#: Set this environment variable to a non-empty value to get the timing report
+#: printed once the app has finished starting up.
+TIMING_ENV_VAR = "DGISIM_TIMING"
+
+
+@dataclass(frozen=True)
+class Span:
+    name: str
+    #: seconds since the recorder's origin (roughly process start)
+    start: float
+    duration: float
+
+
+class TimingRecorder:
+    """
+    Records named wall-clock spans relative to an origin.
+
+    Both `span()` and `first_span()` can also be used as decorators.
+    Only the latest `max_spans` spans are kept.
+    """
+
+    def __init__(self, origin: float | None = None, max_spans: int = 256) -> None:
+        self._origin = time.perf_counter() if origin is None else origin
+        self._spans: deque[Span] = deque(maxlen=max_spans)
+        self._seen: set[str] = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._spans.append(Span(name, start - self._origin, end - start))
+
+    @contextmanager
+    def first_span(self, name: str) -> Iterator[None]:
+        """
+        Same as `span()` but only the first occurrence of `name` is recorded.
+        """
+        with self._lock:
+            first = name not in self._seen
+            self._seen.add(name)
+        if first:
+            with self.span(name):
+                yield
+        else:
+            yield
+
+    def spans(self) -> list[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def get(self, name: str) -> Span | None:
+        """
+        :returns: the first recorded span called `name`.
+        """
+        for span in self.spans():
+            if span.name == name:
+                return span
+        return None
+
+    def report(self) -> str:
+        lines = [f"{'span':<40} {'start ms':>10} {'took ms':>10}"]
+        for span in self.spans():
+            lines.append(
+                f"{span.name:<40} {span.start * 1000:>10.1f} {span.duration * 1000:>10.1f}"
+            )
+        return '\n'.join(lines)
+
+
+def report_enabled() -> bool:
+    return bool(os.environ.get(TIMING_ENV_VAR))
+
+
+#: The process-wide recorder used for startup and navigation timings.
+recorder = TimingRecorder()
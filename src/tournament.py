@@ -0,0 +1,292 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import argparse
+import csv
+import importlib
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+import time
+from ast import literal_eval
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+
+import dgisim as ds
+from dgisim import agents as dsa
+
+from .agents.mcts import MCTSAgent
+from .agents.rollout import set_rollout_workers
+from .game_data import Match
+
+__all__ = [
+    "GameResult",
+    "LeaderboardRow",
+    "leaderboard",
+    "make_agent",
+    "play_game",
+    "run_tournament",
+]
+
+_DESCRIPTION = """
+Plays round-robin games between player agents, e.g.
+
+    python -m src.tournament random mcts mcts:time_budget=0.2 --games 4 --slo-ms 500
+
+Each agent is given as a name ("random", "mcts") or a dotted class path,
+optionally followed by ":key=value,..." keyword arguments for the class.
+"""
+
+_AGENTS: dict[str, Callable[..., ds.PlayerAgent]] = {
+    "random": dsa.RandomAgent,
+    "mcts": MCTSAgent,
+}
+
+#: Games still running after this many actions are counted as draws.
+DEFAULT_MAX_ACTIONS = 1000
+
+
+def make_agent(spec: str) -> ds.PlayerAgent:
+    name, _, args = spec.partition(":")
+    if name in _AGENTS:
+        cls = _AGENTS[name]
+    else:
+        module, _, qualname = name.rpartition(".")
+        cls = getattr(importlib.import_module(module), qualname)
+    kwargs = {}
+    for arg in filter(None, args.split(",")):
+        key, _, value = arg.partition("=")
+        kwargs[key.strip()] = literal_eval(value.strip())
+    return cls(**kwargs)
+
+
+class _TimedAgent(ds.PlayerAgent):
+    def __init__(self, agent: ds.PlayerAgent) -> None:
+        self.agent = agent
+        self.locks_engine = getattr(agent, "locks_engine", False)
+        self.latencies: list[float] = []
+
+    def choose_action(self, history: list[ds.GameState], pid: ds.Pid) -> ds.PlayerAction:
+        start = time.perf_counter()
+        try:
+            return self.agent.choose_action(history, pid)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+@dataclass(frozen=True)
+class GameResult:
+    p1: str
+    p2: str
+    seed: int
+    #: None for a draw
+    winner: str | None
+    num_actions: int
+    p1_latencies: list[float]
+    p2_latencies: list[float]
+
+
+def play_game(p1: str, p2: str, seed: int, max_actions: int = DEFAULT_MAX_ACTIONS) -> GameResult:
+    """
+    Plays one game between the agents specified by `p1` and `p2`.
+    """
+    agent1 = _TimedAgent(make_agent(p1))
+    agent2 = _TimedAgent(make_agent(p2))
+    match = Match(agent1=agent1, agent2=agent2, seed=seed)
+    num_actions = 0
+    state = match.latest_state()
+    while not state.game_end() and num_actions < max_actions:
+        depth = match.curr_node.depth
+        match.agent_action_step(state.waiting_for())
+        if match.curr_node.depth == depth:
+            # the agent failed to act, which would repeat forever
+            break
+        num_actions += 1
+        state = match.latest_state()
+    winner = None
+    if state.game_end() and state.get_winner() is not None:
+        winner = p1 if state.get_winner() is ds.Pid.P1 else p2
+    return GameResult(
+        p1=p1,
+        p2=p2,
+        seed=seed,
+        winner=winner,
+        num_actions=num_actions,
+        p1_latencies=agent1.latencies,
+        p2_latencies=agent2.latencies,
+    )
+
+
+def _init_worker() -> None:
+    # the games already keep every process busy
+    set_rollout_workers(0)
+
+
+def run_tournament(
+        specs: list[str],
+        games_per_pair: int = 2,
+        seed: int = 0,
+        num_workers: int | None = None,
+        max_actions: int = DEFAULT_MAX_ACTIONS,
+        on_result: Callable[[GameResult], None] | None = None,
+) -> list[GameResult]:
+    """
+    Plays `games_per_pair` games for every pair of agents, each agent playing
+    first in half of them. Game seeds only depend on `seed`.
+    """
+    seeds = random.Random(seed)
+    games = []
+    for a, b in itertools.combinations(specs, 2):
+        for i in range(games_per_pair):
+            p1, p2 = (a, b) if i % 2 == 0 else (b, a)
+            games.append((p1, p2, seeds.getrandbits(32)))
+    results = []
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+    ) as executor:
+        futures = [
+            executor.submit(play_game, p1, p2, game_seed, max_actions)
+            for p1, p2, game_seed in games
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            if on_result is not None:
+                on_result(result)
+            results.append(result)
+    results.sort(key=lambda result: (result.p1, result.p2, result.seed))
+    return results
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(pct / 100 * len(sorted_values)))
+    return sorted_values[index]
+
+
+@dataclass
+class LeaderboardRow:
+    agent: str
+    games: int = 0
+    wins: int = 0
+    draws: int = 0
+    losses: int = 0
+    win_rate: float = 0.0
+    mean_game_length: float = 0.0
+    p50_ms: float = 0.0
+    p90_ms: float = 0.0
+    p99_ms: float = 0.0
+    max_ms: float = 0.0
+    #: whether p99 latency is within the SLO, None without an SLO
+    within_slo: bool | None = None
+    _lengths: list[int] = field(default_factory=list, repr=False)
+    _latencies: list[float] = field(default_factory=list, repr=False)
+
+    def as_dict(self) -> dict:
+        return {k: v for k, v in asdict(self).items() if not k.startswith("_")}
+
+
+def leaderboard(results: list[GameResult], slo_ms: float | None = None) -> list[LeaderboardRow]:
+    """
+    :returns: a row per agent, best win rate first.
+    """
+    rows: dict[str, LeaderboardRow] = {}
+    for result in results:
+        for spec, latencies in ((result.p1, result.p1_latencies), (result.p2, result.p2_latencies)):
+            row = rows.setdefault(spec, LeaderboardRow(spec))
+            row.games += 1
+            if result.winner is None:
+                row.draws += 1
+            elif result.winner == spec:
+                row.wins += 1
+            else:
+                row.losses += 1
+            row._lengths.append(result.num_actions)
+            row._latencies.extend(latencies)
+    for row in rows.values():
+        latencies = sorted(row._latencies)
+        row.win_rate = (row.wins + 0.5 * row.draws) / row.games
+        row.mean_game_length = sum(row._lengths) / len(row._lengths)
+        row.p50_ms = 1000 * _percentile(latencies, 50)
+        row.p90_ms = 1000 * _percentile(latencies, 90)
+        row.p99_ms = 1000 * _percentile(latencies, 99)
+        row.max_ms = 1000 * (latencies[-1] if latencies else 0.0)
+        if slo_ms is not None:
+            row.within_slo = row.p99_ms <= slo_ms
+    return sorted(rows.values(), key=lambda row: row.win_rate, reverse=True)
+
+
+def _main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=_DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("agents", nargs="+", help="agent specs, at least two")
+    parser.add_argument("--games", type=int, default=2, help="games per pair of agents")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="game processes, defaults to one per core")
+    parser.add_argument("--max-actions", type=int, default=DEFAULT_MAX_ACTIONS)
+    parser.add_argument("--slo-ms", type=float, default=None, help="p99 decision latency limit")
+    parser.add_argument("--csv", help="write the leaderboard to this CSV file")
+    parser.add_argument("--json", help="write the leaderboard and all games to this JSON file")
+    args = parser.parse_args(argv)
+    if len(args.agents) < 2:
+        parser.error("at least two agents are needed")
+
+    def report(result: GameResult) -> None:
+        print(
+            f"{result.p1} vs {result.p2} (seed {result.seed}): "
+            f"{result.winner or 'draw'} after {result.num_actions} actions",
+            file=sys.stderr,
+        )
+
+    results = run_tournament(
+        args.agents,
+        games_per_pair=args.games,
+        seed=args.seed,
+        num_workers=args.workers,
+        max_actions=args.max_actions,
+        on_result=report,
+    )
+    rows = [row.as_dict() for row in leaderboard(results, args.slo_ms)]
+    columns = list(rows[0])
+    print(" ".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        print(" ".join(
+            f"{value:>16.3f}" if isinstance(value, float) else f"{str(value):>16}"
+            for value in row.values()
+        ))
+    if args.slo_ms is not None:
+        best = next((row for row in rows if row["within_slo"]), None)
+        print(f"best within {args.slo_ms:g} ms: {best['agent'] if best else 'none'}")
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "leaderboard": rows,
+                "games": [asdict(result) for result in results],
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    _main()
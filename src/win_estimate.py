@@ -0,0 +1,162 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import random
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+import dgisim as ds
+
+from .agents.rollout import evaluate, rollout, rollout_executor
+from .engine import THREADS_AVAILABLE
+from .log import get_logger
+
+if TYPE_CHECKING:
+    from .game_data import MatchNode
+
+__all__ = [
+    "WinEstimator",
+]
+
+_logger = get_logger(__name__)
+
+
+class _Request:
+    def __init__(self, node: MatchNode) -> None:
+        self.node = node
+        self.callbacks: list[Callable[[float], None]] = []
+        #: owners whose latest request this is
+        self.owners = 0
+        #: requested without an owner, so it is never dropped
+        self.pinned = False
+
+
+class WinEstimator:
+    """
+    Estimates the chance of player 1 winning from a node's stop state by the
+    mean of short rollouts, computed on a background thread and cached in
+    `MatchNode.win_estimate`.
+
+    Each owner, e.g. a session, only waits for the node it asked about last.
+    Queued estimates that no owner waits for any more are dropped, so that
+    looking through history doesn't hold up the estimate of the node shown.
+    """
+
+    def __init__(self, num_rollouts: int = 16, rollout_depth: int = 12) -> None:
+        self._num_rollouts = num_rollouts
+        self._rollout_depth = rollout_depth
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="win-estimate")
+        self._lock = threading.Lock()
+        # id of node -> request for its estimate, until it is computed
+        self._pending: dict[int, _Request] = {}
+        # owner -> id of the node it asked about last
+        self._wanted: weakref.WeakKeyDictionary[object, int] = weakref.WeakKeyDictionary()
+        self._closed = False
+
+    def estimate(
+            self,
+            node: MatchNode,
+            on_ready: Callable[[float], None] | None = None,
+            owner: object | None = None,
+    ) -> float | None:
+        """
+        :param owner: who asks, e.g. the session, weakly referenced; its
+                      earlier requests are dropped unless started or asked
+                      for by others. Without an owner, the estimate is always
+                      computed.
+        :returns: the cached estimate of `node`, or None if it is pending, in
+                  which case `on_ready` is called with it from another thread
+                  once it is computed. After `close()`, or where threads
+                  can't be started, nothing new is estimated.
+        """
+        if node.win_estimate is not None:
+            return node.win_estimate
+        with self._lock:
+            if node.win_estimate is not None or self._closed or not THREADS_AVAILABLE:
+                return node.win_estimate
+            request = self._pending.get(id(node))
+            if request is None:
+                request = self._pending[id(node)] = _Request(node)
+                self._executor.submit(self._compute, request)
+            if owner is None:
+                request.pinned = True
+            elif self._wanted.get(owner) != id(node):
+                self._unwant(owner)
+                self._wanted[owner] = id(node)
+                request.owners += 1
+            if on_ready is not None:
+                request.callbacks.append(on_ready)
+        return None
+
+    def close(self) -> None:
+        """
+        Stops the estimator's thread, dropping the estimates not started yet
+        and their callbacks.
+        """
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            self._wanted.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _unwant(self, owner: object) -> None:
+        node_id = self._wanted.pop(owner, None)
+        request = None if node_id is None else self._pending.get(node_id)
+        if request is None:
+            return
+        request.owners -= 1
+        if not request.owners and not request.pinned:
+            # still queued, `_compute()` skips it
+            del self._pending[node_id]
+
+    def _compute(self, request: _Request) -> None:
+        node = request.node
+        with self._lock:
+            if self._pending.get(id(node)) is not request:
+                return
+            # started, no longer dropped
+            request.pinned = True
+        try:
+            node.win_estimate = self._rollouts(node.latest_state(), node.seed)
+        except Exception:
+            _logger.warning("Win estimate failed", exc_info=True, extra={"depth": node.depth})
+            node.win_estimate = 0.5
+        with self._lock:
+            self._pending.pop(id(node), None)
+            for owner, node_id in list(self._wanted.items()):
+                if node_id == id(node):
+                    del self._wanted[owner]
+        for callback in request.callbacks:
+            callback(node.win_estimate)
+
+    def _rollouts(self, game_state: ds.GameState, seed: int) -> float:
+        if game_state.game_end():
+            return evaluate(game_state, ds.Pid.P1)
+        # seeded by the node, so the same position always gets the same estimate
+        seeds = random.Random(seed)
+        args = [
+            (game_state, ds.Pid.P1, self._rollout_depth, seeds.getrandbits(32))
+            for _ in range(self._num_rollouts)
+        ]
+        executor = rollout_executor()
+        if executor is None:
+            values = [rollout(*arg) for arg in args]
+        else:
+            values = [future.result() for future in [executor.submit(rollout, *arg) for arg in args]]
+        return sum(values) / len(values)
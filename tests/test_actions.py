@@ -0,0 +1,93 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+import unittest
+
+import dgisim as ds
+
+from src.agents.actions import ActionList, iter_actions
+from src.engine import ENGINE_LOCK
+
+
+def _first_decision() -> tuple[ds.GameState, ds.Pid]:
+    state = ds.GameState.from_default()
+    while state.waiting_for() is None:
+        state = state.step()
+    return state, state.waiting_for()
+
+
+class IterActionsTest(unittest.TestCase):
+    def test_every_redraw_is_an_action(self) -> None:
+        state, pid = _first_decision()
+        # the starting hand: redraw any of its cards
+        act_gen = state.action_generator(pid)
+        while not isinstance(act_gen.choices(), ds.Cards):
+            act_gen = act_gen.choose(act_gen.choices()[0])
+        hand = act_gen.choices().to_dict()
+        subsets = 1
+        for count in hand.values():
+            subsets *= count + 1
+        actions = list(iter_actions(state, pid))
+        self.assertEqual(len(actions), len(set(actions)))
+        redraws = [action for action in actions if isinstance(action, ds.CardsSelectAction)]
+        self.assertEqual(len(redraws), subsets)
+
+    def test_payments_are_held_dice_and_distinct(self) -> None:
+        state, pid = _first_decision()
+        for _ in range(200):
+            if state.game_end():
+                break
+            pid = state.waiting_for()
+            if pid is None:
+                state = state.step()
+                continue
+            actions = list(iter_actions(state, pid))
+            self.assertEqual(len(actions), len(set(actions)))
+            for action in actions:
+                instruction = getattr(action, "instruction", None)
+                dice = getattr(instruction, "dice", None)
+                if dice is not None:
+                    available = state.get_player(pid).dice
+                    self.assertTrue(all(dice[elem] <= available[elem] for elem in dice.elems()))
+            state = state.action_step(pid, actions[-1])
+
+
+class ActionListTest(unittest.TestCase):
+    def test_iterating_while_engine_lock_is_held_elsewhere(self) -> None:
+        state, pid = _first_decision()
+        actions = ActionList(state, pid)
+        done = threading.Event()
+
+        def iterate() -> None:
+            actions.all()
+            done.set()
+
+        with ENGINE_LOCK:
+            thread = threading.Thread(target=iterate)
+            thread.start()
+            # the other thread waits on ENGINE_LOCK, not on the list's lock,
+            # so taking the list here can't deadlock
+            self.assertFalse(done.wait(0.2))
+            first = next(iter(actions))
+        thread.join(10)
+        self.assertTrue(done.is_set())
+        self.assertEqual(actions.all()[0], first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import unittest
+
+from src.engine_host import HostedAgent, _Request
+from src.game_data import Match
+
+
+class _BusyWorker:
+    """
+    A worker that never gets to its requests.
+    """
+
+    def __init__(self) -> None:
+        self.abandoned: list[_Request] = []
+
+    def request(self, op: str, *args) -> tuple[_Request, int]:
+        return _Request(), 1
+
+    def abandon(self, request: _Request) -> None:
+        self.abandoned.append(request)
+
+    def notify(self, op: str, *args) -> None:
+        pass
+
+
+class HostedAgentTest(unittest.TestCase):
+    def test_gives_up_on_busy_worker(self) -> None:
+        worker = _BusyWorker()
+        agent = HostedAgent(worker, object, timeout=60, queue_timeout=0.05)
+        state = Match(seed=1).latest_state()
+        pid = state.waiting_for()
+        action = agent.choose_action([state], pid)
+        self.assertIsNotNone(state.action_step(pid, action))
+        self.assertEqual(len(worker.abandoned), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from dgisim import agents as dsa
+from dgisim import card as dscd
+
+from src.game_data import Match
+from src.match_codec import (
+    _TAG_NAMED_ITEM,
+    MatchFormatError,
+    _Reader,
+    _Writer,
+    _read_value,
+    _write_value,
+    decode_match,
+    encode_match,
+)
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Writes a finished random match to argv[1] and its states, node by node from
+# the current one back to the root, to argv[2].
+_WRITE = """
+import pickle, sys
+from dgisim import agents as dsa
+from src.game_data import Match
+from src.match_codec import encode_match
+
+match = Match(seed=7)
+agent = dsa.RandomAgent()
+while not match.curr_node.is_terminal():
+    state = match.latest_state()
+    pid = state.waiting_for()
+    match.apply_action(pid, agent.choose_action([state], pid))
+states = []
+node = match.curr_node
+while node is not None:
+    states.append([*node.inter_states, node.stop_state])
+    node = node.parent
+with open(sys.argv[1], "wb") as f:
+    f.write(encode_match(match))
+with open(sys.argv[2], "wb") as f:
+    pickle.dump(states, f)
+"""
+
+# Loads the match at argv[1] and walks back to the root, checking the states
+# of the snapshot nodes against those at argv[2]. Nodes in between are
+# replayed, which is only exact within a process, and encodings of equal
+# states differ across processes, so only snapshot states are compared.
+_READ = """
+import pickle, sys
+from src.match_codec import DEFAULT_SNAPSHOT_EVERY, decode_match
+
+with open(sys.argv[1], "rb") as f:
+    match = decode_match(f.read())
+with open(sys.argv[2], "rb") as f:
+    expected = pickle.load(f)
+curr_depth = match.curr_node.depth
+checked = 0
+while True:
+    node = match.curr_node
+    if node.depth == curr_depth or node.depth % DEFAULT_SNAPSHOT_EVERY == 0:
+        states = expected[curr_depth - node.depth]
+        assert [*node.inter_states, node.stop_state] == states, f"wrong states at depth {node.depth}"
+        checked += 1
+    if node.parent is None:
+        break
+    match.action_back()
+    assert match.curr_node is not node, f"stuck at depth {node.depth}"
+assert checked == curr_depth // DEFAULT_SNAPSHOT_EVERY + 2, checked
+"""
+
+
+def _run(script: str, hash_seed: int, *args: str) -> None:
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    subprocess.run(
+        [sys.executable, "-c", script, *args],
+        cwd=ROOT,
+        env=env,
+        check=True,
+    )
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_replays_nodes_between_snapshots(self) -> None:
+        match = Match(seed=7)
+        agent = dsa.RandomAgent()
+        while match.curr_node.depth < 40:
+            state = match.latest_state()
+            pid = state.waiting_for()
+            match.apply_action(pid, agent.choose_action([state], pid))
+        loaded = decode_match(encode_match(match, snapshot_every=8))
+        node = loaded.curr_node.parent
+        while node is not None:
+            self.assertEqual(node.packed_states is not None, node.depth % 8 == 0)
+            node = node.parent
+        node, expected = loaded.curr_node, match.curr_node
+        while expected is not None:
+            loaded.realize(node)
+            self.assertEqual(
+                [*node.inter_states, node.stop_state],
+                [*expected.inter_states, expected.stop_state],
+            )
+            node, expected = node.parent, expected.parent
+
+    def test_rejects_unknown_item_names(self) -> None:
+        w = _Writer()
+        w.uint(_TAG_NAMED_ITEM)
+        w.blob(b"os:system")
+        with self.assertRaises(MatchFormatError):
+            _read_value(_Reader(bytes(w.buffer)))
+
+    def test_named_items_round_trip(self) -> None:
+        w = _Writer()
+        _write_value(w, dscd.CrownOfWatatsumi)
+        self.assertIs(_read_value(_Reader(bytes(w.buffer))), dscd.CrownOfWatatsumi)
+
+
+class CrossProcessRoundTripTest(unittest.TestCase):
+    def test_load_in_other_processes(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            save = os.path.join(tmp, "match.dgsm")
+            expected = os.path.join(tmp, "states.pkl")
+            _run(_WRITE, 1, save, expected)
+            for hash_seed in (2, 3):
+                with self.subTest(hash_seed=hash_seed):
+                    _run(_READ, hash_seed, save, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
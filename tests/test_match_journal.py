@@ -0,0 +1,104 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Plays a random match journaled to argv[1], starting the journal midway so
+# that it has both a base and records, then tears the last record. Writes the
+# states, node by node from the last journaled one back to the root, to
+# argv[2].
+_WRITE = """
+import pickle, sys
+from dgisim import agents as dsa
+from src.game_data import Match
+from src.match_journal import MatchJournal
+
+match = Match(seed=7)
+agent = dsa.RandomAgent()
+
+def play(depth):
+    while match.curr_node.depth < depth and not match.curr_node.is_terminal():
+        state = match.latest_state()
+        pid = state.waiting_for()
+        match.apply_action(pid, agent.choose_action([state], pid))
+
+play(20)
+journal = MatchJournal(sys.argv[1], match)
+play(40)
+journal.close()
+last = match.curr_node
+play(41)
+with open(sys.argv[1], "ab") as f:
+    f.write(b"\\x40\\x00\\x00\\x00torn")
+states = []
+node = last
+while node is not None:
+    states.append([*node.inter_states, node.stop_state])
+    node = node.parent
+with open(sys.argv[2], "wb") as f:
+    pickle.dump(states, f)
+"""
+
+# Resumes the journal at argv[1] and walks back to the root, checking every
+# node against the states at argv[2]. Journals carry every node's states, so
+# nothing is replayed and every node matches in any process.
+_READ = """
+import pickle, sys
+from src.match_journal import load_journal
+
+match = load_journal(sys.argv[1])
+with open(sys.argv[2], "rb") as f:
+    expected = pickle.load(f)
+assert match.curr_node.depth == len(expected) - 1, match.curr_node.depth
+for states in expected:
+    node = match.curr_node
+    assert [*node.inter_states, node.stop_state] == states, f"wrong states at depth {node.depth}"
+    match.action_back()
+assert node.parent is None, f"stuck at depth {node.depth}"
+"""
+
+
+def _run(script: str, hash_seed: int, *args: str) -> None:
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    subprocess.run(
+        [sys.executable, "-c", script, *args],
+        cwd=ROOT,
+        env=env,
+        check=True,
+    )
+
+
+class JournalResumeTest(unittest.TestCase):
+    def test_resume_in_other_processes(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = os.path.join(tmp, "match.dgmj")
+            expected = os.path.join(tmp, "states.pkl")
+            _run(_WRITE, 1, journal, expected)
+            for hash_seed in (2, 3):
+                with self.subTest(hash_seed=hash_seed):
+                    _run(_READ, hash_seed, journal, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
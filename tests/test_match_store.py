@@ -0,0 +1,106 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from dgisim import agents as dsa
+
+from src import match_codec
+from src.game_data import Match
+from src.match_store import MatchCache
+
+
+def _played(seed: int, depth: int = 10) -> Match:
+    match = Match(seed=seed)
+    agent = dsa.RandomAgent()
+    while match.curr_node.depth < depth:
+        state = match.latest_state()
+        pid = state.waiting_for()
+        match.apply_action(pid, agent.choose_action([state], pid))
+    return match
+
+
+def _states(match: Match) -> list:
+    node = match.curr_node
+    return [*node.inter_states, node.stop_state]
+
+
+class MatchCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = MatchCache(max_matches=1, root=tmp.name)
+        self.addCleanup(self.cache.discard)
+
+    def _files(self) -> list[str]:
+        directory = self.cache._dir
+        return [] if directory is None else os.listdir(directory)
+
+    def test_spills_and_reloads(self) -> None:
+        first, second = _played(1), _played(2)
+        expected = _states(first)
+        self.cache[("a",)] = first
+        self.cache[("b",)] = second
+        self.cache.flush()
+        self.assertEqual(self.cache.on_disk(), 1)
+        self.assertEqual(self.cache.in_memory(), 1)
+        self.assertEqual(len(self._files()), 1)
+
+        reloaded = self.cache[("a",)]
+        self.assertIsNot(reloaded, first)
+        self.assertEqual(_states(reloaded), expected)
+        self.cache.flush()
+        # reloading "a" spilled "b"
+        self.assertEqual(self.cache.on_disk(), 1)
+        self.assertEqual(sorted(self.cache), [("a",), ("b",)])
+
+    def test_keeps_match_accessed_while_written(self) -> None:
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        snapshot_match = match_codec.snapshot_match
+
+        def blocked_snapshot(match: Match, *args) -> object:
+            encode = snapshot_match(match, *args)
+
+            def blocked_encode() -> bytes:
+                gate.wait()
+                return encode()
+
+            return blocked_encode
+
+        first = _played(1)
+        with mock.patch.object(match_codec, "snapshot_match", blocked_snapshot):
+            self.cache[("a",)] = first
+            self.cache[("b",)] = _played(2)
+        # still in memory until written, and kept when accessed meanwhile
+        self.assertEqual(self.cache.in_memory(), 2)
+        self.assertEqual(self.cache.on_disk(), 0)
+        self.assertIs(self.cache[("a",)], first)
+        gate.set()
+        self.cache.flush()
+        # accessing "a" spilled "b", and "a"'s superseded file is removed
+        self.assertIs(self.cache[("a",)], first)
+        self.assertEqual(self.cache.on_disk(), 1)
+        self.assertEqual(len(self._files()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
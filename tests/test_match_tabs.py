@@ -0,0 +1,73 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import tempfile
+import unittest
+
+from src.game_data import GameData, GamePlaySettings, GameServices
+
+
+class KeyedTabTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.services = GameServices(engine_host=None, journal_dir=None, match_dir=tmp.name)
+        self.addCleanup(self.services.close)
+        self.game_data = GameData(services=self.services)
+        self.addCleanup(self.game_data.close_tabs)
+
+    def test_keyed_tab_stays_open_and_resumes(self) -> None:
+        game_data = self.game_data
+        game_data.curr_game_mode = GamePlaySettings.from_random_local_PVP()
+        game_data.init_game()
+        pvp_tab = game_data.focused_tab
+        match = game_data.curr_match
+        depth = match.curr_node.depth
+
+        eve_id = game_data.open_tab(GamePlaySettings.from_random_EVE())
+        self.assertEqual([tab.tab_id for tab in game_data.tabs], [pvp_tab.tab_id, eve_id])
+        # let go of while not focused, so that it can go to disk
+        self.assertIsNone(pvp_tab.match)
+        self.assertTrue(pvp_tab.title())
+        game_data.spill()
+        game_data.matches.flush()
+        self.assertGreater(game_data.matches.on_disk(), 0)
+
+        game_data.focus_tab(pvp_tab.tab_id)
+        self.assertIs(game_data.focused_tab, pvp_tab)
+        self.assertIs(pvp_tab.match, game_data.curr_match)
+        self.assertEqual(game_data.curr_match.curr_node.depth, depth)
+        self.assertEqual(len(game_data.tabs), 2)
+
+        game_data.focus_tab(eve_id)
+        game_data.focus_tab(pvp_tab.tab_id)
+        self.assertEqual(len(game_data.tabs), 2)
+
+    def test_init_game_reuses_tab_of_mode(self) -> None:
+        game_data = self.game_data
+        game_data.curr_game_mode = GamePlaySettings.from_random_local_PVP()
+        game_data.init_game()
+        tab = game_data.focused_tab
+        game_data.open_tab(GamePlaySettings.from_random_EVE())
+        game_data.curr_game_mode = GamePlaySettings.from_random_local_PVP()
+        game_data.init_game()
+        self.assertIs(game_data.focused_tab, tab)
+        self.assertEqual(len(game_data.tabs), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
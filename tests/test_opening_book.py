@@ -0,0 +1,65 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import os
+import tempfile
+import unittest
+
+import dgisim as ds
+
+from src.agents.opening_book import OpeningBook
+
+
+def _redraw_state() -> tuple[ds.GameState, ds.Pid]:
+    state = ds.GameState.from_default()
+    while state.waiting_for() is None:
+        state = state.step()
+    assert isinstance(state.phase, state.mode.card_select_phase)
+    return state, state.waiting_for()
+
+
+class OpeningBookTest(unittest.TestCase):
+    def test_redraws_follow_most_votes(self) -> None:
+        state, pid = _redraw_state()
+        hand = state.get_player(pid).hand_cards
+        redraw_all = ds.CardsSelectAction(selected_cards=hand)
+        keep_all = ds.CardsSelectAction(selected_cards=ds.Cards({}))
+        book = OpeningBook(min_votes=3)
+        book.learn(state, pid, redraw_all)
+        book.learn(state, pid, redraw_all)
+        # too few decisions to go by yet
+        self.assertIsNone(book.get(state, pid))
+        book.learn(state, pid, redraw_all)
+        self.assertEqual(book.get(state, pid), redraw_all)
+        # a later hand doesn't stay bound to the first decisions
+        for _ in range(4):
+            book.learn(state, pid, keep_all)
+        self.assertEqual(book.get(state, pid), keep_all)
+
+    def test_save_and_load(self) -> None:
+        state, pid = _redraw_state()
+        book = OpeningBook(min_votes=1)
+        book.learn(state, pid, ds.CardsSelectAction(selected_cards=state.get_player(pid).hand_cards))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "openings.book")
+            book.save(path)
+            loaded = OpeningBook.load(path)
+        self.assertEqual(loaded._choices, book._choices)
+
+
+if __name__ == "__main__":
+    unittest.main()
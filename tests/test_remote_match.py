@@ -0,0 +1,80 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import unittest
+
+import dgisim as ds
+
+from src.game_data import GameData, GamePlaySettings, GameServices
+from src.remote_match import MatchServer
+
+
+class _Storage:
+    """
+    Stands in for the page's client storage, which outlives sessions.
+    """
+
+    def __init__(self) -> None:
+        self.values: dict = {}
+
+    def get(self, key: str):
+        return self.values.get(key)
+
+    def set(self, key: str, value) -> bool:
+        self.values[key] = value
+        return True
+
+
+class SeatReclaimTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = MatchServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.services = GameServices(engine_host=None, journal_dir=None)
+        self.addCleanup(self.services.close)
+
+    def _join(self, storage: _Storage) -> GameData:
+        game_data = GameData(services=self.services, seat_tokens=storage)
+        self.addCleanup(game_data.close_tabs)
+        game_data.curr_game_mode = GamePlaySettings.from_remote_PVP(self.server.url, "m", ds.Pid.P1)
+        game_data.init_game()
+        return game_data
+
+    def test_reload_retakes_seat(self) -> None:
+        storage = _Storage()
+        first = self._join(storage)
+        remote = first._remote
+        self.assertIsNotNone(remote.token)
+        self.assertIn(remote.token, storage.values.values())
+        first.close_tabs()
+        self.assertIsNone(first._remote)
+        remote._thread.join(5)
+        self.assertFalse(remote._thread.is_alive())
+
+        # a reloaded page starts a new session with the same client storage
+        second = self._join(storage)
+        self.assertEqual(second._remote.token, remote.token)
+        self.assertIs(second.curr_match, second._remote.match)
+
+    def test_seat_of_other_client_is_refused(self) -> None:
+        self._join(_Storage())
+        with self.assertRaises(ConnectionError):
+            self._join(_Storage())
+
+
+if __name__ == "__main__":
+    unittest.main()
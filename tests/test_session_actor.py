@@ -0,0 +1,73 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import asyncio
+import threading
+import unittest
+
+from src.session_actor import SessionActor
+
+
+class SessionActorTest(unittest.TestCase):
+    def _check_order(self, actor: SessionActor) -> None:
+        runs: list = []
+
+        def command(i: int) -> int:
+            self.assertTrue(actor.on_actor_thread())
+            runs.append(i)
+            # queued behind this command, not run inside it
+            actor.submit(runs.append, -i)
+            return actor.call(lambda: i * 10)
+
+        self.assertEqual(actor.call(command, 1), 10)
+        self.assertEqual(asyncio.run(actor.call_async(command, 2)), 20)
+        actor.call(lambda: None)
+        self.assertEqual(runs, [1, -1, 2, -2])
+
+    def test_threaded(self) -> None:
+        actor = SessionActor("test", threaded=True)
+        self._check_order(actor)
+        thread = actor._thread
+        self.assertIsNotNone(thread)
+        self.assertIsNot(thread, threading.current_thread())
+        actor.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        # reusable after closing
+        self.assertEqual(actor.call(lambda: 1), 1)
+        actor.close()
+
+    def test_inline(self) -> None:
+        actor = SessionActor("test", threaded=False)
+        self._check_order(actor)
+        self.assertIsNone(actor._thread)
+
+    def test_coalesces_keyed_commands(self) -> None:
+        actor = SessionActor("test", threaded=True)
+        gate = threading.Event()
+        runs: list = []
+        actor.submit(gate.wait)
+        futures = [actor.submit(runs.append, i, key="seek") for i in range(5)]
+        gate.set()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(runs, [4])
+        actor.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
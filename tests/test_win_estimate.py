@@ -0,0 +1,85 @@
+"""
+Copyright (C) 2024 Leyang Yu
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+import threading
+import unittest
+
+from src.game_data import MatchNode
+from src.win_estimate import WinEstimator
+
+
+class _Estimator(WinEstimator):
+    def __init__(self) -> None:
+        super().__init__()
+        self.computed: list[int] = []
+
+    def _rollouts(self, game_state, seed: int) -> float:
+        self.computed.append(seed)
+        return 0.25
+
+
+class _Owner:
+    pass
+
+
+def _node(seed: int) -> MatchNode:
+    node = MatchNode(seed=seed)
+    node.latest_state = lambda: None
+    return node
+
+
+class WinEstimatorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.estimator = _Estimator()
+        self.addCleanup(self.estimator.close)
+        # holds the estimator's thread until the requests are queued
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+        self.estimator._executor.submit(self.gate.wait)
+
+    def _drain(self) -> None:
+        self.estimator._executor.submit(lambda: None).result(5)
+
+    def test_drops_nodes_the_owner_moved_away_from(self) -> None:
+        owner = _Owner()
+        nodes = [_node(seed) for seed in range(3)]
+        ready: list[float] = []
+        for node in nodes:
+            self.assertIsNone(self.estimator.estimate(node, ready.append, owner=owner))
+        self.gate.set()
+        self._drain()
+        self.assertEqual(self.estimator.computed, [2])
+        self.assertEqual(ready, [0.25])
+        self.assertIsNone(nodes[0].win_estimate)
+        self.assertEqual(self.estimator.estimate(nodes[2], owner=owner), 0.25)
+
+    def test_keeps_nodes_others_wait_for(self) -> None:
+        first, second = _node(0), _node(1)
+        a, b = _Owner(), _Owner()
+        self.estimator.estimate(first, owner=a)
+        self.estimator.estimate(first, owner=b)
+        self.estimator.estimate(second, owner=a)
+        # asked for without an owner, never dropped
+        unowned = _node(2)
+        self.estimator.estimate(unowned)
+        self.gate.set()
+        self._drain()
+        self.assertEqual(self.estimator.computed, [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()